@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Benchmark bgg_xml (iterparse) against the previous xmltodict code on the
+recorded XML API fixtures in benchmarks/fixtures. Reports median parse time
+and peak allocation (tracemalloc) per document.
+
+    python backend/benchmarks/bench_bgg_xml.py --rounds 50
+"""
+
+import argparse
+import html
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+import xmltodict
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+FIXTURES = Path(__file__).resolve().parent / "fixtures"
+sys.path.insert(0, str(BACKEND_DIR))
+
+import bgg_xml  # noqa: E402
+
+
+def old_search(content):
+    data = xmltodict.parse(content)
+    items = data.get('items', {}).get('item', [])
+    if isinstance(items, dict):
+        items = [items]
+    results = []
+    for item in items[:5]:
+        name_val = item.get('name', {}).get('@value')
+        if not name_val and isinstance(item.get('name'), list):
+            name_val = item.get('name')[0].get('@value')
+        results.append({
+            "id": item.get('@id'),
+            "title": name_val,
+            "year": item.get('yearpublished', {}).get('@value'),
+        })
+    return results
+
+
+def old_things(content):
+    # The old code fetched one id per request; parse the batch the same way per item
+    data = xmltodict.parse(content)
+    items = data.get('items', {}).get('item', [])
+    if isinstance(items, dict):
+        items = [items]
+    things = {}
+    for item in items:
+        raw_desc = item.get('description', '')
+        things[item.get('@id')] = {
+            "image": item.get('image', ''),
+            "thumbnail": item.get('thumbnail', ''),
+            "description": html.unescape(raw_desc) if raw_desc else "",
+        }
+    return things
+
+
+def new_things(content):
+    return {
+        k: {"image": v.get("image", ""), "thumbnail": v.get("thumbnail", ""), "description": v.get("description", "")}
+        for k, v in bgg_xml.parse_things(content).items()
+    }
+
+
+def measure(fn, content, rounds):
+    times = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        result = fn(content)
+        times.append(time.perf_counter() - start)
+    times.sort()
+    tracemalloc.start()
+    fn(content)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return times[len(times) // 2], peak, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds", type=int, default=30)
+    parser.add_argument("--fixtures", type=Path, default=FIXTURES)
+    args = parser.parse_args()
+
+    cases = [
+        ("search", args.fixtures / "bgg_xml_search_catan.xml", old_search, bgg_xml.parse_search),
+        ("thing", args.fixtures / "bgg_xml_thing_batch.xml", old_things, new_things),
+    ]
+    for name, path, before_fn, after_fn in cases:
+        content = path.read_bytes()
+        b_time, b_peak, b_result = measure(before_fn, content, args.rounds)
+        a_time, a_peak, a_result = measure(after_fn, content, args.rounds)
+        same = "same output" if b_result == a_result else "OUTPUT DIFFERS"
+        print(
+            f"{name:<7} {path.name} ({len(content) / 1024:.0f} KiB): "
+            f"xmltodict={b_time * 1000:.2f} ms / {b_peak / 1024:.0f} KiB peak  "
+            f"iterparse={a_time * 1000:.2f} ms / {a_peak / 1024:.0f} KiB peak  "
+            f"({b_time / a_time:.1f}x, {same})"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Benchmark the BGG scrape parsers on saved pages in benchmarks/fixtures.
+
+"before" is the previous code path: BeautifulSoup(html.parser) over the whole
+page. "after" is bgg_scrape, which slices out the relevant fragment and parses
+it with lxml.
+
+    python backend/benchmarks/bench_scrape.py --rounds 50
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+from bs4 import BeautifulSoup
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+FIXTURES = Path(__file__).resolve().parent / "fixtures"
+sys.path.insert(0, str(BACKEND_DIR))
+
+import bgg_scrape  # noqa: E402
+
+
+def old_search(text):
+    soup = BeautifulSoup(text, 'html.parser')
+    rows = soup.select('#collectionitems tr')
+    results = []
+    for row in rows[1:6]:
+        title_link = row.select_one('.collection_objectname a.primary')
+        if not title_link:
+            continue
+        year_span = row.select_one('.collection_objectname .smallerfont')
+        img_tag = row.select_one('.collection_thumbnail img')
+        thumbnail = img_tag['src'] if img_tag else ""
+        results.append({
+            "id": title_link['href'].split('/')[2],
+            "title": title_link.text.strip(),
+            "year": year_span.text.strip('()') if year_span else "",
+            "thumbnail": thumbnail,
+            "image": thumbnail,
+        })
+    return results
+
+
+def old_details(text):
+    soup = BeautifulSoup(text, 'html.parser')
+    og_image = soup.select_one('meta[property="og:image"]')
+    desc_meta = soup.select_one('meta[name="description"]')
+    return {
+        "image": og_image['content'] if og_image else "",
+        "description": desc_meta['content'] if desc_meta else "",
+    }
+
+
+def bench(fn, text, rounds):
+    times = []
+    result = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        result = fn(text)
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return times[len(times) // 2], result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds", type=int, default=30)
+    parser.add_argument("--fixtures", type=Path, default=FIXTURES)
+    args = parser.parse_args()
+
+    cases = [
+        ("search", args.fixtures / "bgg_search_catan.html", old_search, bgg_scrape.parse_search_page),
+        ("details", args.fixtures / "bgg_boardgame_13.html", old_details, bgg_scrape.parse_details_page),
+    ]
+    for name, path, before_fn, after_fn in cases:
+        text = path.read_text(encoding="utf-8")
+        before, before_result = bench(before_fn, text, args.rounds)
+        after, after_result = bench(after_fn, text, args.rounds)
+        same = "same output" if before_result == after_result else "OUTPUT DIFFERS"
+        print(
+            f"{name:<8} {path.name} ({len(text) / 1024:.0f} KiB): "
+            f"before={before * 1000:.2f} ms  after={after * 1000:.2f} ms  "
+            f"({before / after:.1f}x, {same})"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Serialization / compression benchmark for the listings feed payload.
+
+Compares the old path (jsonable_encoder + json.dumps, createdAt parsed back to
+datetime) with the orjson path, and reports bytes on the wire for identity,
+gzip and brotli encodings.
+
+    python backend/benchmarks/bench_serialization.py --listings 100 --rounds 50
+"""
+
+import argparse
+import base64
+import gzip
+import json
+import os
+import random
+import time
+import uuid
+from datetime import datetime, timezone, timedelta
+
+import orjson
+from fastapi.encoders import jsonable_encoder
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def make_listing(i: int, rnd: random.Random):
+    created = datetime.now(timezone.utc) - timedelta(minutes=i)
+    fake_jpeg = base64.b64encode(os.urandom(2000) + b"\x00" * 6000).decode()
+    return {
+        "id": str(uuid.uuid4()),
+        "type": rnd.choice(["WTS", "WTB", "WTT", "WTL"]),
+        "title": f"Board Game {i}",
+        "price": rnd.randint(20, 400),
+        "condition": 8.0,
+        "description": "Great condition, sleeved, all components present. " * 10,
+        "images": [f"data:image/jpeg;base64,{fake_jpeg}"],
+        "image": f"data:image/jpeg;base64,{fake_jpeg}",
+        "status": "active",
+        "sellerId": str(uuid.uuid4()),
+        "sellerName": "Seller",
+        "createdAt": created.isoformat(),
+        "currentBid": 0,
+        "bidCount": 0,
+        "bggId": str(rnd.randint(1, 300000)),
+        "openForTrade": False,
+        "isBNIS": False,
+        "comments": [],
+    }
+
+
+def old_path(listings):
+    # What get_listings used to do: parse createdAt, then FastAPI's default encoder
+    for l in listings:
+        if isinstance(l.get("createdAt"), str):
+            l["createdAt"] = datetime.fromisoformat(l["createdAt"])
+    return json.dumps(jsonable_encoder(listings), ensure_ascii=False).encode("utf-8")
+
+
+def new_path(listings):
+    return orjson.dumps(listings)
+
+
+def timed(fn, make_payload, rounds):
+    best = float("inf")
+    body = b""
+    for _ in range(rounds):
+        payload = make_payload()
+        start = time.perf_counter()
+        body = fn(payload)
+        best = min(best, time.perf_counter() - start)
+    return best, body
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--listings", type=int, default=100)
+    parser.add_argument("--rounds", type=int, default=30)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rnd = random.Random(args.seed)
+    base = [make_listing(i, rnd) for i in range(args.listings)]
+
+    def fresh():
+        return [dict(l) for l in base]
+
+    results = {}
+    for name, fn in (("before", old_path), ("after", new_path)):
+        secs, body = timed(fn, fresh, args.rounds)
+        sizes = {"identity": len(body), "gzip": len(gzip.compress(body, 6))}
+        if brotli:
+            sizes["br"] = len(brotli.compress(body, quality=4))
+        results[name] = (secs, sizes)
+
+    print(f"{args.listings} listings, best of {args.rounds} rounds")
+    for name, (secs, sizes) in results.items():
+        wire = ", ".join(f"{k}={v / 1024:.1f} KiB" for k, v in sizes.items())
+        print(f"  {name:<7} serialize={secs * 1000:8.2f} ms  {wire}")
+
+    before, after = results["before"][0], results["after"][0]
+    print(f"  speedup: {before / after:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+"""
+Synthetic marketplace data generator.
+
+Bulk-inserts users and listings (with embedded comments and bids) shaped like
+production data, for benchmarking the feed, search and seller enrichment at
+10k-1M listings. Output is fully determined by --seed, ids included, so two
+runs with the same arguments produce the same database.
+
+Skew knobs:
+- --seller-skew: Zipf exponent for picking sellers; 0 is uniform, ~1.2 gives a
+  handful of power sellers owning a large share of the listings
+- --hot-auctions: fraction of listings that attract heavy bidding
+- --comment-skew: Pareto shape for comments per listing; lower means longer
+  tails (a few threads with hundreds of comments)
+- --image-mode: BGG CDN urls, upload urls, or inline base64 blobs of
+  --image-bytes (what older listings carry)
+
+    python backend/benchmarks/generate_data.py --mongo-url mongodb://localhost:27017 --db-name pmbg_bench \\
+        --users 5000 --listings 200000 --seller-skew 1.2 --drop
+"""
+
+import argparse
+import asyncio
+import base64
+import bisect
+import itertools
+import os
+import random
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+# (bggId, title, typical price in RM)
+GAMES = [
+    ("13", "Catan", 120), ("9209", "Ticket to Ride", 150), ("266192", "Wingspan", 220),
+    ("230802", "Azul", 130), ("174430", "Gloomhaven", 450), ("167791", "Terraforming Mars", 200),
+    ("30549", "Pandemic", 110), ("822", "Carcassonne", 90), ("68448", "7 Wonders", 140),
+    ("148228", "Splendor", 100), ("178900", "Codenames", 60), ("36218", "Dominion", 120),
+    ("31260", "Agricola", 200), ("3076", "Puerto Rico", 150), ("120677", "Terra Mystica", 250),
+    ("161936", "Pandemic Legacy: Season 1", 230), ("224517", "Brass: Birmingham", 300),
+    ("169786", "Scythe", 280), ("187645", "Star Wars: Rebellion", 320), ("173346", "7 Wonders Duel", 90),
+    ("199792", "Everdell", 260), ("237182", "Root", 240), ("162886", "Spirit Island", 260),
+    ("342942", "Ark Nova", 280), ("316554", "Dune: Imperium", 220), ("291457", "Gloomhaven: Jaws of the Lion", 200),
+    ("233078", "Twilight Imperium: Fourth Edition", 600), ("12333", "Twilight Struggle", 180),
+    ("84876", "The Castles of Burgundy", 130), ("182028", "Through the Ages", 250),
+]
+EDITION_SUFFIXES = ["", "", "", " (2nd Edition)", " Deluxe", " - Big Box", " + expansions", " KS Edition"]
+COMMENT_TEXTS = [
+    "Is this still available?", "Can nego?", "Interested, PM you", "Can ship to Penang?",
+    "Condition of the cards?", "Sleeved?", "COD KL possible?", "Will you trade for Root?",
+    "Still there?", "Up", "Bump",
+]
+TYPE_WEIGHTS = {"WTS": 70, "WTB": 15, "WTT": 10, "WTL": 5}
+BATCH_SIZE = 1000
+
+
+def _uuid(rnd: random.Random) -> str:
+    return str(uuid.UUID(int=rnd.getrandbits(128), version=4))
+
+
+def _cumulative(weights):
+    return list(itertools.accumulate(weights))
+
+
+def _pick(rnd: random.Random, items, cum):
+    return items[bisect.bisect_right(cum, rnd.random() * cum[-1])]
+
+
+def make_users(rnd: random.Random, count: int, now: datetime, password_hash: str = ""):
+    users = []
+    for i in range(count):
+        user = {
+            "id": _uuid(rnd),
+            "displayName": f"Seller {i}" if i % 7 else f"Collector {i}",
+            "email": f"user{i}@example.com",
+            "auth_provider": "email",
+            "phone": f"01{rnd.randint(10000000, 99999999)}",
+            "createdAt": (now - timedelta(days=rnd.randint(0, 900))).isoformat(),
+        }
+        if password_hash:
+            user["password_hash"] = password_hash
+        if rnd.random() < 0.3:
+            user["facebookLink"] = f"https://facebook.com/user{i}"
+        if rnd.random() < 0.4:
+            user["picture"] = f"https://i.pravatar.cc/150?u={user['id']}"
+        users.append(user)
+    return users
+
+
+def _image(rnd: random.Random, mode: str, image_bytes: int, bgg_id: str):
+    if mode == "none":
+        return ""
+    if mode == "url":
+        return f"https://cf.geekdo-images.com/synthetic/pic{bgg_id}.jpg"
+    if mode == "upload":
+        return f"/api/uploads/{rnd.getrandbits(128):032x}.jpg"
+    # JPEG magic plus random bytes: same size on the wire as a real photo, incompressible like one
+    blob = b"\xff\xd8\xff\xe0" + rnd.randbytes(max(0, image_bytes - 4))
+    return "data:image/jpeg;base64," + base64.b64encode(blob).decode()
+
+
+def iter_listings(rnd: random.Random, users, count: int, now: datetime, seller_skew: float = 1.0,
+                  hot_auctions: float = 0.02, comment_skew: float = 1.5, comments_scale: float = 0.5,
+                  sold_ratio: float = 0.3, image_mode: str = "url", image_bytes: int = 60_000):
+    """Yield listing documents lazily, newest first, so 1M listings never sit in memory."""
+    seller_cum = _cumulative([1 / (rank + 1) ** seller_skew for rank in range(len(users))])
+    # Popular games dominate the feed the same way
+    game_cum = _cumulative([1 / (rank + 1) ** 0.8 for rank in range(len(GAMES))])
+    types = list(TYPE_WEIGHTS)
+    type_cum = _cumulative(TYPE_WEIGHTS.values())
+    # Spread createdAt over roughly two years with a denser recent tail
+    span_minutes = 2 * 365 * 24 * 60
+
+    for i in range(count):
+        seller = _pick(rnd, users, seller_cum)
+        bgg_id, base_title, base_price = _pick(rnd, GAMES, game_cum)
+        listing_type = _pick(rnd, types, type_cum)
+        created = now - timedelta(minutes=span_minutes * (i / max(count, 1)) ** 1.5)
+        condition = round(min(10.0, max(3.0, rnd.gauss(8.2, 1.2))) * 2) / 2
+        price = max(10, int(base_price * (0.4 + condition / 12) * rnd.uniform(0.8, 1.2)))
+
+        listing = {
+            "id": _uuid(rnd),
+            "type": listing_type,
+            "title": base_title + rnd.choice(EDITION_SUFFIXES),
+            "price": price if listing_type != "WTT" else None,
+            "condition": condition,
+            "description": " ".join(rnd.choices(COMMENT_TEXTS + ["Good condition.", "Complete.", "Smoke free home."], k=rnd.randint(2, 30))),
+            "images": [],
+            "image": "",
+            "status": "sold" if rnd.random() < sold_ratio else "active",
+            "sellerId": seller["id"],
+            "sellerName": seller["displayName"],
+            "createdAt": created.isoformat(),
+            "updatedAt": None,
+            "currentBid": 0,
+            "bidCount": 0,
+            "lastBidderId": None,
+            "bggId": bgg_id if rnd.random() < 0.7 else None,
+            "openForTrade": listing_type == "WTT" or rnd.random() < 0.15,
+            "isBNIS": rnd.random() < 0.05,
+            "comments": [],
+        }
+        if listing_type in ("WTS", "WTT") and image_mode != "none":
+            listing["images"] = [_image(rnd, image_mode, image_bytes, bgg_id) for _ in range(rnd.choice([0, 1, 1, 2, 3]))]
+            listing["image"] = listing["images"][0] if listing["images"] else _image(rnd, "url", 0, bgg_id)
+
+        if listing_type == "WTS" and rnd.random() < hot_auctions:
+            listing["bidCount"] = rnd.randint(10, 150)
+            listing["currentBid"] = price + listing["bidCount"] * rnd.randint(1, 10)
+            listing["lastBidderId"] = rnd.choice(users)["id"]
+        elif listing_type == "WTS" and rnd.random() < 0.1:
+            listing["bidCount"] = rnd.randint(1, 5)
+            listing["currentBid"] = price + listing["bidCount"] * 5
+            listing["lastBidderId"] = rnd.choice(users)["id"]
+
+        # Pareto-tailed thread length: most listings have a comment or two, a few run to hundreds
+        n_comments = int(comments_scale * (rnd.paretovariate(comment_skew) - 1) * 4)
+        for c in range(min(n_comments, 500)):
+            author = rnd.choice(users)
+            listing["comments"].append({
+                "id": _uuid(rnd),
+                "userId": author["id"],
+                "userName": author["displayName"],
+                "userAvatar": author.get("picture"),
+                "text": rnd.choice(COMMENT_TEXTS),
+                "createdAt": (created + timedelta(minutes=5 * (c + 1))).isoformat(),
+            })
+        yield listing
+
+
+async def generate(db, users: int = 1000, listings: int = 10_000, seed: int = 1, drop: bool = False,
+                   batch_size: int = BATCH_SIZE, password_hash: str = "", progress: bool = False, **shape):
+    """Insert a synthetic dataset into `db`. Returns (user_docs, listing_ids).
+
+    `shape` is passed through to iter_listings (seller_skew, hot_auctions, ...).
+    """
+    rnd = random.Random(seed)
+    # Fixed reference time keeps createdAt reproducible too
+    now = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    if drop:
+        await db.users.delete_many({})
+        await db.listings.delete_many({})
+
+    user_docs = make_users(rnd, users, now, password_hash)
+    for start in range(0, len(user_docs), batch_size):
+        # insert_many adds _id to the dicts it's given; keep ours clean for callers
+        await db.users.insert_many([dict(u) for u in user_docs[start:start + batch_size]], ordered=False)
+
+    listing_ids = []
+    batch = []
+    started = time.perf_counter()
+    for listing in iter_listings(rnd, user_docs, listings, now, **shape):
+        listing_ids.append(listing["id"])
+        batch.append(listing)
+        if len(batch) >= batch_size:
+            await db.listings.insert_many(batch, ordered=False)
+            batch = []
+            if progress:
+                rate = len(listing_ids) / (time.perf_counter() - started)
+                print(f"\r{len(listing_ids):>9} / {listings} listings ({rate:,.0f}/s)", end="", file=sys.stderr)
+    if batch:
+        await db.listings.insert_many(batch, ordered=False)
+    if progress:
+        print(file=sys.stderr)
+    return user_docs, listing_ids
+
+
+def add_shape_arguments(parser):
+    parser.add_argument("--seller-skew", type=float, default=1.0, help="Zipf exponent for seller choice (0 = uniform)")
+    parser.add_argument("--hot-auctions", type=float, default=0.02, help="fraction of WTS listings with heavy bidding")
+    parser.add_argument("--comment-skew", type=float, default=1.5, help="Pareto shape for comments per listing")
+    parser.add_argument("--comments-scale", type=float, default=0.5, help="multiplier on comments per listing")
+    parser.add_argument("--sold-ratio", type=float, default=0.3)
+    parser.add_argument("--image-mode", choices=["url", "upload", "base64", "none"], default="url")
+    parser.add_argument("--image-bytes", type=int, default=60_000, help="size of each base64 image before encoding")
+
+
+def shape_from_args(args):
+    return {
+        "seller_skew": args.seller_skew,
+        "hot_auctions": args.hot_auctions,
+        "comment_skew": args.comment_skew,
+        "comments_scale": args.comments_scale,
+        "sold_ratio": args.sold_ratio,
+        "image_mode": args.image_mode,
+        "image_bytes": args.image_bytes,
+    }
+
+
+async def main_async(args):
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    client = AsyncIOMotorClient(args.mongo_url)
+    db = client[args.db_name]
+    started = time.perf_counter()
+    user_docs, listing_ids = await generate(
+        db, users=args.users, listings=args.listings, seed=args.seed, drop=args.drop,
+        batch_size=args.batch_size, progress=True, **shape_from_args(args),
+    )
+    print(f"Inserted {len(user_docs)} users and {len(listing_ids)} listings into {args.db_name} "
+          f"in {time.perf_counter() - started:.1f} s")
+    client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mongo-url", default=os.environ.get("MONGO_URL", "mongodb://localhost:27017"))
+    parser.add_argument("--db-name", required=True)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--listings", type=int, default=10_000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--drop", action="store_true", help="clear users and listings first")
+    add_shape_arguments(parser)
+    asyncio.run(main_async(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+"""
+Offline load test for the API.
+
+Runs the FastAPI app in-process (httpx ASGITransport), against a local MongoDB
+(--mongo-url) or mongomock-motor (default). BGG is served from the fixtures in
+benchmarks/fixtures and the LLM is a fake LlmChat, so nothing leaves the
+machine. The database is seeded by generate_data.py (same skew options), then
+--concurrency virtual users run a weighted mix of feed polling, bids, logins,
+comments and BGG searches for --duration seconds.
+
+    python backend/benchmarks/load_test.py --listings 2000 --concurrency 20 --duration 20
+    python backend/benchmarks/load_test.py --mongo-url mongodb://localhost:27017 --json results.json
+
+Reports req/s and p50/p95/p99 latency per route.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import time
+import types
+from collections import defaultdict
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+FIXTURES = Path(__file__).resolve().parent / "fixtures"
+sys.path.insert(0, str(BACKEND_DIR))
+
+import generate_data  # noqa: E402
+
+PASSWORD = "loadtest-password"
+
+# op name -> weight; tuned to look like the app's real traffic (mostly feed polling)
+DEFAULT_MIX = {
+    "feed": 45,
+    "feed_by_type": 10,
+    "seller_listings": 5,
+    "me": 10,
+    "bid": 10,
+    "comment": 5,
+    "login": 5,
+    "bgg_search": 7,
+    "ai_parse": 3,
+}
+
+
+class FakeLlmChat:
+    """Stands in for emergentintegrations' LlmChat with a fixed, realistic response."""
+
+    latency = 0.0
+
+    def __init__(self, api_key=None, session_id=None, system_message=None):
+        pass
+
+    def with_model(self, provider, model):
+        return self
+
+    async def send_message(self, message):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return json.dumps([
+            {"title": "Catan", "price": 80, "condition": 8.0, "description": "Complete, sleeved"},
+            {"title": "Ticket to Ride", "price": 120, "condition": 9.0, "description": "Played twice"},
+        ])
+
+
+class FakeBggResponse:
+    def __init__(self, status_code, content: bytes):
+        self.status_code = status_code
+        self.content = content
+        self.text = content.decode("utf-8")
+
+
+class FakeBggSession:
+    """Serves recorded BGG pages by URL shape, with optional simulated latency."""
+
+    latency = 0.0
+    pages = {}
+
+    def get(self, url, timeout=None):
+        if self.latency:
+            time.sleep(self.latency)
+        if "xmlapi2/search" in url:
+            return FakeBggResponse(200, self.pages["xml_search"])
+        if "xmlapi2/thing" in url:
+            return FakeBggResponse(200, self.pages["xml_thing"])
+        if "geeksearch.php" in url:
+            return FakeBggResponse(200, self.pages["html_search"])
+        if "/boardgame/" in url:
+            return FakeBggResponse(200, self.pages["html_details"])
+        return FakeBggResponse(404, b"")
+
+
+def install_llm_stand_in():
+    # The real package is only available inside the Emergent environment
+    try:
+        import emergentintegrations.llm.chat  # noqa: F401
+        return
+    except ImportError:
+        pass
+    chat = types.ModuleType("emergentintegrations.llm.chat")
+    chat.LlmChat = FakeLlmChat
+    chat.UserMessage = lambda text=None, file_contents=None: types.SimpleNamespace(text=text, file_contents=file_contents)
+    chat.ImageContent = lambda image_base64=None: types.SimpleNamespace(image_base64=image_base64)
+    sys.modules["emergentintegrations"] = types.ModuleType("emergentintegrations")
+    sys.modules["emergentintegrations.llm"] = types.ModuleType("emergentintegrations.llm")
+    sys.modules["emergentintegrations.llm.chat"] = chat
+
+
+def load_server(args):
+    os.environ.setdefault("RATE_LIMIT_ENABLED", "false")
+    if args.mongo_url:
+        os.environ["MONGO_URL"] = args.mongo_url
+        os.environ["DB_NAME"] = args.db_name
+    install_llm_stand_in()
+
+    import server
+
+    server.LlmChat = FakeLlmChat
+    FakeLlmChat.latency = args.llm_latency
+    FakeBggSession.latency = args.bgg_latency
+    FakeBggSession.pages = {
+        "xml_search": (FIXTURES / "bgg_xml_search_catan.xml").read_bytes(),
+        "xml_thing": (FIXTURES / "bgg_xml_thing_batch.xml").read_bytes(),
+        "html_search": (FIXTURES / "bgg_search_catan.html").read_bytes(),
+        "html_details": (FIXTURES / "bgg_boardgame_13.html").read_bytes(),
+    }
+    server.get_bgg_session = FakeBggSession
+
+    if not args.mongo_url:
+        from mongomock_motor import AsyncMongoMockClient
+
+        server.client = server.resources.mongo_client = AsyncMongoMockClient()
+        server.db = server.resources.db = server.client[args.db_name]
+    return server
+
+
+async def seed(db, args):
+    import bcrypt
+
+    # One bcrypt hash shared by every seeded user; hashing per user would dominate setup
+    password_hash = bcrypt.hashpw(PASSWORD.encode(), bcrypt.gensalt()).decode()
+    return await generate_data.generate(
+        db, users=args.users, listings=args.listings, seed=args.seed, drop=True,
+        password_hash=password_hash, **generate_data.shape_from_args(args),
+    )
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    k = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[k]
+
+
+async def run(args):
+    import httpx
+
+    server = load_server(args)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    users, listing_ids = await seed(server.db, args)
+    # Start above any seeded currentBid so bids mostly succeed and exercise the write path
+    auction_bids = defaultdict(lambda: 5000.0)
+
+    await server.app.router.startup()
+    # Startup's one-off background work (market stats build, title backfill) isn't what we measure
+    await asyncio.gather(*(t for t in list(server.background_tasks) if t.get_coro().__name__ != "sample_loop_lag"))
+    # Likewise the schema migrations over the seeded data (queued as a job at startup, which may hold the lease)
+    while not await server.migrations.run():
+        await asyncio.sleep(0.2)
+    transport = httpx.ASGITransport(app=server.app)
+    samples = defaultdict(list)
+    errors = defaultdict(int)
+    mix_ops = list(args.mix)
+    mix_weights = [args.mix[o] for o in mix_ops]
+    # https so the Secure session cookie is sent back
+    clients = [httpx.AsyncClient(transport=transport, base_url="https://loadtest") for _ in range(args.concurrency)]
+    # Log every virtual user in up front so the bcrypt checks don't land in the measured window
+    for n, http in enumerate(clients):
+        user = users[n % len(users)]
+        await http.post("/api/auth/login-email", json={"email": user["email"], "password": PASSWORD})
+    deadline = time.perf_counter() + args.duration
+
+    async def virtual_user(n: int):
+        urnd = random.Random(args.seed * 1000 + n)
+        user = users[n % len(users)]
+        http = clients[n]
+        while time.perf_counter() < deadline:
+            op = urnd.choices(mix_ops, weights=mix_weights)[0]
+            start = time.perf_counter()
+            if op == "feed":
+                res = await http.get("/api/listings")
+            elif op == "feed_by_type":
+                res = await http.get("/api/listings", params={"type": urnd.choice(["WTS", "WTB", "WTT"])})
+            elif op == "seller_listings":
+                res = await http.get("/api/listings", params={"sellerId": urnd.choice(users)["id"]})
+            elif op == "me":
+                res = await http.get("/api/auth/me")
+            elif op == "bid":
+                lid = urnd.choice(listing_ids)
+                auction_bids[lid] += urnd.randint(1, 20)
+                res = await http.post(f"/api/listings/{lid}/bid", json={"bidAmount": auction_bids[lid], "userId": user["id"]})
+            elif op == "comment":
+                res = await http.post(f"/api/listings/{urnd.choice(listing_ids)}/comments", json={"text": "Still available?"})
+            elif op == "login":
+                res = await http.post("/api/auth/login-email", json={"email": user["email"], "password": PASSWORD})
+            elif op == "bgg_search":
+                res = await http.get("/api/bgg/search", params={"q": urnd.choice(["catan", "azul", "wingspan", "gloomhaven"])})
+            else:
+                res = await http.post("/api/ai/parse-text", json={"text": "Catan RM80, Ticket to Ride RM120"})
+            samples[op].append(time.perf_counter() - start)
+            # Losing a bid race (400) is expected under concurrency
+            if res.status_code >= 500 or (res.status_code >= 400 and op != "bid"):
+                errors[op] += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(virtual_user(i) for i in range(args.concurrency)))
+    elapsed = time.perf_counter() - started
+    for http in clients:
+        await http.aclose()
+    await server.app.router.shutdown()
+
+    report = {"elapsedSeconds": round(elapsed, 2), "concurrency": args.concurrency, "routes": {}}
+    total = 0
+    print(f"\n{args.concurrency} virtual users, {elapsed:.1f} s, {args.listings} listings, {args.users} users")
+    print(f"{'route':<16} {'count':>7} {'err':>5} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for op in mix_ops:
+        values = sorted(samples.get(op, []))
+        total += len(values)
+        row = {
+            "count": len(values),
+            "errors": errors.get(op, 0),
+            "rps": round(len(values) / elapsed, 1),
+            "p50Ms": round(percentile(values, 50) * 1000, 2),
+            "p95Ms": round(percentile(values, 95) * 1000, 2),
+            "p99Ms": round(percentile(values, 99) * 1000, 2),
+        }
+        report["routes"][op] = row
+        print(f"{op:<16} {row['count']:>7} {row['errors']:>5} {row['rps']:>8} {row['p50Ms']:>8} {row['p95Ms']:>8} {row['p99Ms']:>8}")
+    report["totalRps"] = round(total / elapsed, 1)
+    print(f"{'total':<16} {total:>7} {sum(errors.values()):>5} {report['totalRps']:>8}")
+
+    if args.json:
+        Path(args.json).write_text(json.dumps(report, indent=2))
+
+
+def parse_mix(value: str):
+    mix = {}
+    for part in value.split(","):
+        name, _, weight = part.partition("=")
+        if name not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError(f"unknown op {name}, expected one of {', '.join(DEFAULT_MIX)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mongo-url", help="local MongoDB to use instead of mongomock-motor")
+    parser.add_argument("--db-name", default="pmbg_loadtest", help="wiped and reseeded on every run")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--listings", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--mix", type=parse_mix, default=DEFAULT_MIX, help="e.g. feed=50,bid=10,login=5")
+    parser.add_argument("--bgg-latency", type=float, default=0.0, help="simulated BGG latency in seconds")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="simulated LLM latency in seconds")
+    parser.add_argument("--seed", type=int, default=1)
+    generate_data.add_shape_arguments(parser)
+    parser.add_argument("--json", help="also write the report to this file")
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+Parsers for the BGG HTML pages used when the XML API is blocked.
+
+BGG pages are ~100 KB of scripts and navigation around the few nodes we need.
+Instead of building a full BeautifulSoup tree, cut out just the relevant part
+of the page (the #collectionitems table, or <head> for the meta tags) and
+parse that with lxml. BeautifulSoup is kept as a fallback when lxml is not
+installed.
+
+These are plain CPU-bound functions; callers run them off the event loop.
+"""
+
+import re
+
+try:
+    import lxml.html
+except ImportError:  # pragma: no cover - lxml is in requirements, bs4 keeps us working without it
+    lxml = None
+    from bs4 import BeautifulSoup
+
+_TABLE_ID = re.compile(r"""id\s*=\s*['"]collectionitems['"]""")
+
+
+def _has_class(name: str) -> str:
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+
+def _collection_table(text: str) -> str:
+    m = _TABLE_ID.search(text)
+    if not m:
+        return ""
+    start = text.rfind("<table", 0, m.start())
+    end = text.find("</table>", m.end())
+    if start == -1 or end == -1:
+        return ""
+    return text[start:end + len("</table>")]
+
+
+def _head(text: str) -> str:
+    end = text.find("</head>")
+    return text[:end + len("</head>")] if end != -1 else text
+
+
+def parse_search_page(text: str, limit: int = 5):
+    """Rows of a geeksearch.php result page as [{id, title, year, thumbnail, image}]."""
+    fragment = _collection_table(text)
+    if not fragment:
+        return []
+
+    results = []
+    if lxml is not None:
+        table = lxml.html.fragment_fromstring(fragment)
+        rows = table.xpath("./tr|./tbody/tr")
+        for row in rows[1:1 + limit]:  # Skip header
+            links = row.xpath(f".//td[{_has_class('collection_objectname')}]//a[{_has_class('primary')}]")
+            if not links:
+                continue
+            href = links[0].get("href", "")
+            parts = href.split("/")  # /boardgame/13/catan
+            if len(parts) < 3:
+                continue
+            years = row.xpath(f".//td[{_has_class('collection_objectname')}]//*[{_has_class('smallerfont')}]")
+            imgs = row.xpath(f".//td[{_has_class('collection_thumbnail')}]//img/@src")
+            thumbnail = imgs[0] if imgs else ""
+            results.append({
+                "id": parts[2],
+                "title": links[0].text_content().strip(),
+                "year": years[0].text_content().strip().strip("()") if years else "",
+                "thumbnail": thumbnail,
+                "image": thumbnail,  # Fallback
+            })
+        return results
+
+    soup = BeautifulSoup(fragment, "html.parser")
+    for row in soup.select("tr")[1:1 + limit]:
+        title_link = row.select_one(".collection_objectname a.primary")
+        if not title_link or len(title_link.get("href", "").split("/")) < 3:
+            continue
+        year_span = row.select_one(".collection_objectname .smallerfont")
+        img_tag = row.select_one(".collection_thumbnail img")
+        thumbnail = img_tag["src"] if img_tag else ""
+        results.append({
+            "id": title_link["href"].split("/")[2],
+            "title": title_link.text.strip(),
+            "year": year_span.text.strip().strip("()") if year_span else "",
+            "thumbnail": thumbnail,
+            "image": thumbnail,
+        })
+    return results
+
+
+def parse_details_page(text: str):
+    """og:image and meta description of a /boardgame/<id> page."""
+    head = _head(text)
+    if lxml is not None:
+        doc = lxml.html.document_fromstring(head)
+        image = doc.xpath('//meta[@property="og:image"]/@content')
+        desc = doc.xpath('//meta[@name="description"]/@content')
+        return {"image": image[0] if image else "", "description": desc[0] if desc else ""}
+
+    soup = BeautifulSoup(head, "html.parser")
+    og_image = soup.select_one('meta[property="og:image"]')
+    desc_meta = soup.select_one('meta[name="description"]')
+    return {
+        "image": og_image["content"] if og_image else "",
+        "description": desc_meta["content"] if desc_meta else "",
+    }
@@ -0,0 +1,91 @@
+"""
+Streaming readers for BGG XML API 2 responses.
+
+`thing` responses carry polls, dozens of <link>s and alternate names per item.
+xmltodict turns all of that into nested dicts only for us to read six fields.
+These readers walk the document with iterparse, keep only the fields we use,
+and clear every element once it has been read, so memory stays flat and
+search parsing stops as soon as `limit` items have been seen.
+"""
+
+import html
+import io
+import xml.etree.ElementTree as ET
+from typing import Dict, Iterator, List
+
+# Children of <item> we read; everything else is dropped as soon as it closes
+SEARCH_FIELDS = {"name", "yearpublished"}
+THING_FIELDS = {"name", "yearpublished", "image", "thumbnail", "description"}
+
+
+def _iter_items(content: bytes, fields: set) -> Iterator[ET.Element]:
+    depth = 0
+    root = None
+    for event, el in ET.iterparse(io.BytesIO(content), events=("start", "end")):
+        if event == "start":
+            depth += 1
+            if depth == 1:
+                root = el
+            continue
+        depth -= 1
+        if depth == 2 and el.tag not in fields:
+            el.clear()
+        elif depth == 1 and el.tag == "item":
+            yield el
+            el.clear()
+            root.remove(el)
+
+
+def _name(item: ET.Element) -> str:
+    first = None
+    for name in item.iterfind("name"):
+        if name.get("type") == "primary":
+            return name.get("value")
+        if first is None:
+            first = name.get("value")
+    return first
+
+
+def _alternate_names(item: ET.Element) -> List[str]:
+    return [n.get("value") for n in item.iterfind("name") if n.get("type") == "alternate" and n.get("value")]
+
+
+def _value(item: ET.Element, tag: str):
+    el = item.find(tag)
+    return el.get("value") if el is not None else None
+
+
+def parse_search(content: bytes, limit: int = 5) -> List[dict]:
+    """/xmlapi2/search -> [{id, title, year}] for the first `limit` items."""
+    results = []
+    if limit <= 0:
+        return results
+    for item in _iter_items(content, SEARCH_FIELDS):
+        results.append({
+            "id": item.get("id"),
+            "title": _name(item),
+            "year": _value(item, "yearpublished"),
+        })
+        if len(results) >= limit:
+            break
+    return results
+
+
+def parse_things(content: bytes) -> Dict[str, dict]:
+    """/xmlapi2/thing?id=a,b,c -> {id: {title, alternateNames, year, image, thumbnail, description}}.
+
+    Only fields present in the document are set, so callers can keep fallbacks.
+    """
+    things = {}
+    for item in _iter_items(content, THING_FIELDS):
+        thing = {"title": _name(item), "alternateNames": _alternate_names(item), "year": _value(item, "yearpublished")}
+        for tag in ("image", "thumbnail"):
+            el = item.find(tag)
+            if el is not None:
+                thing[tag] = (el.text or "").strip()
+        desc = item.find("description")
+        if desc is not None:
+            # BGG double-encodes entities (&amp;#10;), the XML parser only undoes one level
+            thing["description"] = html.unescape(desc.text.strip()) if desc.text else ""
+        things[item.get("id")] = thing
+    return things
@@ -0,0 +1,127 @@
+"""
+Circuit breakers for upstream calls (BGG XML API, BGG HTML scrape).
+
+A breaker keeps a short window of recent calls. Once enough of them failed (or
+took longer than `slow_call_seconds`), it opens and callers skip that path
+immediately instead of waiting for a timeout. After `reset_seconds` it goes
+half-open and lets a single probe through: success closes it again, failure
+re-opens it.
+
+The BGG helpers run in worker threads, so all state changes take a lock.
+"""
+
+import threading
+import time
+from collections import deque
+from typing import Dict
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        name: str,
+        window: int = 20,
+        window_seconds: float = 60,
+        min_calls: int = 4,
+        failure_ratio: float = 0.5,
+        slow_call_seconds: float = 4,
+        reset_seconds: float = 30,
+    ):
+        self.name = name
+        self.window_seconds = window_seconds
+        self.min_calls = min_calls
+        self.failure_ratio = failure_ratio
+        self.slow_call_seconds = slow_call_seconds
+        self.reset_seconds = reset_seconds
+
+        self._calls = deque(maxlen=window)  # (timestamp, ok, latency)
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+        self.rejected = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state(time.monotonic())
+
+    def _current_state(self, now: float) -> str:
+        if self._state == OPEN and now - self._opened_at >= self.reset_seconds:
+            self._state = HALF_OPEN
+            self._probing = False
+        return self._state
+
+    def allow(self) -> bool:
+        """True if a call may go through now. In half-open state only one probe is let through."""
+        with self._lock:
+            state = self._current_state(time.monotonic())
+            if state == CLOSED:
+                return True
+            if state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            self.rejected += 1
+            return False
+
+    def record(self, ok: bool, latency: float):
+        now = time.monotonic()
+        ok = ok and latency < self.slow_call_seconds
+        with self._lock:
+            self._calls.append((now, ok, latency))
+            if self._state == HALF_OPEN:
+                self._probing = False
+                if ok:
+                    self._state = CLOSED
+                    self._calls.clear()
+                else:
+                    self._trip(now)
+                return
+
+            recent = [c for c in self._calls if now - c[0] <= self.window_seconds]
+            failures = sum(1 for c in recent if not c[1])
+            if len(recent) >= self.min_calls and failures / len(recent) >= self.failure_ratio:
+                self._trip(now)
+
+    def release(self):
+        """Forget a call allow() let through but that we cut short ourselves (request deadline).
+
+        It says nothing about the upstream, so it isn't recorded; a half-open
+        breaker just lets the next probe through.
+        """
+        with self._lock:
+            self._probing = False
+
+    def _trip(self, now: float):
+        self._state = OPEN
+        self._opened_at = now
+
+    def snapshot(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            state = self._current_state(now)
+            recent = [c for c in self._calls if now - c[0] <= self.window_seconds]
+            latencies = sorted(c[2] for c in recent)
+            failures = sum(1 for c in recent if not c[1])
+            return {
+                "state": state,
+                "recentCalls": len(recent),
+                "errorRate": round(failures / len(recent), 3) if recent else 0.0,
+                "p50LatencyMs": round(latencies[len(latencies) // 2] * 1000) if latencies else None,
+                "maxLatencyMs": round(latencies[-1] * 1000) if latencies else None,
+                "rejected": self.rejected,
+                "retryInSeconds": round(max(0.0, self.reset_seconds - (now - self._opened_at)), 1) if state == OPEN else 0,
+            }
+
+
+breakers: Dict[str, CircuitBreaker] = {}
+
+
+def get_breaker(name: str, **kwargs) -> CircuitBreaker:
+    if name not in breakers:
+        breakers[name] = CircuitBreaker(name, **kwargs)
+    return breakers[name]
@@ -0,0 +1,256 @@
+"""
+Perceptual-hash index of box covers, used in front of the LLM in scan_image.
+
+Every confirmed listing with a bggId contributes 64-bit pHashes of its cover
+(the BGG cover URL and/or the seller's own photo). A new photo is hashed as a
+whole and as 2x2 / 3x3 grid cells. Each region whose hash is within
+MATCH_DISTANCE bits of an indexed cover is treated as recognized. Recognized
+cells are greyed out before the photo goes to the LLM, and if the whole photo
+matches the LLM is skipped entirely.
+
+Hashes are persisted in the `cover_hashes` collection and held in memory as a
+numpy uint64 array, so a lookup is one vectorised XOR + popcount. New covers
+are hashed by the "cover_index" job (see jobs.py), in whichever process runs
+it, and the new hashes are broadcast on the "cover_index" channel so every
+process adds them to its index.
+"""
+
+import asyncio
+import base64
+import io
+import logging
+import os
+import uuid
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+import data_access
+import deadlines
+import jobs
+import resources
+import uploads
+from shared_state import state
+
+try:
+    from PIL import Image, ImageDraw
+except ImportError:  # pragma: no cover - index is simply disabled without Pillow
+    Image = None
+
+try:
+    # HEIC phone photos; without it they can't be hashed and go to the LLM as they are
+    from pillow_heif import register_heif_opener
+    register_heif_opener()
+except ImportError:
+    pass
+
+logger = logging.getLogger(__name__)
+
+MATCH_DISTANCE = int(os.environ.get("COVER_MATCH_DISTANCE", 10))
+GRID_SIZES = (2, 3)
+BGG_IMAGE_HOSTS = ("https://cf.geekdo-images.com/",)
+CHANNEL = "cover_index"
+
+_instance = uuid.uuid4().hex
+
+_DCT_SIZE = 32
+_n = np.arange(_DCT_SIZE)
+_DCT = np.cos(np.pi * (2 * _n[None, :] + 1) * _n[:, None] / (2 * _DCT_SIZE))
+_BIT_WEIGHTS = np.uint64(1) << np.arange(63, -1, -1, dtype=np.uint64)
+
+
+def enabled() -> bool:
+    return Image is not None
+
+
+def decode_image(data: str):
+    if "base64," in data:
+        data = data.split("base64,", 1)[1]
+    return Image.open(io.BytesIO(base64.b64decode(data))).convert("RGB")
+
+
+def phash(img) -> int:
+    """64-bit DCT perceptual hash of a PIL image."""
+    gray = np.asarray(img.convert("L").resize((_DCT_SIZE, _DCT_SIZE), Image.LANCZOS), dtype=np.float64)
+    low = (_DCT @ gray @ _DCT.T)[:8, :8].flatten()
+    bits = low > np.median(low[1:])  # skip the DC term, it only reflects brightness
+    return int((bits.astype(np.uint64) * _BIT_WEIGHTS).sum())
+
+
+def _popcount(x: np.ndarray) -> np.ndarray:
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(x)
+    return np.unpackbits(x.view(np.uint8)).reshape(-1, 64).sum(axis=1)
+
+
+class CoverIndex:
+    def __init__(self):
+        # Replaced as a whole on every add so lookups in worker threads see a consistent pair
+        self._snapshot: Tuple[np.ndarray, list] = (np.zeros(0, dtype=np.uint64), [])
+        self.indexed_urls = set()
+
+    def __len__(self):
+        return len(self._snapshot[1])
+
+    def add(self, h: int, bgg_id: str, title: str):
+        self.add_many([h], [{"bggId": bgg_id, "title": title}])
+
+    def add_many(self, new_hashes: List[int], new_entries: List[dict]):
+        hashes, entries = self._snapshot
+        self._snapshot = (
+            np.concatenate([hashes, np.array(new_hashes, dtype=np.uint64)]),
+            entries + new_entries,
+        )
+
+    def nearest(self, h: int) -> Tuple[int, Optional[dict]]:
+        hashes, entries = self._snapshot
+        if not entries:
+            return 64, None
+        distances = _popcount(hashes ^ np.uint64(h))
+        i = int(distances.argmin())
+        return int(distances[i]), entries[i]
+
+    def match_photo(self, data: str) -> Tuple[List[dict], Optional[str]]:
+        """Returns (recognized covers, base64 JPEG still to send to the LLM or None if nothing is left)."""
+        if not enabled() or not len(self):
+            return [], data
+        img = decode_image(data)
+
+        distance, entry = self.nearest(phash(img))
+        if entry and distance <= MATCH_DISTANCE:
+            return [entry], None
+
+        w, h = img.size
+        matches = {}
+        matched_boxes = []
+        for n in GRID_SIZES:
+            for row in range(n):
+                for col in range(n):
+                    box = (col * w // n, row * h // n, (col + 1) * w // n, (row + 1) * h // n)
+                    distance, entry = self.nearest(phash(img.crop(box)))
+                    if entry and distance <= MATCH_DISTANCE:
+                        matches.setdefault(entry["bggId"], entry)
+                        matched_boxes.append(box)
+
+        if not matched_boxes:
+            return [], data
+
+        masked = img.copy()
+        draw = ImageDraw.Draw(masked)
+        for box in matched_boxes:
+            draw.rectangle(box, fill=(128, 128, 128))
+        out = io.BytesIO()
+        masked.save(out, format="JPEG", quality=85)
+        return list(matches.values()), base64.b64encode(out.getvalue()).decode()
+
+
+index = CoverIndex()
+
+
+def _add_docs(docs: List[dict]):
+    hashes, entries = [], []
+    for doc in docs:
+        hashes.append(int(doc["hash"], 16))
+        entries.append({"bggId": doc["bggId"], "title": doc.get("title", "")})
+        if doc.get("source"):
+            index.indexed_urls.add(doc["source"])
+    index.add_many(hashes, entries)
+
+
+async def load(db):
+    _add_docs([doc async for doc in db.cover_hashes.find({}, {"_id": 0})])
+    logger.info(f"Cover index loaded with {len(index)} hashes")
+
+
+def _on_hashes(message: dict):
+    if message.get("origin") != _instance:
+        _add_docs(message.get("hashes") or [])
+
+
+state.subscribe(CHANNEL, _on_hashes)
+
+
+async def _fetch(url: str) -> Optional[str]:
+    resp = await resources.http_client().get(url, timeout=deadlines.timeout(5))
+    if resp.status_code != 200:
+        return None
+    return base64.b64encode(resp.content).decode()
+
+
+async def index_listings(db, listings: List[dict]):
+    """Hash the covers of newly confirmed listings (those with a bggId)."""
+    if not enabled():
+        return
+    # A scanned shelf photo is attached to every game found in it, so it identifies none of them
+    counts = {}
+    for l in listings:
+        for img in l.get("images") or []:
+            counts[img] = counts.get(img, 0) + 1
+
+    docs = []
+    # BGG covers fetched in this batch; index.indexed_urls only gets them once their hash is stored
+    fetched = set()
+    for l in listings:
+        if not l.get("bggId"):
+            continue
+        sources = [l.get("image")] + list(l.get("images") or [])
+        seen = set()
+        for src in sources:
+            if not src or src in seen or counts.get(src, 0) > 1 or src in index.indexed_urls or src in fetched:
+                continue
+            seen.add(src)
+            source = None
+            try:
+                if src.startswith(BGG_IMAGE_HOSTS):
+                    # The same BGG cover shows up on every listing of that game; fetch it once
+                    source = src
+                    fetched.add(source)
+                    src = await _fetch(src)
+                    if not src:
+                        continue
+                elif uploads.referenced_names([src]):
+                    # The seller's own photo, uploaded through /api/uploads: read it from disk
+                    path = uploads.stored_path(uploads.referenced_names([src])[0])
+                    if path is None:
+                        continue
+                    src = await asyncio.to_thread(lambda p=path: base64.b64encode(p.read_bytes()).decode())
+                elif not src.startswith("data:image"):
+                    continue
+                h = await asyncio.to_thread(lambda s=src: phash(decode_image(s)))
+            except Exception as e:
+                logger.warning(f"Cover hash failed for listing {l.get('id')}: {e}")
+                continue
+            distance, entry = index.nearest(h)
+            if entry and distance == 0 and entry["bggId"] == l["bggId"]:
+                if source:
+                    index.indexed_urls.add(source)
+                continue
+            index.add(h, l["bggId"], l.get("title", ""))
+            docs.append({
+                "hash": f"{h:016x}",
+                "bggId": l["bggId"],
+                "title": l.get("title", ""),
+                "listingId": l.get("id"),
+                "source": source,
+            })
+
+    if docs:
+        await db.cover_hashes.insert_many(docs)
+        for d in docs:
+            d.pop("_id", None)
+            if d["source"]:
+                index.indexed_urls.add(d["source"])
+        try:
+            await state.publish(CHANNEL, {"origin": _instance, "hashes": docs})
+        except Exception as e:
+            logger.warning(f"Cover hash broadcast failed: {e}")
+
+
+@jobs.job("cover_index", concurrency=1, timeout=120)
+async def index_listings_job(payload: dict):
+    """Payload {ids}: listings created together, so shared shelf photos are still recognized."""
+    listings = await data_access.find(
+        "listings", {"id": {"$in": payload["ids"]}},
+        {"_id": 0, "id": 1, "bggId": 1, "title": 1, "image": 1, "images": 1},
+    )
+    await index_listings(resources.db, listings)
@@ -0,0 +1,130 @@
+"""
+Request deadlines.
+
+Each request gets a time budget when it arrives: BUDGETS per (method, path)
+for the routes that call slow upstreams, DEADLINE_DEFAULT_SECONDS for the
+rest. The absolute deadline sits in a contextvar, so it follows the request
+into tasks it spawns and threads started with asyncio.to_thread (the BGG
+lookups) without being passed around.
+
+Outbound calls take their timeout from what's left:
+
+- timeout(cap): seconds to give a blocking call, at most `cap`; raises
+  DeadlineExceeded once nothing is left.
+- run(awaitable, cap): awaits with that timeout and cancels it when it runs
+  out, raising DeadlineExceeded.
+
+Handlers that can do without some enrichment check remaining() and return
+what they have (BGG results without descriptions, locally recognized covers
+without the LLM's). A DeadlineExceeded that reaches the app is answered 504.
+Job handlers run under a deadline of their job timeout (see jobs.py).
+Outside a request or job there is no deadline and only the caps apply.
+"""
+
+import asyncio
+import logging
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Optional
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+DEADLINE_DEFAULT_SECONDS = float(os.environ.get("DEADLINE_DEFAULT_SECONDS", 10.0))
+
+# (method, path) -> seconds
+BUDGETS: Dict[tuple, float] = {
+    ("POST", "/api/ai/scan-image"): 30,
+    ("POST", "/api/ai/scan-image/upload"): 30,
+    ("POST", "/api/ai/parse-text"): 20,
+    ("GET", "/api/bgg/search"): 8,
+    ("POST", "/api/bgg/match"): 15,
+    ("POST", "/api/auth/exchange-session"): 8,
+    ("GET", "/api/auth/facebook/callback"): 10,
+}
+
+# time.monotonic() by which the current request or job should be answered
+_deadline: ContextVar[Optional[float]] = ContextVar("deadline", default=None)
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+def remaining() -> Optional[float]:
+    """Seconds left in the current budget, or None when there is none."""
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def timeout(cap: float) -> float:
+    """Timeout for the next outbound call: `cap`, or less if the budget is running out."""
+    left = remaining()
+    if left is None:
+        return cap
+    if left <= 0:
+        raise DeadlineExceeded("Request deadline passed")
+    return min(cap, left)
+
+
+async def run(awaitable, cap: Optional[float] = None, upstream: Optional[str] = None):
+    """Await `awaitable` within the remaining budget (and `cap`), cancelling it when time runs out."""
+    left = remaining()
+    limit = cap if left is None else (left if cap is None else min(cap, left))
+    if limit is not None and limit <= 0:
+        if asyncio.iscoroutine(awaitable):
+            awaitable.close()
+        raise DeadlineExceeded("Request deadline passed")
+    try:
+        return await asyncio.wait_for(awaitable, limit)
+    except asyncio.TimeoutError:
+        # Only our own cut-off; a timeout raised inside the call is the callee's business
+        if limit is None:
+            raise
+        if upstream:
+            metrics.DEADLINES_EXCEEDED.labels(upstream).inc()
+        raise DeadlineExceeded(f"{upstream or 'Call'} didn't finish in {limit:.1f}s")
+
+
+@contextmanager
+def budget(seconds: float):
+    """Run the block under a deadline `seconds` from now, or the enclosing one if that's sooner."""
+    deadline = time.monotonic() + seconds
+    outer = _deadline.get()
+    token = _deadline.set(deadline if outer is None else min(outer, deadline))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+class DeadlineMiddleware:
+    """ASGI middleware starting each request's budget, and answering 504 when it's blown."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        seconds = BUDGETS.get((scope["method"], scope["path"]), DEADLINE_DEFAULT_SECONDS)
+        started = {"response": False}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                started["response"] = True
+            await send(message)
+
+        with budget(seconds):
+            try:
+                await self.app(scope, receive, send_wrapper)
+            except DeadlineExceeded as e:
+                if started["response"]:
+                    raise
+                logger.warning(f"{scope['method']} {scope['path']} ran out of time: {e}")
+                await send({"type": "http.response.start", "status": 504,
+                            "headers": [(b"content-type", b"application/json")]})
+                await send({"type": "http.response.body", "body": b'{"detail":"Upstream timed out"}'})
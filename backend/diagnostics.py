@@ -0,0 +1,146 @@
+"""
+Opt-in diagnostics: event-loop stall detector and per-request profiler.
+
+Enable with DIAGNOSTICS=1. Output goes to DIAGNOSTICS_DIR (default
+backend/diagnostics_out):
+
+- stalls.jsonl: a task on the loop touches a heartbeat every few ms. A
+  watchdog thread notices when the heartbeat stops for more than
+  BLOCK_THRESHOLD_MS and records the loop thread's stack *while it is still
+  blocked*, which points at the offending call (requests, bcrypt, parsing...).
+  A second record gives the total stall time once the loop recovers.
+- profile-*.html / profile-*.prof: send `X-Profile: 1` (plus
+  `X-Profile-Token` if DIAGNOSTICS_TOKEN is set) and that request is profiled
+  with pyinstrument when installed, cProfile otherwise. The response carries
+  the file name in `X-Profile-Output`. cProfile is not async-aware, so its
+  output includes whatever else ran on the loop during the request.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from pathlib import Path
+
+try:
+    from pyinstrument import Profiler
+except ImportError:
+    Profiler = None
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.environ.get("DIAGNOSTICS", "").lower() in ("1", "true", "yes")
+OUTPUT_DIR = Path(os.environ.get("DIAGNOSTICS_DIR", Path(__file__).parent / "diagnostics_out"))
+BLOCK_THRESHOLD_MS = float(os.environ.get("BLOCK_THRESHOLD_MS", 100))
+PROFILE_TOKEN = os.environ.get("DIAGNOSTICS_TOKEN", "")
+HEARTBEAT_SECONDS = 0.01
+
+
+def _write_jsonl(name: str, record: dict):
+    OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+    with open(OUTPUT_DIR / name, "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+
+class StallDetector:
+    def __init__(self, threshold_ms: float = BLOCK_THRESHOLD_MS):
+        self.threshold = threshold_ms / 1000
+        self._heartbeat = time.monotonic()
+        self._loop_thread_id = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._task = None
+
+    async def _beat(self):
+        while True:
+            self._heartbeat = time.monotonic()
+            await asyncio.sleep(HEARTBEAT_SECONDS)
+
+    def _watch(self):
+        stalled_since = None
+        while not self._stop.wait(self.threshold / 4):
+            now = time.monotonic()
+            late = now - self._heartbeat - HEARTBEAT_SECONDS
+            if late > self.threshold and stalled_since is None:
+                stalled_since = self._heartbeat
+                frame = sys._current_frames().get(self._loop_thread_id)
+                stack = traceback.format_stack(frame) if frame else []
+                _write_jsonl("stalls.jsonl", {
+                    "event": "stall",
+                    "at": time.time(),
+                    "blockedMs": round(late * 1000, 1),
+                    "stack": stack,
+                })
+                logger.warning(f"Event loop blocked for {late * 1000:.0f} ms, stack written to {OUTPUT_DIR}")
+            elif late <= self.threshold and stalled_since is not None:
+                _write_jsonl("stalls.jsonl", {
+                    "event": "recovered",
+                    "at": time.time(),
+                    "totalMs": round((self._heartbeat - stalled_since) * 1000, 1),
+                })
+                stalled_since = None
+
+    def start(self):
+        self._loop_thread_id = threading.get_ident()
+        self._task = asyncio.get_running_loop().create_task(self._beat())
+        self._thread = threading.Thread(target=self._watch, name="loop-stall-watchdog", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._task:
+            self._task.cancel()
+
+
+detector = StallDetector()
+
+
+class ProfilerMiddleware:
+    """Profiles requests carrying `X-Profile: 1`. Only installed when DIAGNOSTICS is on."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        headers = dict(scope.get("headers", []))
+        if headers.get(b"x-profile") != b"1":
+            return await self.app(scope, receive, send)
+        if PROFILE_TOKEN and headers.get(b"x-profile-token", b"").decode() != PROFILE_TOKEN:
+            return await self.app(scope, receive, send)
+
+        OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+        slug = scope["path"].strip("/").replace("/", "_") or "root"
+        stem = f"profile-{time.strftime('%Y%m%d-%H%M%S')}-{int(time.time() * 1000) % 1000:03d}-{scope['method']}-{slug}"
+        filename = f"{stem}.html" if Profiler else f"{stem}.prof"
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                message = dict(message)
+                message["headers"] = list(message.get("headers", [])) + [(b"x-profile-output", filename.encode())]
+            await send(message)
+
+        if Profiler is not None:
+            profiler = Profiler(async_mode="enabled")
+            profiler.start()
+            try:
+                await self.app(scope, receive, send_wrapper)
+            finally:
+                profiler.stop()
+                (OUTPUT_DIR / filename).write_text(profiler.output_html())
+            return
+
+        import cProfile
+
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            profile.disable()
+            profile.dump_stats(str(OUTPUT_DIR / filename))
@@ -0,0 +1,388 @@
+"""
+Near-duplicate detection over listing text, with MinHash LSH.
+
+Two indexes share one MinHash (character trigrams, NUM_PERM hash functions,
+banded BANDS x ROWS so only listings sharing a band are ever compared):
+
+- Reposts: every active listing is indexed on its title key plus the start
+  of its description. A new listing at least REPOST_SIMILARITY similar to an
+  active listing of the same type is stored with `duplicateOf`
+  {id, sellerId, kind, similarity}. kind is "repost" when the seller is the
+  same, "copy" when another seller's listing has the same (substantial)
+  description.
+- BGG links: the title keys of listings linked to BGG, each with the bggId
+  most of them use. An unlinked listing gets the bggId of its own key (or of
+  a BGG alias, see titles.py), else of the nearest indexed key when that is
+  at least LINK_SIMILARITY similar by exact trigram Jaccard, has the same
+  numbers in it ("season 1" vs "season 2"), and no other game comes close.
+  Such links are stored with bggIdSource "title" and never count as evidence.
+
+New listings are annotated in create_listings. link_unlabeled() does the
+same linking over the whole collection in bulk and backfills `normTitle`.
+It runs as the "link_unlabeled" job (see jobs.py), queued once under one key
+when the API starts so a deploy runs it once rather than in every worker,
+and from the command line:
+
+    python backend/duplicates.py
+"""
+
+import asyncio
+import logging
+import os
+import re
+import zlib
+from typing import Dict, List, Optional, Set, Tuple
+
+import numpy as np
+from pymongo import UpdateOne
+
+import data_access
+import feed_views
+import http_cache
+import jobs
+from titles import bgg_id_for_key, normalize_title, title_key
+
+logger = logging.getLogger(__name__)
+
+REPOST_SIMILARITY = float(os.environ.get("REPOST_SIMILARITY", 0.85))
+LINK_SIMILARITY = float(os.environ.get("TITLE_LINK_SIMILARITY", 0.8))
+# How far ahead of the next game the best near match has to be
+LINK_MARGIN = 0.1
+# Share of a key's linked listings that must agree on one bggId
+LINK_AGREEMENT = 0.8
+DESCRIPTION_CHARS = 300
+# Shorter descriptions ("mint, no trades") are too common to call a copy
+MIN_COPY_DESCRIPTION = 40
+
+NUM_PERM = 64
+# 8 bands of 8 rows: pairs above ~0.8 similarity share a band with high
+# probability, pairs below ~0.5 almost never do, so few candidates get scored
+BANDS = 8
+ROWS = NUM_PERM // BANDS
+_PRIME = 4294967291  # largest prime below 2**32; keeps a * x + b inside uint64
+# Fixed seed: every worker has to hash the same way
+_rng = np.random.default_rng(0x5EED)
+_A = _rng.integers(1, _PRIME, NUM_PERM, dtype=np.uint64)[:, None]
+_B = _rng.integers(0, _PRIME, NUM_PERM, dtype=np.uint64)[:, None]
+
+PROJECTION = {"_id": 0, "id": 1, "title": 1, "description": 1, "type": 1, "status": 1,
+              "sellerId": 1, "bggId": 1, "bggIdSource": 1}
+
+
+def shingles(text: str) -> Set[str]:
+    if not text:
+        return set()
+    padded = f" {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def signature(grams: Set[str]) -> Optional[np.ndarray]:
+    if not grams:
+        return None
+    x = np.fromiter((zlib.crc32(g.encode()) % _PRIME for g in grams), dtype=np.uint64, count=len(grams))
+    return ((_A * x + _B) % _PRIME).min(axis=1).astype(np.uint32)
+
+
+class MinHashIndex:
+    def __init__(self):
+        self.signatures: Dict[str, np.ndarray] = {}
+        self.buckets: Dict[Tuple[int, bytes], Set[str]] = {}
+
+    def __len__(self):
+        return len(self.signatures)
+
+    def _bands(self, sig: np.ndarray):
+        for b in range(BANDS):
+            yield b, sig[b * ROWS:(b + 1) * ROWS].tobytes()
+
+    def add(self, key: str, sig: np.ndarray):
+        self.remove(key)
+        self.signatures[key] = sig
+        for band in self._bands(sig):
+            self.buckets.setdefault(band, set()).add(key)
+
+    def remove(self, key: str):
+        sig = self.signatures.pop(key, None)
+        if sig is None:
+            return
+        for band in self._bands(sig):
+            keys = self.buckets.get(band)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.buckets[band]
+
+    def similar(self, sig: np.ndarray, threshold: float) -> List[Tuple[str, float]]:
+        """Indexed keys whose estimated Jaccard similarity is at least `threshold`, best first."""
+        candidates = set()
+        for band in self._bands(sig):
+            candidates |= self.buckets.get(band, set())
+        if not candidates:
+            return []
+        keys = list(candidates)
+        similarity = (np.stack([self.signatures[k] for k in keys]) == sig).mean(axis=1)
+        order = np.argsort(-similarity)
+        return [(keys[i], float(similarity[i])) for i in order if similarity[i] >= threshold]
+
+
+# --- Reposts ---
+
+listing_index = MinHashIndex()
+# listing id -> (sellerId, type, indexed text)
+_meta: Dict[str, Tuple[str, str, str]] = {}
+
+
+def _listing_text(doc: dict) -> Tuple[str, bool]:
+    description = normalize_title(doc.get("description"))[:DESCRIPTION_CHARS]
+    return f"{title_key(doc.get('title'))} {description}".strip(), len(description) >= MIN_COPY_DESCRIPTION
+
+
+def _unindex_listing(listing_id: str):
+    listing_index.remove(listing_id)
+    _meta.pop(listing_id, None)
+
+
+def _index_listing(doc: dict, sig: Optional[np.ndarray] = None):
+    if doc.get("status", "active") != "active":
+        _unindex_listing(doc["id"])
+        return
+    text, _ = _listing_text(doc)
+    old = _meta.get(doc["id"])
+    if sig is None and old and old[2] == text:
+        # Bids and comments don't change the text
+        _meta[doc["id"]] = (doc.get("sellerId"), doc.get("type"), text)
+        return
+    sig = sig if sig is not None else signature(shingles(text))
+    if sig is None:
+        _unindex_listing(doc["id"])
+        return
+    listing_index.add(doc["id"], sig)
+    _meta[doc["id"]] = (doc.get("sellerId"), doc.get("type"), text)
+
+
+def check(doc: dict) -> Optional[dict]:
+    """The active listing that `doc` most likely duplicates, if any."""
+    text, substantial = _listing_text(doc)
+    sig = signature(shingles(text))
+    if sig is None:
+        return None
+    for other_id, similarity in listing_index.similar(sig, REPOST_SIMILARITY):
+        seller_id, listing_type, _ = _meta[other_id]
+        if other_id == doc.get("id") or listing_type != doc.get("type"):
+            continue
+        if seller_id == doc.get("sellerId"):
+            kind = "repost"
+        elif substantial:
+            kind = "copy"
+        else:
+            continue
+        return {"id": other_id, "sellerId": seller_id, "kind": kind, "similarity": round(similarity, 2)}
+    return None
+
+
+# --- BGG links ---
+
+title_index = MinHashIndex()
+_title_grams: Dict[str, Set[str]] = {}
+# title key -> bggId -> number of linked listings
+_evidence: Dict[str, Dict[str, int]] = {}
+# listing id -> the (title key, bggId) it counts towards
+_evidence_of: Dict[str, Tuple[str, str]] = {}
+
+
+def _count_evidence(listing_id: str, doc: Optional[dict]):
+    old = _evidence_of.pop(listing_id, None)
+    if old:
+        key, bgg_id = old
+        counts = _evidence[key]
+        counts[bgg_id] -= 1
+        if not counts[bgg_id]:
+            del counts[bgg_id]
+        if not counts:
+            del _evidence[key]
+            del _title_grams[key]
+            title_index.remove(key)
+    if not doc or not doc.get("bggId") or doc.get("bggIdSource") == "title":
+        return
+    key = title_key(doc.get("title"))
+    if not key:
+        return
+    bgg_id = str(doc["bggId"])
+    counts = _evidence.setdefault(key, {})
+    counts[bgg_id] = counts.get(bgg_id, 0) + 1
+    _evidence_of[listing_id] = (key, bgg_id)
+    if key not in _title_grams:
+        _title_grams[key] = shingles(key)
+        title_index.add(key, signature(_title_grams[key]))
+
+
+def _dominant(key: str) -> Optional[str]:
+    counts = _evidence.get(key)
+    if not counts:
+        return None
+    bgg_id, n = max(counts.items(), key=lambda kv: kv[1])
+    return bgg_id if n >= LINK_AGREEMENT * sum(counts.values()) else None
+
+
+def _numbers(key: str) -> List[str]:
+    return re.findall(r"\d+", key)
+
+
+def suggest_bgg_id(title: str) -> Optional[str]:
+    """The BGG id an unlinked title most likely means, or None when unsure."""
+    key = title_key(title)
+    if not key:
+        return None
+    exact = _dominant(key) or bgg_id_for_key(key)
+    if exact or key in _evidence:
+        return exact
+    grams = shingles(key)
+    best: Dict[str, float] = {}
+    # The LSH estimate is only used to find candidates; they're scored exactly
+    for other, _ in title_index.similar(signature(grams), LINK_SIMILARITY - 2 * LINK_MARGIN):
+        bgg_id = _dominant(other)
+        if not bgg_id or _numbers(other) != _numbers(key):
+            continue
+        other_grams = _title_grams[other]
+        jaccard = len(grams & other_grams) / len(grams | other_grams)
+        best[bgg_id] = max(best.get(bgg_id, 0.0), jaccard)
+    ranked = sorted(best.items(), key=lambda kv: -kv[1])
+    if not ranked or ranked[0][1] < LINK_SIMILARITY:
+        return None
+    if len(ranked) > 1 and ranked[0][1] - ranked[1][1] < LINK_MARGIN:
+        return None
+    return ranked[0][0]
+
+
+def annotate(doc: dict):
+    """Set normTitle, a title-derived bggId and duplicateOf on a listing about to be stored."""
+    doc["normTitle"] = title_key(doc.get("title"))
+    if not doc.get("bggId"):
+        bgg_id = suggest_bgg_id(doc.get("title"))
+        if bgg_id:
+            doc["bggId"] = bgg_id
+            doc["bggIdSource"] = "title"
+    duplicate = check(doc)
+    if duplicate:
+        doc["duplicateOf"] = duplicate
+
+
+# --- Loading and bulk linking ---
+
+_loaded = False
+# Changes seen while load() is reading; replayed on top of what it read
+_replay: Optional[list] = None
+
+
+def _on_change(listing_id: str, doc: Optional[dict]):
+    if _replay is not None:
+        _replay.append((listing_id, doc))
+    _count_evidence(listing_id, doc)
+    if doc is None:
+        _unindex_listing(listing_id)
+    else:
+        _index_listing(doc)
+
+
+feed_views.subscribe(_on_change)
+
+
+async def _load_batch(docs: List[dict]):
+    active = [d for d in docs if d.get("status", "active") == "active"]
+    # Hashing is the slow part; keep it off the event loop
+    sigs = await asyncio.to_thread(lambda: [signature(shingles(_listing_text(d)[0])) for d in active])
+    for d in docs:
+        _count_evidence(d["id"], d)
+    for d, sig in zip(active, sigs):
+        if sig is not None:
+            _index_listing(d, sig)
+
+
+async def load():
+    """Build both indexes from every listing."""
+    global _loaded, _replay
+    _replay = []
+    try:
+        batch = []
+        async for doc in data_access.collection("listings", "search").find({}, PROJECTION).batch_size(1000):
+            batch.append(doc)
+            if len(batch) >= 1000:
+                await _load_batch(batch)
+                batch = []
+        if batch:
+            await _load_batch(batch)
+    finally:
+        replay, _replay = _replay, None
+    for listing_id, doc in replay:
+        _on_change(listing_id, doc)
+    _loaded = True
+    logger.info(f"Duplicate index loaded ({len(listing_index)} active listings, {len(title_index)} linked titles)")
+
+
+async def link_unlabeled() -> Tuple[int, int]:
+    """Backfill normTitle and link unlinked listings by title. Returns (normalized, linked)."""
+    coll = data_access.collection("listings")
+    await coll.create_index("normTitle")
+    ops = []
+    linked_ids = []
+    normalized = 0
+    cursor = data_access.collection("listings", "search").find(
+        {}, {"_id": 0, "id": 1, "title": 1, "normTitle": 1, "bggId": 1}
+    ).batch_size(1000)
+    async for doc in cursor:
+        key = title_key(doc.get("title"))
+        if doc.get("normTitle") != key:
+            ops.append(UpdateOne({"id": doc["id"]}, {"$set": {"normTitle": key}}))
+            normalized += 1
+        if not doc.get("bggId"):
+            bgg_id = suggest_bgg_id(doc.get("title"))
+            if bgg_id:
+                # Unless someone linked it by hand in the meantime
+                ops.append(UpdateOne({"id": doc["id"], "bggId": {"$in": [None, ""]}},
+                                     {"$set": {"bggId": bgg_id, "bggIdSource": "title"}}))
+                linked_ids.append(doc["id"])
+        if len(ops) >= 1000:
+            await coll.bulk_write(ops, ordered=False)
+            ops = []
+    if ops:
+        await coll.bulk_write(ops, ordered=False)
+
+    for start in range(0, len(linked_ids), 1000):
+        docs = await data_access.find("listings", {"id": {"$in": linked_ids[start:start + 1000]}}, {"_id": 0})
+        await feed_views.refreshed(docs)
+    if linked_ids:
+        await http_cache.bump("listings")
+    return normalized, len(linked_ids)
+
+
+@jobs.job("link_unlabeled", concurrency=1, timeout=600)
+async def link_unlabeled_job(payload: dict):
+    if not _loaded:
+        # Links come from the title index; this process hasn't built it yet
+        await jobs.enqueue("link_unlabeled", {}, key="link_unlabeled", delay=30)
+        return
+    normalized, linked = await link_unlabeled()
+    logger.info(f"Title backfill: {normalized} normalized, {linked} linked to BGG")
+
+
+async def start():
+    try:
+        await load()
+        await jobs.enqueue("link_unlabeled", {}, key="link_unlabeled")
+    except Exception as e:
+        logger.error(f"Duplicate index startup failed: {e}")
+
+
+if __name__ == "__main__":
+    import resources
+    import titles
+
+    async def main():
+        await titles.load()
+        await load()
+        normalized, linked = await link_unlabeled()
+        print(f"{normalized} listings normalized, {linked} linked to BGG")
+        resources.mongo_client.close()
+
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
@@ -0,0 +1,320 @@
+"""
+Materialized views over listings, kept up to date on every write.
+
+- feed: the newest FEED_SIZE listings overall and per type, i.e. exactly what
+  GET /api/listings returns without a sellerId. Held in memory, so a feed
+  request no longer queries and sorts listings.
+- hot: the most-bid active listings (GET /api/listings/hot).
+- seller_summaries: a compact collection with each seller's listing counts
+  by status (GET /api/sellers/{id}/summary). Built for a seller on first
+  request, then kept with $inc on create/delete and recounted for that seller
+  when a listing's status changes.
+
+Write handlers pass the document they just wrote to added/updated/removed.
+The listing ids are broadcast on the "feed_views" channel and other workers
+re-read those listings, so every process converges on the same views. Other
+in-memory indexes over listings register with subscribe() to get the same
+stream of changes, local and remote.
+
+Each in-memory view keeps twice what it serves. Deletes eat into that
+buffer; once a view can no longer vouch for its top entries it is rebuilt
+from Mongo in the background, and the caller falls back to a query.
+"""
+
+import asyncio
+import bisect
+import logging
+import os
+import uuid
+from datetime import datetime, timezone
+from typing import Callable, Dict, Iterable, List, Optional
+
+import data_access
+from shared_state import state
+
+logger = logging.getLogger(__name__)
+
+TYPES = ("WTS", "WTB", "WTT", "WTL")
+ALL = "ALL"
+# Must match the limit GET /api/listings has always used
+FEED_SIZE = 100
+HOT_SIZE = int(os.environ.get("HOT_VIEW_SIZE", 20))
+CHANNEL = "feed_views"
+
+_instance = uuid.uuid4().hex
+
+
+def _created_key(doc: dict):
+    # Same order as Mongo's sort on a field holding a mix of strings and dates. Once the
+    # listings 1 migration is done (see migrations.py) every createdAt is an ISO string.
+    value = doc.get("createdAt")
+    if "listings" in data_access.migrated:
+        return (1, value) if isinstance(value, str) else (0, 0)
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return (2, value.timestamp())
+    if isinstance(value, str):
+        return (1, value)
+    return (0, 0)
+
+
+def _is_active(doc: dict) -> bool:
+    return doc.get("status", "active") == "active"
+
+
+class RankedView:
+    """Listing ids ranked by `key`, best last, holding up to twice `size`.
+
+    Invariant: the entries are exactly the top len(entries) listings that
+    match `accepts`. When the view was loaded with fewer than its capacity
+    (`complete`), it holds every matching listing.
+    """
+
+    def __init__(self, size: int, accepts: Callable[[dict], bool], key: Callable[[dict], tuple]):
+        self.size = size
+        self.capacity = size * 2
+        self.accepts = accepts
+        self.key = key
+        self.entries = []
+        self.keys: Dict[str, tuple] = {}
+        self.complete = False
+
+    def reset(self, docs: List[dict]):
+        self.entries = sorted((self.key(d), d["id"]) for d in docs)
+        self.keys = {i: k for k, i in self.entries}
+        self.complete = len(docs) < self.capacity
+
+    def discard(self, listing_id: str):
+        key = self.keys.pop(listing_id, None)
+        if key is not None:
+            i = bisect.bisect_left(self.entries, (key, listing_id))
+            del self.entries[i]
+
+    def upsert(self, doc: dict):
+        self.discard(doc["id"])
+        if not self.accepts(doc):
+            return
+        key = self.key(doc)
+        # Below our lowest entry we can't tell whether unseen listings rank higher
+        if not self.complete and (not self.entries or (key, doc["id"]) < self.entries[0]):
+            return
+        bisect.insort(self.entries, (key, doc["id"]))
+        self.keys[doc["id"]] = key
+        if len(self.entries) > self.capacity:
+            _, dropped = self.entries.pop(0)
+            del self.keys[dropped]
+            self.complete = False
+
+    @property
+    def ready(self) -> bool:
+        return self.complete or len(self.entries) >= self.size
+
+    def top(self) -> List[str]:
+        return [i for _, i in reversed(self.entries[-self.size:])]
+
+
+def _type_filter(listing_type: str):
+    return lambda d: d.get("type") == listing_type
+
+
+feeds: Dict[str, RankedView] = {t: RankedView(FEED_SIZE, _type_filter(t), _created_key) for t in TYPES}
+feeds[ALL] = RankedView(FEED_SIZE, lambda d: True, _created_key)
+hot = RankedView(HOT_SIZE, lambda d: _is_active(d) and (d.get("bidCount") or 0) > 0,
+                 lambda d: (d.get("bidCount") or 0, _created_key(d)))
+_views = list(feeds.values()) + [hot]
+_docs: Dict[str, dict] = {}
+_loaded = False
+_loading: Optional[asyncio.Task] = None
+# Writes seen while load() is querying; replayed on top of its results
+_replay: Optional[list] = None
+_listeners: List[Callable[[str, Optional[dict]], None]] = []
+
+
+def subscribe(listener: Callable[[str, Optional[dict]], None]):
+    """Call listener(listing_id, doc) on every listing change; doc is None once it's gone."""
+    _listeners.append(listener)
+
+
+def _notify(listing_id: str, doc: Optional[dict]):
+    for listener in _listeners:
+        try:
+            listener(listing_id, doc)
+        except Exception as e:
+            logger.error(f"Listing change listener failed: {e}")
+
+
+def _upsert_local(doc: dict):
+    doc = {k: v for k, v in doc.items() if k != "_id"}
+    if _replay is not None:
+        _replay.append(("upsert", doc))
+    for view in _views:
+        view.upsert(doc)
+    if any(doc["id"] in v.keys for v in _views):
+        _docs[doc["id"]] = doc
+    else:
+        _docs.pop(doc["id"], None)
+
+
+def _remove_local(listing_id: str):
+    if _replay is not None:
+        _replay.append(("remove", listing_id))
+    for view in _views:
+        view.discard(listing_id)
+    _docs.pop(listing_id, None)
+
+
+async def _query_view(query: dict, sort: tuple, capacity: int):
+    return await data_access.find("listings", query, {"_id": 0}, sort=sort, limit=capacity)
+
+
+async def load():
+    """Build every in-memory view from Mongo."""
+    global _loaded, _replay
+    _replay = []
+    try:
+        results = await asyncio.gather(
+            *(_query_view({"type": t}, ("createdAt", -1), feeds[t].capacity) for t in TYPES),
+            _query_view({}, ("createdAt", -1), feeds[ALL].capacity),
+            _query_view({"status": "active", "bidCount": {"$gt": 0}}, ("bidCount", -1), hot.capacity),
+        )
+    finally:
+        replay, _replay = _replay, None
+    _docs.clear()
+    for view, docs in zip([feeds[t] for t in TYPES] + [feeds[ALL], hot], results):
+        view.reset(docs)
+        for d in docs:
+            _docs[d["id"]] = d
+    for op, arg in replay:
+        if op == "upsert":
+            _upsert_local(arg)
+        else:
+            _remove_local(arg)
+    _loaded = True
+    logger.info(f"Feed views loaded ({len(_docs)} listings)")
+
+
+def _reload_in_background():
+    global _loading
+    if _loading is None or _loading.done():
+        _loading = asyncio.get_running_loop().create_task(load())
+
+
+def _serve(view: RankedView) -> Optional[List[dict]]:
+    if not _loaded:
+        return None
+    if not view.ready:
+        _reload_in_background()
+        return None
+    # Shallow copies: callers add seller fields to what they return
+    return [dict(_docs[i]) for i in view.top()]
+
+
+def feed(listing_type: Optional[str] = None) -> Optional[List[dict]]:
+    """The feed for a type (or all), newest first; None means query Mongo instead."""
+    view = feeds.get(listing_type or ALL)
+    return _serve(view) if view else None
+
+
+def hottest() -> Optional[List[dict]]:
+    return _serve(hot)
+
+
+async def _broadcast(ids: List[str]):
+    try:
+        await state.publish(CHANNEL, {"origin": _instance, "ids": ids})
+    except Exception as e:
+        logger.warning(f"Feed view broadcast failed: {e}")
+
+
+async def _on_change(message: dict):
+    if message.get("origin") == _instance or not (_loaded or _listeners):
+        return
+    ids = message.get("ids") or []
+    docs = await data_access.find("listings", {"id": {"$in": ids}}, {"_id": 0})
+    found = {d["id"]: d for d in docs}
+    for listing_id in ids:
+        doc = found.get(listing_id)
+        if _loaded:
+            if doc:
+                _upsert_local(doc)
+            else:
+                _remove_local(listing_id)
+        _notify(listing_id, doc)
+
+
+state.subscribe(CHANNEL, _on_change)
+
+
+# --- Seller summaries ---
+
+async def _recount_seller(seller_id: str) -> dict:
+    rows = await data_access.collection("listings").aggregate([
+        {"$match": {"sellerId": seller_id}},
+        {"$group": {"_id": "$status", "n": {"$sum": 1}}},
+    ]).to_list(length=None)
+    counts = {str(r["_id"] or "active"): r["n"] for r in rows}
+    summary = {
+        "sellerId": seller_id,
+        "counts": counts,
+        "total": sum(counts.values()),
+        "updatedAt": datetime.now(timezone.utc).isoformat(),
+    }
+    await data_access.collection("seller_summaries").replace_one({"sellerId": seller_id}, summary, upsert=True)
+    return summary
+
+
+async def _bump_seller(seller_id: str, status: str, delta: int):
+    # Only sellers whose summary exists are kept incrementally; the rest are counted on first read
+    await data_access.update_one("seller_summaries", {"sellerId": seller_id}, {
+        "$inc": {f"counts.{status}": delta, "total": delta},
+        "$set": {"updatedAt": datetime.now(timezone.utc).isoformat()},
+    })
+
+
+async def seller_summary(seller_id: str) -> dict:
+    summary = await data_access.find_one("seller_summaries", {"sellerId": seller_id}, {"_id": 0})
+    return summary or await _recount_seller(seller_id)
+
+
+# --- Write hooks ---
+
+async def added(docs: Iterable[dict]):
+    docs = list(docs)
+    for d in docs:
+        _upsert_local(d)
+        _notify(d["id"], d)
+    await _broadcast([d["id"] for d in docs])
+    per_seller = {}
+    for d in docs:
+        if d.get("sellerId"):
+            key = (d["sellerId"], d.get("status") or "active")
+            per_seller[key] = per_seller.get(key, 0) + 1
+    for (seller_id, status), n in per_seller.items():
+        await _bump_seller(seller_id, status, n)
+
+
+async def updated(doc: dict, status_changed: bool = False):
+    _upsert_local(doc)
+    _notify(doc["id"], doc)
+    await _broadcast([doc["id"]])
+    if status_changed and doc.get("sellerId"):
+        await _recount_seller(doc["sellerId"])
+
+
+async def refreshed(docs: Iterable[dict]):
+    """Listings changed by a background job: views and listeners only, statuses untouched."""
+    docs = list(docs)
+    for d in docs:
+        _upsert_local(d)
+        _notify(d["id"], d)
+    if docs:
+        await _broadcast([d["id"] for d in docs])
+
+
+async def removed(doc: dict):
+    _remove_local(doc["id"])
+    _notify(doc["id"], None)
+    await _broadcast([doc["id"]])
+    if doc.get("sellerId"):
+        await _bump_seller(doc["sellerId"], doc.get("status") or "active", -1)
@@ -0,0 +1,219 @@
+"""
+Response cache for public GET routes.
+
+Each cached route declares which collections its response depends on. Write
+handlers call bump("listings") etc., which advances that collection's version
+counter and drops every cached response that depends on it. ETags are weak and
+built from those version counters, so a polling client gets a 304 without the
+route ever touching Mongo until something it depends on is written.
+
+Version counters live in shared_state and bumps are broadcast on the
+"http_cache" channel, so with a shared backend every worker sees a write and
+drops its stale entries.
+"""
+
+import logging
+import os
+import time
+import uuid
+import zlib
+from typing import Dict, Tuple
+
+import metrics
+from shared_state import state
+
+logger = logging.getLogger(__name__)
+
+# path -> (collections the response depends on, ttl in seconds)
+CACHED_ROUTES: Dict[str, Tuple[Tuple[str, ...], float]] = {
+    "/api/": ((), 300),
+    "/api/listings": (("listings", "users"), float(os.environ.get("RESPONSE_CACHE_TTL", 10))),
+    "/api/listings/hot": (("listings", "users"), float(os.environ.get("RESPONSE_CACHE_TTL", 10))),
+    "/api/bgg/search": ((), float(os.environ.get("BGG_RESPONSE_CACHE_TTL", 300))),
+}
+RESPONSE_CACHE_MAX = int(os.environ.get("RESPONSE_CACHE_MAX", 500))
+INVALIDATE_CHANNEL = "http_cache"
+
+# Changes when the shared state is reset so clients never revalidate against old counters
+_epoch = uuid.uuid4().hex[:8]
+_versions: Dict[str, int] = {}
+_entries: Dict[str, dict] = {}
+_keys_by_collection: Dict[str, set] = {}
+
+
+def _apply_version(name: str, version: int):
+    if version > _versions.get(name, 0):
+        _versions[name] = version
+    for key in _keys_by_collection.pop(name, ()):
+        _entries.pop(key, None)
+
+
+def _on_invalidate(message: dict):
+    for name, version in message.get("collections", {}).items():
+        _apply_version(name, version)
+
+
+state.subscribe(INVALIDATE_CHANNEL, _on_invalidate)
+
+
+async def bump(*collections: str):
+    """Mark collections as written: new ETags, and drop dependent cached responses everywhere."""
+    new_versions = {}
+    for name in collections:
+        try:
+            new_versions[name] = await state.incr(f"http_cache:version:{name}")
+        except Exception as e:
+            # Shared backend down: still invalidate locally rather than fail the write
+            logger.warning(f"Response cache version bump failed for {name}: {e}")
+            new_versions[name] = _versions.get(name, 0) + 1
+        _apply_version(name, new_versions[name])
+    try:
+        await state.publish(INVALIDATE_CHANNEL, {"collections": new_versions})
+    except Exception as e:
+        logger.warning(f"Response cache invalidation broadcast failed: {e}")
+
+
+async def start():
+    """Load the shared epoch and version counters so all workers emit the same ETags."""
+    global _epoch
+    epoch = await state.get("http_cache:epoch")
+    if not epoch:
+        await state.set("http_cache:epoch", _epoch)
+        epoch = _epoch
+    _epoch = epoch
+    for deps, _ in CACHED_ROUTES.values():
+        for name in deps:
+            _versions[name] = int(await state.get(f"http_cache:version:{name}") or 0)
+
+
+def version_tag(deps: Tuple[str, ...]) -> str:
+    return ".".join(str(_versions.get(d, 0)) for d in deps)
+
+
+def make_etag(key: str, deps: Tuple[str, ...], body: bytes = b"") -> str:
+    # Routes without collection deps (BGG proxy) fall back to hashing the body
+    if deps:
+        return f'W/"{_epoch}-{zlib.crc32(key.encode()):x}-{version_tag(deps)}"'
+    return f'W/"{_epoch}-{zlib.crc32(body):x}"'
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    tags = [t.strip() for t in if_none_match.split(",")]
+    bare = etag[2:] if etag.startswith("W/") else etag
+    return any((t[2:] if t.startswith("W/") else t) == bare for t in tags)
+
+
+def _store(key: str, deps: Tuple[str, ...], ttl: float, entry: dict):
+    if len(_entries) >= RESPONSE_CACHE_MAX:
+        _entries.pop(next(iter(_entries)))
+    entry["expires"] = time.monotonic() + ttl
+    entry["versions"] = version_tag(deps)
+    _entries[key] = entry
+    for d in deps:
+        _keys_by_collection.setdefault(d, set()).add(key)
+
+
+def _lookup(key: str, deps: Tuple[str, ...]):
+    entry = _entries.get(key)
+    if not entry:
+        return None
+    if entry["expires"] < time.monotonic() or entry["versions"] != version_tag(deps):
+        _entries.pop(key, None)
+        return None
+    return entry
+
+
+def clear():
+    _entries.clear()
+    _keys_by_collection.clear()
+
+
+class ResponseCacheMiddleware:
+    """ASGI middleware serving CACHED_ROUTES from memory with ETag / 304 support."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "GET":
+            return await self.app(scope, receive, send)
+        route = CACHED_ROUTES.get(scope["path"])
+        if route is None:
+            return await self.app(scope, receive, send)
+
+        deps, ttl = route
+        query = scope.get("query_string", b"").decode("latin-1")
+        key = f"{scope['path']}?{'&'.join(sorted(query.split('&')))}" if query else scope["path"]
+
+        if_none_match = ""
+        for name, value in scope.get("headers", []):
+            if name == b"if-none-match":
+                if_none_match = value.decode("latin-1")
+                break
+
+        # Version-based ETags can be answered before doing any work
+        if deps and etag_matches(if_none_match, make_etag(key, deps)):
+            metrics.cache_result("http_response", True)
+            return await self._send_not_modified(send, make_etag(key, deps))
+
+        entry = _lookup(key, deps)
+        metrics.cache_result("http_response", entry is not None)
+        if entry is not None:
+            if etag_matches(if_none_match, entry["etag"]):
+                return await self._send_not_modified(send, entry["etag"])
+            return await self._send_entry(send, entry, b"HIT")
+
+        # Miss: run the route and capture the response
+        versions_before = version_tag(deps)
+        start = {}
+        chunks = []
+
+        async def capture(message):
+            if message["type"] == "http.response.start":
+                start.update(message)
+            elif message["type"] == "http.response.body":
+                chunks.append(message.get("body", b""))
+
+        await self.app(scope, receive, capture)
+
+        body = b"".join(chunks)
+        headers = [(k, v) for k, v in start.get("headers", []) if k.lower() not in (b"etag", b"content-length")]
+        # A response that raced with a write may predate it: don't cache it or tag it
+        raced = version_tag(deps) != versions_before
+        entry = {
+            "status": start.get("status", 200),
+            "headers": headers,
+            "body": body,
+            "etag": None if raced else make_etag(key, deps, body),
+        }
+        if entry["status"] == 200 and not raced:
+            _store(key, deps, ttl, entry)
+
+        if entry["status"] == 200 and entry["etag"] and etag_matches(if_none_match, entry["etag"]):
+            return await self._send_not_modified(send, entry["etag"])
+        return await self._send_entry(send, entry, b"MISS")
+
+    async def _send_entry(self, send, entry, cache_status: bytes):
+        headers = list(entry["headers"])
+        headers.append((b"content-length", str(len(entry["body"])).encode()))
+        if entry["status"] == 200 and entry["etag"]:
+            headers.append((b"etag", entry["etag"].encode()))
+            headers.append((b"cache-control", b"public, max-age=0, must-revalidate"))
+        headers.append((b"x-cache", cache_status))
+        await send({"type": "http.response.start", "status": entry["status"], "headers": headers})
+        await send({"type": "http.response.body", "body": entry["body"]})
+
+    async def _send_not_modified(self, send, etag: str):
+        await send({
+            "type": "http.response.start",
+            "status": 304,
+            "headers": [
+                (b"etag", etag.encode()),
+                (b"cache-control", b"public, max-age=0, must-revalidate"),
+            ],
+        })
+        await send({"type": "http.response.body", "body": b""})
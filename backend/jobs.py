@@ -0,0 +1,284 @@
+"""
+Background jobs persisted in the `jobs` collection.
+
+enqueue(type, payload) stores a job; a Runner in any process (the API
+process, or `python backend/worker.py`) picks it up:
+
+- Claim: one find_one_and_update moves a due job to "running" and stamps it
+  with the runner's id and lockedUntil = now + the type's timeout. That
+  update is atomic, so exactly one runner gets each job.
+- Visibility timeout: a running job whose lockedUntil has passed (its runner
+  died or hung) is due again and will be claimed by someone else. Handlers
+  are cut off at the same timeout, so a live runner never outlasts its lock.
+- Retries: a failed attempt is re-queued with exponential backoff plus
+  jitter, up to the type's max_attempts, after which it stays "failed" with
+  the last error for inspection.
+- Concurrency: each runner runs at most `concurrency` jobs of a type at once.
+
+Handlers are registered with @job("type") next to the code they run, and
+get the payload dict. They must be idempotent: a job can run more than once
+if a runner dies after finishing but before recording it. Finished jobs are
+removed after JOB_RETENTION_SECONDS by a TTL index.
+
+Keyed jobs (enqueue(..., key=...)) run one at a time per key: a unique
+partial index allows one queued job per key, a second enqueue is absorbed
+by it, and an enqueue while a job with that key is running is dropped,
+unless it comes from that job itself (how slices queue their next one).
+
+Enqueueing wakes the local runner and publishes on the "jobs" channel, so
+runners elsewhere don't wait for their next poll.
+"""
+
+import asyncio
+import logging
+import os
+import random
+import time
+import uuid
+from contextvars import ContextVar
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Dict, NamedTuple, Optional
+
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+import data_access
+import deadlines
+import metrics
+from shared_state import state
+
+logger = logging.getLogger(__name__)
+
+JOBS_IN_APP = os.environ.get("JOBS_IN_APP", "true").lower() == "true"
+JOB_POLL_INTERVAL = float(os.environ.get("JOB_POLL_INTERVAL", 2.0))
+JOB_BACKOFF_BASE = float(os.environ.get("JOB_BACKOFF_BASE", 5.0))
+JOB_BACKOFF_MAX = float(os.environ.get("JOB_BACKOFF_MAX", 15 * 60))
+JOB_RETENTION_SECONDS = int(os.environ.get("JOB_RETENTION_SECONDS", 7 * 24 * 60 * 60))
+# How long stop() lets running jobs finish before handing them back
+JOB_SHUTDOWN_GRACE = float(os.environ.get("JOB_SHUTDOWN_GRACE", 10.0))
+CHANNEL = "jobs"
+
+
+class JobType(NamedTuple):
+    handler: Callable[[dict], Awaitable]
+    concurrency: int
+    max_attempts: int
+    timeout: float
+
+
+_types: Dict[str, JobType] = {}
+# Id of the job whose handler is running in this context
+_current_job: ContextVar[Optional[str]] = ContextVar("current_job", default=None)
+_indexes_created = False
+
+
+def job(name: str, concurrency: int = 2, max_attempts: int = 5, timeout: float = 60):
+    """Register the decorated coroutine as the handler for jobs of type `name`."""
+    def register(handler):
+        _types[name] = JobType(handler, concurrency, max_attempts, timeout)
+        return handler
+    return register
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+async def _create_indexes():
+    global _indexes_created
+    if _indexes_created:
+        return
+    coll = data_access.collection("jobs")
+    await coll.create_index([("type", ASCENDING), ("status", ASCENDING), ("runAt", ASCENDING)])
+    await coll.create_index("finishedAt", expireAfterSeconds=JOB_RETENTION_SECONDS)
+    # At most one queued job per key, even when several processes enqueue at once
+    await coll.create_index("key", unique=True, partialFilterExpression={"status": "queued"})
+    _indexes_created = True
+
+
+async def enqueue(name: str, payload: dict, key: Optional[str] = None, delay: float = 0):
+    """Queue a job. With `key`, a job with that key still waiting to run absorbs this one,
+    and one running elsewhere (not the caller) means this one is dropped."""
+    now = _now()
+    doc = {
+        "id": str(uuid.uuid4()),
+        "type": name,
+        "payload": payload,
+        "status": "queued",
+        "attempts": 0,
+        "runAt": now + timedelta(seconds=delay),
+        "createdAt": now,
+    }
+    if key:
+        doc["key"] = key
+        await _create_indexes()
+        coll = data_access.collection("jobs")
+        running = await coll.find_one(
+            {"key": key, "status": "running", "lockedUntil": {"$gt": now}, "id": {"$ne": _current_job.get()}},
+            {"_id": 1},
+        )
+        if running is not None:
+            return
+        try:
+            await coll.update_one({"key": key, "status": "queued"}, {"$setOnInsert": doc}, upsert=True)
+        except DuplicateKeyError:
+            # Another process queued it between our lookup and insert
+            return
+    else:
+        await data_access.insert_one("jobs", doc)
+    if runner is not None:
+        runner.wake()
+    try:
+        await state.publish(CHANNEL, {"type": name})
+    except Exception as e:
+        logger.warning(f"Job wake-up broadcast failed: {e}")
+
+
+def _backoff(attempts: int) -> float:
+    delay = min(JOB_BACKOFF_MAX, JOB_BACKOFF_BASE * 2 ** (attempts - 1))
+    return delay * random.uniform(0.5, 1.0)
+
+
+class Runner:
+    def __init__(self):
+        self.id = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.running: Dict[str, int] = {}
+        self._tasks = set()
+        self._wake = asyncio.Event()
+        self._loop_task: Optional[asyncio.Task] = None
+        self._stopping = False
+
+    def wake(self):
+        self._wake.set()
+
+    async def start(self):
+        await _create_indexes()
+        self._loop_task = asyncio.get_running_loop().create_task(self._run())
+        logger.info(f"Job runner {self.id} started for {sorted(_types)}")
+
+    async def stop(self):
+        self._stopping = True
+        self.wake()
+        if self._loop_task:
+            await self._loop_task
+        if self._tasks:
+            _, pending = await asyncio.wait(set(self._tasks), timeout=JOB_SHUTDOWN_GRACE)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        # Whatever didn't finish goes back to the queue without using up an attempt
+        await data_access.collection("jobs").update_many(
+            {"lockedBy": self.id, "status": "running"},
+            {"$set": {"status": "queued", "runAt": _now()}, "$unset": {"lockedBy": "", "lockedUntil": ""},
+             "$inc": {"attempts": -1}},
+        )
+
+    async def _claim(self, name: str, spec: JobType) -> Optional[dict]:
+        now = _now()
+        # The document as it was before the claim; the claim's own changes are applied below
+        doc = await data_access.collection("jobs").find_one_and_update(
+            {"type": name, "$or": [
+                {"status": "queued", "runAt": {"$lte": now}},
+                {"status": "running", "lockedUntil": {"$lte": now}},
+            ]},
+            {"$set": {"status": "running", "lockedBy": self.id, "lockedUntil": now + timedelta(seconds=spec.timeout),
+                      "startedAt": now},
+             "$inc": {"attempts": 1}},
+            projection={"_id": 0, "id": 1, "type": 1, "payload": 1, "attempts": 1},
+            sort=[("runAt", ASCENDING)],
+            return_document=ReturnDocument.BEFORE,
+        )
+        if doc is not None:
+            doc["attempts"] = doc.get("attempts", 0) + 1
+        return doc
+
+    async def _run(self):
+        while not self._stopping:
+            self._wake.clear()
+            claimed = False
+            for name, spec in list(_types.items()):
+                while self.running.get(name, 0) < spec.concurrency and not self._stopping:
+                    try:
+                        doc = await self._claim(name, spec)
+                    except Exception as e:
+                        logger.error(f"Claiming {name} job failed: {e}")
+                        doc = None
+                    if doc is None:
+                        break
+                    claimed = True
+                    self.running[name] = self.running.get(name, 0) + 1
+                    metrics.JOBS_RUNNING.labels(name).inc()
+                    task = asyncio.get_running_loop().create_task(self._execute(doc, spec))
+                    self._tasks.add(task)
+                    task.add_done_callback(self._tasks.discard)
+            if not claimed:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), JOB_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _finish(self, doc: dict, update: dict):
+        # Only if we still hold it: after our lock expired the job may belong to someone else
+        try:
+            await data_access.update_one("jobs", {"id": doc["id"], "lockedBy": self.id, "status": "running"}, update)
+        except Exception as e:
+            logger.error(f"Recording {doc['type']} job {doc['id']} failed: {e}")
+
+    async def _execute(self, doc: dict, spec: JobType):
+        name = doc["type"]
+        start = time.perf_counter()
+        _current_job.set(doc["id"])
+        try:
+            # Outbound calls in the handler share the job's timeout as their deadline
+            with deadlines.budget(spec.timeout):
+                await asyncio.wait_for(spec.handler(doc.get("payload") or {}), spec.timeout)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            if doc["attempts"] >= spec.max_attempts:
+                logger.error(f"Job {name} {doc['id']} failed for good after {doc['attempts']} attempts: {error}")
+                metrics.JOBS.labels(name, "failed").inc()
+                await self._finish(doc, {"$set": {"status": "failed", "lastError": error, "failedAt": _now()},
+                                         "$unset": {"lockedBy": "", "lockedUntil": ""}})
+            else:
+                delay = _backoff(doc["attempts"])
+                logger.warning(f"Job {name} {doc['id']} attempt {doc['attempts']} failed, retrying in {delay:.0f}s: {error}")
+                metrics.JOBS.labels(name, "retry").inc()
+                await self._finish(doc, {"$set": {"status": "queued", "lastError": error,
+                                                  "runAt": _now() + timedelta(seconds=delay)},
+                                         "$unset": {"lockedBy": "", "lockedUntil": ""}})
+        else:
+            metrics.JOBS.labels(name, "done").inc()
+            await self._finish(doc, {"$set": {"status": "done", "finishedAt": _now()},
+                                     "$unset": {"lockedBy": "", "lockedUntil": ""}})
+        finally:
+            metrics.JOB_LATENCY.labels(name).observe(time.perf_counter() - start)
+            self.running[name] -= 1
+            metrics.JOBS_RUNNING.labels(name).dec()
+            self.wake()
+
+
+runner: Optional[Runner] = None
+
+
+def _on_enqueued(message: dict):
+    if runner is not None:
+        runner.wake()
+
+
+state.subscribe(CHANNEL, _on_enqueued)
+
+
+async def start():
+    global runner
+    if runner is None:
+        runner = Runner()
+        await runner.start()
+
+
+async def stop():
+    global runner
+    if runner is not None:
+        await runner.stop()
+        runner = None
@@ -0,0 +1,267 @@
+"""
+Market value per BGG id, from what listings actually sold for.
+
+Each bggId has one market_stats document holding the last MARKET_SAMPLE_SIZE
+sales (price, condition, listing id, when) and statistics computed from them:
+count, mean, min/max, p10/p25/median/p75/p90, and count/median/quartiles per
+condition band. It is served at GET /api/bgg/{id}/market. Links guessed from
+the title (bggIdSource "title", see duplicates.py) are never counted as sales
+of that game.
+
+Incremental: when a listing's status changes, or its price, condition or
+bggId while it is sold, the "market_sale" job (see jobs.py) pushes its sale
+onto the window if it is now sold, or pulls it out if it isn't, and
+recomputes the stats for that one bggId with NumPy. A sale moves out of the
+old bggId's window when the bggId changes, and out of its window when a
+sold listing is deleted.
+A `version` counter guards the stats write, so a slower concurrent update
+can't overwrite newer stats.
+
+Batch: recompute_all() rebuilds every document from the sold listings in
+one pass with pandas (vectorized group-by quantiles). It runs on startup
+when the collection is empty, and can be run by hand:
+
+    python backend/market.py
+"""
+
+import asyncio
+import logging
+import os
+from datetime import datetime, timezone
+from typing import List, Optional
+
+import numpy as np
+import pandas as pd
+from pymongo import ReplaceOne
+
+import data_access
+import jobs
+
+logger = logging.getLogger(__name__)
+
+MARKET_SAMPLE_SIZE = int(os.environ.get("MARKET_SAMPLE_SIZE", 500))
+QUANTILES = (10, 25, 50, 75, 90)
+# Condition is rated 1-10; a band covers [lower edge, next edge)
+BAND_EDGES = (6.0, 8.0, 9.0)
+BANDS = ("fair", "good", "veryGood", "likeNew")
+
+
+def _round(x) -> float:
+    return round(float(x), 2)
+
+
+def _band_stats(prices: np.ndarray) -> dict:
+    p25, p50, p75 = np.percentile(prices, (25, 50, 75))
+    return {"count": int(len(prices)), "median": _round(p50), "p25": _round(p25), "p75": _round(p75)}
+
+
+def compute_stats(sales: List[dict]) -> dict:
+    """Statistics over a window of sales ({price, condition, ...})."""
+    prices = np.array([s["price"] for s in sales], dtype=float)
+    if not len(prices):
+        return {"count": 0}
+    p10, p25, p50, p75, p90 = np.percentile(prices, QUANTILES)
+    stats = {
+        "count": int(len(prices)),
+        "mean": _round(prices.mean()),
+        "min": _round(prices.min()),
+        "max": _round(prices.max()),
+        "p10": _round(p10),
+        "p25": _round(p25),
+        "median": _round(p50),
+        "p75": _round(p75),
+        "p90": _round(p90),
+        "byCondition": {},
+    }
+    conditions = np.array([s.get("condition") if s.get("condition") is not None else np.nan for s in sales], dtype=float)
+    known = ~np.isnan(conditions)
+    bands = np.digitize(conditions, BAND_EDGES)
+    for i, name in enumerate(BANDS):
+        in_band = prices[known & (bands == i)]
+        if len(in_band):
+            stats["byCondition"][name] = _band_stats(in_band)
+    return stats
+
+
+def _sale(listing: dict) -> Optional[dict]:
+    price = listing.get("price")
+    if not listing.get("bggId") or listing.get("bggIdSource") == "title":
+        return None
+    if not isinstance(price, (int, float)) or price <= 0:
+        return None
+    at = listing.get("updatedAt") or listing.get("createdAt")
+    return {
+        "listingId": listing["id"],
+        "price": float(price),
+        "condition": listing.get("condition"),
+        "at": at.isoformat() if isinstance(at, datetime) else at,
+    }
+
+
+async def _store_stats(doc: Optional[dict]):
+    if not doc:
+        return
+    # Only the writer that saw the latest version gets to set the stats
+    await data_access.update_one(
+        "market_stats",
+        {"bggId": doc["bggId"], "version": doc["version"]},
+        {"$set": {"stats": compute_stats(doc.get("sales", [])), "updatedAt": datetime.now(timezone.utc).isoformat()}},
+    )
+
+
+async def record_sale(listing: dict):
+    """Add a sold listing to its bggId's window and refresh the stats."""
+    sale = _sale(listing)
+    if sale is None:
+        return
+    # Pull first so re-marking a listing as sold doesn't count it twice
+    await data_access.update_one("market_stats", {"bggId": listing["bggId"]},
+                                 {"$pull": {"sales": {"listingId": sale["listingId"]}}})
+    doc = await data_access.find_one_and_update(
+        "market_stats",
+        {"bggId": listing["bggId"]},
+        {"$push": {"sales": {"$each": [sale], "$slice": -MARKET_SAMPLE_SIZE}}, "$inc": {"version": 1}},
+        {"_id": 0},
+        upsert=True,
+    )
+    await _store_stats(doc)
+
+
+async def remove_sale(listing: dict):
+    """Take a listing back out of its bggId's window (marked unsold, moved to another game, or deleted)."""
+    if not listing.get("bggId"):
+        return
+    doc = await data_access.find_one_and_update(
+        "market_stats",
+        {"bggId": listing["bggId"]},
+        {"$pull": {"sales": {"listingId": listing["id"]}}, "$inc": {"version": 1}},
+        {"_id": 0},
+    )
+    await _store_stats(doc)
+
+
+@jobs.job("market_sale")
+async def sale_job(payload: dict):
+    """Payload {id, previousBggId?}: bring the windows in line with the listing as it is now."""
+    listing = await data_access.find_one(
+        "listings", {"id": payload["id"]},
+        {"_id": 0, "id": 1, "bggId": 1, "bggIdSource": 1, "price": 1, "condition": 1, "status": 1,
+         "updatedAt": 1, "createdAt": 1},
+    )
+    if listing is None:
+        return
+    previous = payload.get("previousBggId")
+    if previous and previous != listing.get("bggId"):
+        await remove_sale({"id": listing["id"], "bggId": previous})
+    if listing.get("status") == "sold" and _sale(listing):
+        await record_sale(listing)
+    else:
+        await remove_sale(listing)
+
+
+async def market_value(bgg_id: str) -> dict:
+    doc = await data_access.find_one("market_stats", {"bggId": bgg_id}, {"_id": 0})
+    if not doc or not doc.get("stats"):
+        return {"bggId": bgg_id, "count": 0}
+    return {
+        "bggId": bgg_id,
+        **doc["stats"],
+        "recentSales": [
+            {"price": s["price"], "condition": s.get("condition"), "at": s.get("at")}
+            for s in reversed(doc.get("sales", [])[-10:])
+        ],
+        "updatedAt": doc.get("updatedAt"),
+    }
+
+
+def _frame_stats(df: pd.DataFrame) -> dict:
+    """bggId -> stats for every group in df, computed column-wise."""
+    grouped = df.groupby("bggId")["price"]
+    agg = grouped.agg(["count", "mean", "min", "max"])
+    quantiles = grouped.quantile([q / 100 for q in QUANTILES]).unstack()
+    quantiles.columns = ["p10", "p25", "median", "p75", "p90"]
+    table = agg.join(quantiles).round(2)
+
+    banded = df.dropna(subset=["condition"]).copy()
+    banded["band"] = pd.cut(banded["condition"], bins=(-np.inf, *BAND_EDGES, np.inf), labels=BANDS, right=False)
+    band_grouped = banded.groupby(["bggId", "band"], observed=True)["price"]
+    band_table = band_grouped.count().to_frame("count").join(
+        band_grouped.quantile([0.25, 0.5, 0.75]).unstack().set_axis(["p25", "median", "p75"], axis=1)
+    ).round(2)
+
+    stats = {}
+    for bgg_id, row in table.iterrows():
+        stats[bgg_id] = {
+            "count": int(row["count"]),
+            **{k: float(row[k]) for k in ("mean", "min", "max", "p10", "p25", "median", "p75", "p90")},
+            "byCondition": {},
+        }
+    for (bgg_id, band), row in band_table.iterrows():
+        stats[bgg_id]["byCondition"][band] = {
+            "count": int(row["count"]), "median": float(row["median"]), "p25": float(row["p25"]), "p75": float(row["p75"]),
+        }
+    return stats
+
+
+async def recompute_all() -> int:
+    """Rebuild market_stats from every sold listing. Returns the number of bggIds written."""
+    rows = await data_access.find(
+        "listings",
+        {"status": "sold", "bggId": {"$nin": [None, ""]}, "bggIdSource": {"$ne": "title"}, "price": {"$gt": 0}},
+        {"_id": 0, "id": 1, "bggId": 1, "price": 1, "condition": 1, "updatedAt": 1, "createdAt": 1},
+        tier="search",
+    )
+    coll = data_access.collection("market_stats")
+    if not rows:
+        await coll.delete_many({})
+        return 0
+
+    records = []
+    for r in rows:
+        sale = _sale(r)
+        if sale:
+            records.append({**sale, "bggId": r["bggId"]})
+    df = pd.DataFrame(records)
+    df["condition"] = pd.to_numeric(df["condition"], errors="coerce")
+    df["sortAt"] = pd.to_datetime(df["at"], utc=True, errors="coerce", format="mixed")
+    # Same window the incremental path keeps: the latest MARKET_SAMPLE_SIZE sales per game
+    df = df.sort_values("sortAt", na_position="first").groupby("bggId").tail(MARKET_SAMPLE_SIZE)
+
+    stats = _frame_stats(df)
+    now = datetime.now(timezone.utc).isoformat()
+    ops = []
+    for bgg_id, group in df.groupby("bggId"):
+        sales = [
+            {"listingId": lid, "price": price, "condition": None if pd.isna(cond) else cond, "at": at}
+            for lid, price, cond, at in zip(group["listingId"], group["price"], group["condition"], group["at"])
+        ]
+        ops.append(ReplaceOne(
+            {"bggId": bgg_id},
+            {"bggId": bgg_id, "sales": sales, "stats": stats[bgg_id], "version": 0, "updatedAt": now},
+            upsert=True,
+        ))
+    for start in range(0, len(ops), 1000):
+        await coll.bulk_write(ops[start:start + 1000], ordered=False)
+    await coll.delete_many({"bggId": {"$nin": list(stats)}})
+    return len(ops)
+
+
+async def ensure_built():
+    """Initial batch build on a fresh deployment."""
+    try:
+        if await data_access.find_one("market_stats", {}, {"_id": 1}) is None:
+            count = await recompute_all()
+            logger.info(f"Market stats built for {count} games")
+    except Exception as e:
+        logger.error(f"Market stats build failed: {e}")
+
+
+if __name__ == "__main__":
+    import resources
+
+    async def main():
+        print(f"Market stats rebuilt for {await recompute_all()} games")
+        resources.mongo_client.close()
+
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
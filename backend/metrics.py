@@ -0,0 +1,328 @@
+"""
+Prometheus metrics, exposed on GET /metrics.
+
+- http_request_duration_seconds / http_requests_in_flight, per route template
+- mongo_command_duration_seconds, fed by a pymongo CommandListener on the Motor client
+- upstream_request_duration_seconds, for outbound BGG and LLM calls
+- cache_requests_total{cache, result}, for hit ratios of the various caches
+- event_loop_lag_seconds, sampled by a background task
+- mongo_tier_duration_seconds, per read tier from data_access.py
+- mongo_pool_* / http_pool_*, connection pool usage against the configured limits
+- jobs_total / job_duration_seconds / jobs_running, for the background job runner (jobs.py)
+- deadline_exceeded_total{upstream}, outbound calls cut off by a request deadline (deadlines.py)
+
+Every process keeps its own metrics, so with several uvicorn workers a
+scrape would only see whichever worker answered it. For multi-worker
+deployments, set PROMETHEUS_MULTIPROC_DIR to a directory every worker (and
+`worker.py`) can write to. Empty it before the processes start. Each
+process then writes its samples there, and /metrics aggregates all of
+them. Gauges are summed over live processes, and a process drops its own
+gauges on shutdown. Without the variable, metrics are per process, which
+is only right for a single worker.
+"""
+
+import asyncio
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+from prometheus_client import multiprocess
+from pymongo import monitoring
+from starlette.routing import Match
+
+logger = logging.getLogger(__name__)
+
+LOOP_LAG_INTERVAL = float(os.environ.get("LOOP_LAG_INTERVAL", 0.5))
+# Read by prometheus_client itself when it is imported
+MULTIPROCESS = bool(os.environ.get("PROMETHEUS_MULTIPROC_DIR"))
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds",
+    "HTTP request latency by route template",
+    ["method", "route", "status"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    "http_requests_in_flight",
+    "Requests currently being handled",
+    ["method"],
+    multiprocess_mode="livesum",
+)
+MONGO_LATENCY = Histogram(
+    "mongo_command_duration_seconds",
+    "MongoDB command latency",
+    ["command", "collection", "outcome"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+UPSTREAM_LATENCY = Histogram(
+    "upstream_request_duration_seconds",
+    "Outbound call latency (BGG, LLM, auth provider)",
+    ["upstream", "status"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40),
+)
+CACHE_REQUESTS = Counter(
+    "cache_requests_total",
+    "Cache lookups by result",
+    ["cache", "result"],
+)
+LOOP_LAG = Histogram(
+    "event_loop_lag_seconds",
+    "How late the event loop ran a timer scheduled LOOP_LAG_INTERVAL ahead",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+MONGO_POOL_CONNECTIONS = Gauge(
+    "mongo_pool_connections",
+    "Open MongoDB connections per server",
+    ["address"],
+    multiprocess_mode="livesum",
+)
+MONGO_POOL_CHECKED_OUT = Gauge(
+    "mongo_pool_checked_out",
+    "MongoDB connections currently in use per server",
+    ["address"],
+    multiprocess_mode="livesum",
+)
+MONGO_POOL_WAITING = Gauge(
+    "mongo_pool_waiting",
+    "Operations waiting for a MongoDB connection; above zero means the pool is saturated",
+    ["address"],
+    multiprocess_mode="livesum",
+)
+MONGO_POOL_LIMIT = Gauge(
+    "mongo_pool_limit",
+    "Configured maxPoolSize",
+    multiprocess_mode="livesum",
+)
+MONGO_TIER_LATENCY = Histogram(
+    "mongo_tier_duration_seconds",
+    "MongoDB call latency by read tier (see data_access.py)",
+    ["tier", "collection", "op"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+HTTP_POOL_CONNECTIONS = Gauge(
+    "http_pool_connections",
+    "Outbound HTTP connections per shared client",
+    ["client", "state"],
+    multiprocess_mode="livesum",
+)
+HTTP_POOL_LIMIT = Gauge(
+    "http_pool_limit",
+    "Configured max_connections per shared client",
+    ["client"],
+    multiprocess_mode="livesum",
+)
+
+JOBS = Counter(
+    "jobs_total",
+    "Background jobs finished, by outcome (done, retry, failed)",
+    ["type", "outcome"],
+)
+JOB_LATENCY = Histogram(
+    "job_duration_seconds",
+    "Time a background job's handler ran",
+    ["type"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120),
+)
+JOBS_RUNNING = Gauge(
+    "jobs_running",
+    "Background jobs running in this process",
+    ["type"],
+    multiprocess_mode="livesum",
+)
+DEADLINES_EXCEEDED = Counter(
+    "deadline_exceeded_total",
+    "Outbound calls cancelled because the request's time budget ran out",
+    ["upstream"],
+)
+
+
+def cache_result(cache: str, hit: bool):
+    CACHE_REQUESTS.labels(cache, "hit" if hit else "miss").inc()
+
+
+def observe_upstream(upstream: str, status, seconds: float):
+    UPSTREAM_LATENCY.labels(upstream, str(status)).observe(seconds)
+
+
+@contextmanager
+def time_upstream(upstream: str):
+    """Time an outbound call; the status label is "ok" or "error"."""
+    start = time.perf_counter()
+    status = "error"
+    try:
+        yield
+        status = "ok"
+    finally:
+        observe_upstream(upstream, status, time.perf_counter() - start)
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    """Times every command Motor sends. Pass to AsyncIOMotorClient(event_listeners=[...])."""
+
+    # Commands whose first argument is not a collection name
+    _NO_COLLECTION = {"ping", "hello", "isMaster", "ismaster", "buildInfo", "endSessions", "saslStart", "saslContinue"}
+
+    def __init__(self):
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def started(self, event):
+        name = event.command_name
+        if name in self._NO_COLLECTION:
+            collection = ""
+        elif name == "getMore":
+            collection = str(event.command.get("collection", ""))
+        else:
+            collection = str(event.command.get(name, ""))
+        with self._lock:
+            self._pending[(event.connection_id, event.request_id)] = (name, collection)
+
+    def _finish(self, event, outcome: str):
+        with self._lock:
+            info = self._pending.pop((event.connection_id, event.request_id), None)
+        if info:
+            MONGO_LATENCY.labels(info[0], info[1], outcome).observe(event.duration_micros / 1e6)
+
+    def succeeded(self, event):
+        self._finish(event, "ok")
+
+    def failed(self, event):
+        self._finish(event, "error")
+
+
+class MongoPoolListener(monitoring.ConnectionPoolListener):
+    """Tracks pool size, checked-out connections and checkout waiters per server."""
+
+    def _address(self, event):
+        host, port = event.address
+        return f"{host}:{port}"
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        address = self._address(event)
+        MONGO_POOL_CONNECTIONS.labels(address).set(0)
+        MONGO_POOL_CHECKED_OUT.labels(address).set(0)
+
+    def connection_created(self, event):
+        MONGO_POOL_CONNECTIONS.labels(self._address(event)).inc()
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        MONGO_POOL_CONNECTIONS.labels(self._address(event)).dec()
+
+    def connection_check_out_started(self, event):
+        MONGO_POOL_WAITING.labels(self._address(event)).inc()
+
+    def connection_check_out_failed(self, event):
+        MONGO_POOL_WAITING.labels(self._address(event)).dec()
+
+    def connection_checked_out(self, event):
+        address = self._address(event)
+        MONGO_POOL_WAITING.labels(address).dec()
+        MONGO_POOL_CHECKED_OUT.labels(address).inc()
+
+    def connection_checked_in(self, event):
+        MONGO_POOL_CHECKED_OUT.labels(self._address(event)).dec()
+
+
+# Called every LOOP_LAG_INTERVAL in multiprocess mode, for values otherwise computed at scrape time
+_samplers = []
+
+
+def watch_http_pool(name: str, client, limit: int):
+    """Export an httpx client's pool usage, read from httpcore at scrape time."""
+    pool = getattr(getattr(client, "_transport", None), "_pool", None)
+    if pool is None:
+        return
+
+    def count(idle: bool):
+        try:
+            return sum(1 for c in pool.connections if c.is_idle() == idle)
+        except Exception:
+            return 0
+
+    active, idle = HTTP_POOL_CONNECTIONS.labels(name, "active"), HTTP_POOL_CONNECTIONS.labels(name, "idle")
+    if MULTIPROCESS:
+        # Scrapes read the other processes' files, so the values are sampled instead (see sample_loop_lag)
+        _samplers.append(lambda: (active.set(count(False)), idle.set(count(True))))
+    else:
+        active.set_function(lambda: count(False))
+        idle.set_function(lambda: count(True))
+    HTTP_POOL_LIMIT.labels(name).set(limit)
+
+
+class MetricsMiddleware:
+    """Outermost ASGI middleware: latency histogram and in-flight gauge per route template."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] == "/metrics":
+            return await self.app(scope, receive, send)
+
+        method = scope["method"]
+        status = {"code": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        REQUESTS_IN_FLIGHT.labels(method).inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            REQUESTS_IN_FLIGHT.labels(method).dec()
+            # FastAPI puts the matched route on the scope; template paths keep label cardinality bounded
+            route = scope.get("route") or _match_route(scope)
+            label = getattr(route, "path", None) or "unmatched"
+            REQUEST_LATENCY.labels(method, label, str(status["code"])).observe(time.perf_counter() - start)
+
+
+def _match_route(scope):
+    # Responses answered by inner middlewares (response cache, rate limiter) never reach the router
+    app = scope.get("app")
+    for route in getattr(app, "routes", ()):
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route
+    return None
+
+
+async def sample_loop_lag():
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + LOOP_LAG_INTERVAL
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        LOOP_LAG.observe(max(0.0, loop.time() - expected))
+        for sample in _samplers:
+            sample()
+
+
+def render():
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+
+def shutdown():
+    """Drop this process's live gauges from the shared directory; its counters stay in the totals."""
+    if MULTIPROCESS:
+        multiprocess.mark_process_dead(os.getpid())
@@ -0,0 +1,319 @@
+"""
+Schema versions and background data migrations.
+
+Every document in a migrated collection carries `schemaVersion`; new
+documents are written at version(collection) and so never need migrating.
+A migration moves one collection from version - 1 to `version`: registered
+with @migration(collection, version, ...), its transform gets a document
+(just `fields` of it) and returns the update operators that bring it up to
+date, or None when only the version needs stamping.
+
+Migrations run as the "migrate" job (see jobs.py), so on whichever runner
+picks it up and never on a request:
+
+- Batched: MIGRATION_BATCH_SIZE documents at a time, walking `_id` in
+  order, with one bulk_write per batch.
+- Throttled: MIGRATION_PAUSE_SECONDS between batches, so the primary keeps
+  serving requests; each job runs for MIGRATION_SLICE_SECONDS and queues
+  the next one.
+- Resumable: the last `_id` done is saved in the `migrations` collection
+  after every batch, so a restart picks up where it left off. The updates
+  match on the old version, so running a batch twice changes nothing.
+- Leased: a runner claims a migration's progress document for
+  MIGRATION_LEASE_SECONDS and renews it with every batch, so only one
+  runner walks a collection at a time. Another run() finds it leased and
+  returns; a lease left by a dead runner expires and is taken over.
+
+start() queues the job at boot when a registered migration isn't done yet.
+`python backend/migrations.py` runs them all to completion from a shell.
+
+Readers keep handling the old shapes until a collection's migrations are
+done. data_access.migrated holds the collections that are: start() fills it
+from the `migrations` collection, and a runner that finishes one adds it
+everywhere through the "migrations" channel, so the hot reads drop their
+fallbacks (noted below) as soon as the backfill is through.
+
+Current versions:
+
+- listings 1: createdAt/updatedAt are ISO 8601 strings in UTC, as the API
+  writes them (imports and old rows had BSON dates). Fallback: the feed
+  views rank dates too (feed_views._created_key).
+- users 1: createdAt as ISO strings; the avatar is `picture` (some rows
+  had `image`). Fallback: avatar reads try `image` (server.user_avatar).
+- user_sessions 1: expires_at/created_at are BSON dates, so the session
+  lookup compares in the query and a TTL index clears expired sessions.
+  Fallback: expiry is checked in Python, where ISO strings parse too
+  (data_access.session_expired).
+"""
+
+import asyncio
+import logging
+import os
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Dict, List, NamedTuple, Optional
+
+from pymongo import ASCENDING, ReturnDocument, UpdateOne
+
+import data_access
+import feed_views
+import http_cache
+import jobs
+from shared_state import state
+
+logger = logging.getLogger(__name__)
+
+MIGRATION_BATCH_SIZE = int(os.environ.get("MIGRATION_BATCH_SIZE", 500))
+MIGRATION_PAUSE_SECONDS = float(os.environ.get("MIGRATION_PAUSE_SECONDS", 0.2))
+MIGRATION_SLICE_SECONDS = float(os.environ.get("MIGRATION_SLICE_SECONDS", 60.0))
+MIGRATION_LEASE_SECONDS = float(os.environ.get("MIGRATION_LEASE_SECONDS", 30.0))
+CHANNEL = "migrations"
+
+
+class Migration(NamedTuple):
+    collection: str
+    version: int
+    description: str
+    transform: Callable[[dict], Optional[dict]]
+    fields: tuple
+    # Called with the documents a batch changed (as read, before the change)
+    on_batch: Optional[Callable[[List[dict]], Awaitable]]
+
+    @property
+    def id(self) -> str:
+        return f"{self.collection}:{self.version}"
+
+
+_migrations: List[Migration] = []
+
+
+def migration(collection: str, version: int, description: str, fields: tuple = (), on_batch=None):
+    """Register the decorated function as the migration of `collection` to `version`."""
+    def register(transform):
+        _migrations.append(Migration(collection, version, description, transform, fields, on_batch))
+        _migrations.sort(key=lambda m: (m.collection, m.version))
+        return transform
+    return register
+
+
+def version(collection: str) -> int:
+    """Schema version new documents in `collection` are written at."""
+    return max((m.version for m in _migrations if m.collection == collection), default=0)
+
+
+def _utc(value: datetime) -> datetime:
+    # Mongo hands back naive datetimes in UTC
+    return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value.astimezone(timezone.utc)
+
+
+def _parse(value: str) -> Optional[datetime]:
+    try:
+        return _utc(datetime.fromisoformat(value.replace("Z", "+00:00")))
+    except ValueError:
+        return None
+
+
+def _as_iso(value):
+    """`value` as the ISO string the API writes, or None when it already is one (or can't be)."""
+    if isinstance(value, datetime):
+        return _utc(value).isoformat()
+    if isinstance(value, str):
+        parsed = _parse(value)
+        if parsed is not None and parsed.isoformat() != value:
+            return parsed.isoformat()
+    return None
+
+
+def _as_date(value) -> Optional[datetime]:
+    """`value` as a UTC datetime, or None when it already is one (or can't be)."""
+    if isinstance(value, str):
+        return _parse(value)
+    return None
+
+
+def _set_converted(doc: dict, fields: tuple, convert) -> Optional[dict]:
+    changes = {}
+    for field in fields:
+        converted = convert(doc.get(field))
+        if converted is not None:
+            changes[field] = converted
+    return {"$set": changes} if changes else None
+
+
+async def _refresh_listings(docs: List[dict]):
+    # The feed views hold listings as read at startup
+    await feed_views.refreshed(await data_access.find("listings", {"id": {"$in": [d["id"] for d in docs]}}, {"_id": 0}))
+    await http_cache.bump("listings")
+
+
+@migration("listings", 1, "createdAt/updatedAt as ISO strings", ("id", "createdAt", "updatedAt"), _refresh_listings)
+def _listing_dates(doc: dict) -> Optional[dict]:
+    return _set_converted(doc, ("createdAt", "updatedAt"), _as_iso)
+
+
+@migration("users", 1, "createdAt as an ISO string, avatar in picture", ("createdAt", "picture", "image"))
+def _user_dates_and_avatar(doc: dict) -> Optional[dict]:
+    update = _set_converted(doc, ("createdAt",), _as_iso) or {}
+    if "image" in doc:
+        if doc["image"] and not doc.get("picture"):
+            update.setdefault("$set", {})["picture"] = doc["image"]
+        update["$unset"] = {"image": ""}
+    return update or None
+
+
+@migration("user_sessions", 1, "expires_at/created_at as dates", ("expires_at", "created_at"))
+def _session_dates(doc: dict) -> Optional[dict]:
+    return _set_converted(doc, ("expires_at", "created_at"), _as_date)
+
+
+async def _status() -> Dict[str, dict]:
+    return {s["id"]: s for s in await data_access.find("migrations", {}, {"_id": 0})}
+
+
+def _done_collections(status: Dict[str, dict]) -> set:
+    collections = {m.collection for m in _migrations}
+    return {c for c in collections
+            if all(status.get(m.id, {}).get("status") == "done" for m in _migrations if m.collection == c)}
+
+
+def _on_migrated(message: dict):
+    data_access.migrated.update(message.get("collections") or [])
+
+
+state.subscribe(CHANNEL, _on_migrated)
+
+
+async def _announce(status: Dict[str, dict]):
+    new = _done_collections(status) - data_access.migrated
+    if not new:
+        return
+    data_access.migrated.update(new)
+    try:
+        await state.publish(CHANNEL, {"collections": sorted(new)})
+    except Exception as e:
+        # Other processes pick it up from the migrations collection when they next start
+        logger.warning(f"Migration broadcast failed: {e}")
+
+
+async def _run_batch(m: Migration, last_id) -> tuple:
+    """Migrate the next batch after `last_id`. Returns (last _id read or None at the end, documents changed)."""
+    coll = data_access.collection(m.collection)
+    projection = {field: 1 for field in m.fields}
+    projection["schemaVersion"] = 1
+    query = {"_id": {"$gt": last_id}} if last_id is not None else {}
+    batch = await coll.find(query, projection).sort("_id", ASCENDING).limit(MIGRATION_BATCH_SIZE).to_list(None)
+    if not batch:
+        return None, 0
+
+    ops, changed = [], []
+    for doc in batch:
+        if doc.get("schemaVersion", 0) >= m.version:
+            continue
+        update = m.transform(doc) or {}
+        if update:
+            changed.append(doc)
+        update.setdefault("$set", {})["schemaVersion"] = m.version
+        # Only while it's still at the old version, so a repeated batch is a no-op
+        ops.append(UpdateOne({"_id": doc["_id"], "schemaVersion": {"$not": {"$gte": m.version}}}, update))
+    if ops:
+        await coll.bulk_write(ops, ordered=False)
+    if changed and m.on_batch:
+        await m.on_batch(changed)
+    return batch[-1]["_id"], len(changed)
+
+
+def _lease_until() -> datetime:
+    return datetime.now(timezone.utc) + timedelta(seconds=MIGRATION_LEASE_SECONDS)
+
+
+async def _claim(m: Migration, owner: str) -> Optional[dict]:
+    """Take the lease on `m`'s progress document; None while another runner holds it."""
+    return await data_access.collection("migrations").find_one_and_update(
+        {"id": m.id, "status": {"$ne": "done"},
+         "$or": [{"leaseUntil": None}, {"leaseUntil": {"$lte": datetime.now(timezone.utc)}}]},
+        {"$set": {"owner": owner, "leaseUntil": _lease_until()}},
+        projection={"_id": 0},
+        # The lease fields aren't needed back, and AFTER would be None where the update un-matches the filter
+        return_document=ReturnDocument.BEFORE,
+    )
+
+
+async def run(seconds: Optional[float] = None) -> bool:
+    """Run pending migrations, each collection's in version order, for at most `seconds`.
+
+    True once all are done; False when time ran out or another runner holds a migration's lease.
+    """
+    deadline = None if seconds is None else time.monotonic() + seconds
+    owner = uuid.uuid4().hex
+    status = await _status()
+    for m in _migrations:
+        state = status.get(m.id) or {}
+        if state.get("status") == "done":
+            continue
+        if not state:
+            logger.info(f"Migrating {m.collection} to version {m.version}: {m.description}")
+            state = {"id": m.id, "collection": m.collection, "version": m.version, "description": m.description,
+                     "status": "running", "lastId": None, "changed": 0,
+                     "startedAt": datetime.now(timezone.utc).isoformat()}
+            await data_access.collection("migrations").update_one({"id": m.id}, {"$setOnInsert": state}, upsert=True)
+        state = await _claim(m, owner)
+        if state is None:
+            return False
+        last_id, changed = state.get("lastId"), state.get("changed", 0)
+        mine = {"id": m.id, "owner": owner}
+        while True:
+            if deadline is not None and time.monotonic() >= deadline:
+                await data_access.update_one("migrations", mine, {"$set": {"leaseUntil": None}})
+                return False
+            last_id, n = await _run_batch(m, last_id)
+            if last_id is None:
+                break
+            changed += n
+            renewed = await data_access.update_one(
+                "migrations", mine, {"$set": {"lastId": last_id, "changed": changed, "leaseUntil": _lease_until()}})
+            if not renewed.matched_count:
+                # Our lease ran out and someone else took over from the last saved batch
+                return False
+            await asyncio.sleep(MIGRATION_PAUSE_SECONDS)
+        await data_access.update_one("migrations", mine, {"$set": {
+            "status": "done", "changed": changed, "finishedAt": datetime.now(timezone.utc).isoformat(),
+            "leaseUntil": None}})
+        status[m.id] = {"status": "done"}
+        logger.info(f"Migrated {m.collection} to version {m.version} ({changed} documents changed)")
+        await _announce(status)
+    return True
+
+
+@jobs.job("migrate", concurrency=1, max_attempts=10, timeout=MIGRATION_SLICE_SECONDS * 3)
+async def migrate_job(payload: dict):
+    started = time.monotonic()
+    if not await run(MIGRATION_SLICE_SECONDS):
+        # Straight on after a full slice; a lease held elsewhere is looked at again once it could have expired
+        leased = time.monotonic() - started < MIGRATION_SLICE_SECONDS
+        await jobs.enqueue("migrate", {}, key="migrate", delay=MIGRATION_LEASE_SECONDS if leased else 0)
+
+
+async def start():
+    """Create the indexes that rely on migrated types, and queue the migrations still to do."""
+    # Only applies to documents whose expires_at is a date, which after migration is all of them
+    await data_access.collection("user_sessions").create_index("expires_at", expireAfterSeconds=0)
+    status = await _status()
+    data_access.migrated.update(_done_collections(status))
+    if any(status.get(m.id, {}).get("status") != "done" for m in _migrations):
+        await jobs.enqueue("migrate", {}, key="migrate")
+
+
+if __name__ == "__main__":
+    import resources
+
+    async def main():
+        while not await run():
+            # Another runner (the "migrate" job) holds a lease; wait for it
+            await asyncio.sleep(MIGRATION_LEASE_SECONDS / 2)
+        for s in (await _status()).values():
+            print(f"{s['id']}: {s['status']}, {s.get('changed', 0)} documents changed")
+        resources.mongo_client.close()
+
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
@@ -0,0 +1,147 @@
+"""
+Per-client rate limiting for routes that call paid or rate-limited upstreams.
+
+Each policy is a token bucket: `capacity` tokens of burst, refilled evenly
+over `per_seconds`. A request costs one token; handlers whose work grows with
+the request (one BGG search per title in /bgg/match) take the rest with
+take(). Buckets live in shared_state, so with a Redis backend the limit holds
+across all workers. One bucket read/update per request, plus a session
+lookup that is cached for a minute.
+
+Clients are keyed by user when they send a session cookie that belongs to a
+live session, and by IP otherwise. An unknown cookie counts as no cookie, so
+inventing a fresh one per request doesn't buy a fresh bucket. The IP is the
+socket peer by default. X-Forwarded-For is only read when TRUSTED_PROXY_HOPS
+says how many of our own proxies append to it: behind the ingress, set
+TRUSTED_PROXY_HOPS=1 (one more per proxy in the chain) and the IP is taken
+that many entries from the right. The entries further left are whatever the
+client sent, and with no proxy in front so is the whole header, so never
+set it on a directly exposed app.
+"""
+
+import logging
+import math
+import os
+import time
+from typing import Dict, NamedTuple, Optional, Tuple
+
+import orjson
+
+import data_access
+from shared_state import state
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_ENABLED = os.environ.get("RATE_LIMIT_ENABLED", "true").lower() != "false"
+# Proxies in front of the app that append to X-Forwarded-For; 0 trusts none of it
+TRUSTED_PROXY_HOPS = int(os.environ.get("TRUSTED_PROXY_HOPS", 0))
+SESSION_CACHE_SECONDS = float(os.environ.get("RATE_LIMIT_SESSION_CACHE_SECONDS", 60))
+SESSION_CACHE_SIZE = 10_000
+
+
+class Policy(NamedTuple):
+    capacity: int
+    per_seconds: float
+
+    @property
+    def rate(self) -> float:
+        return self.capacity / self.per_seconds
+
+
+# (method, path) -> policy
+POLICIES: Dict[tuple, Policy] = {
+    ("POST", "/api/ai/scan-image"): Policy(5, 60),
+    ("POST", "/api/ai/scan-image/upload"): Policy(5, 60),
+    ("POST", "/api/ai/parse-text"): Policy(10, 60),
+    ("GET", "/api/bgg/search"): Policy(30, 60),
+    # Charged per title (see server.bgg_match), so up to 100 BGG lookups a minute
+    ("POST", "/api/bgg/match"): Policy(100, 60),
+    ("POST", "/api/uploads/images"): Policy(30, 60),
+}
+
+
+# session_token -> (user id, monotonic time it was checked); only live sessions are kept
+_sessions: Dict[str, Tuple[str, float]] = {}
+
+
+async def _session_user(token: str) -> Optional[str]:
+    cached = _sessions.get(token)
+    now = time.monotonic()
+    if cached and now - cached[1] < SESSION_CACHE_SECONDS:
+        return cached[0]
+    session = await data_access.load_session(token)
+    if session is None:
+        _sessions.pop(token, None)
+        return None
+    if len(_sessions) >= SESSION_CACHE_SIZE:
+        _sessions.pop(next(iter(_sessions)))
+    _sessions[token] = (session["user_id"], now)
+    return session["user_id"]
+
+
+def client_ip(scope) -> str:
+    headers = dict(scope.get("headers", []))
+    forwarded = [h.strip() for h in headers.get(b"x-forwarded-for", b"").decode("latin-1").split(",") if h.strip()]
+    if TRUSTED_PROXY_HOPS and len(forwarded) >= TRUSTED_PROXY_HOPS:
+        return forwarded[-TRUSTED_PROXY_HOPS]
+    client = scope.get("client")
+    return client[0] if client else "unknown"
+
+
+async def client_key(scope) -> str:
+    headers = dict(scope.get("headers", []))
+    cookie = headers.get(b"cookie", b"").decode("latin-1")
+    for part in cookie.split(";"):
+        name, _, value = part.strip().partition("=")
+        if name == "session_token" and value:
+            user_id = await _session_user(value)
+            if user_id:
+                return f"u:{user_id}"
+            break
+    return f"ip:{client_ip(scope)}"
+
+
+async def take(scope, cost: float = 1) -> Tuple[bool, float]:
+    """Take `cost` tokens from the client's bucket for this route: (allowed, seconds to wait).
+
+    Routes without a policy, and a broken limiter backend, always allow.
+    """
+    policy = POLICIES.get((scope["method"], scope["path"]))
+    if policy is None or not RATE_LIMIT_ENABLED or cost <= 0:
+        return True, 0.0
+    try:
+        key = f"ratelimit:{scope['path']}:{await client_key(scope)}"
+        return await state.take_token(key, policy.capacity, policy.rate, min(cost, policy.capacity))
+    except Exception as e:
+        # Fail open: a broken limiter backend shouldn't take the API down
+        logger.warning(f"Rate limiter unavailable: {e}")
+        return True, 0.0
+
+
+class RateLimitMiddleware:
+    """ASGI middleware answering 429 + Retry-After once a client's bucket is empty."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not RATE_LIMIT_ENABLED:
+            return await self.app(scope, receive, send)
+        if (scope["method"], scope["path"]) not in POLICIES:
+            return await self.app(scope, receive, send)
+
+        allowed, retry_after = await take(scope)
+        if allowed:
+            return await self.app(scope, receive, send)
+
+        body = orjson.dumps({"detail": "Too many requests, please slow down"})
+        await send({
+            "type": "http.response.start",
+            "status": 429,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"retry-after", str(max(1, math.ceil(retry_after))).encode()),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
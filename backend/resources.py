@@ -0,0 +1,142 @@
+"""
+Long-lived clients shared by the whole process.
+
+- Mongo: one Motor client with pool size, timeouts, read preference and wire
+  compression taken from the environment. The client itself connects lazily;
+  startup() pings it so a bad MONGO_URL fails at boot instead of on the first
+  request, and shutdown() closes the pool.
+- HTTP: pooled httpx clients instead of a fresh client/session per call.
+  `bgg` is synchronous because BGG lookups run in worker threads; `http` is
+  async, for the auth provider and cover downloads. Both keep connections
+  alive between requests.
+
+Pool usage for both is exported as Prometheus gauges (see metrics.py), so
+saturation shows up as checked-out connections at the limit and Mongo
+checkout waiters above zero.
+"""
+
+import logging
+import os
+from pathlib import Path
+
+import httpx
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Scripts importing this directly (market.py, workers) get the same config as the server
+load_dotenv(Path(__file__).parent / ".env")
+
+MONGO_URL = os.environ.get("MONGO_URL") or "mongodb://localhost:27017"
+DB_NAME = os.environ.get("DB_NAME", "app_db")
+MONGO_MAX_POOL_SIZE = int(os.environ.get("MONGO_MAX_POOL_SIZE", 100))
+MONGO_MIN_POOL_SIZE = int(os.environ.get("MONGO_MIN_POOL_SIZE", 0))
+MONGO_MAX_IDLE_MS = int(os.environ.get("MONGO_MAX_IDLE_MS", 60_000))
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.environ.get("MONGO_WAIT_QUEUE_TIMEOUT_MS", 5_000))
+MONGO_CONNECT_TIMEOUT_MS = int(os.environ.get("MONGO_CONNECT_TIMEOUT_MS", 5_000))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.environ.get("MONGO_SERVER_SELECTION_TIMEOUT_MS", 5_000))
+MONGO_SOCKET_TIMEOUT_MS = int(os.environ.get("MONGO_SOCKET_TIMEOUT_MS", 20_000))
+MONGO_READ_PREFERENCE = os.environ.get("MONGO_READ_PREFERENCE", "primary")
+# Tried in order; the server picks the first one it also supports
+MONGO_COMPRESSORS = os.environ.get("MONGO_COMPRESSORS", "zstd,snappy,zlib")
+
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", 20))
+BGG_POOL_SIZE = int(os.environ.get("BGG_POOL_SIZE", 10))
+
+BGG_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,image/apng,*/*;q=0.8",
+    "Accept-Language": "en-US,en;q=0.9",
+    "Referer": "https://boardgamegeek.com/",
+}
+
+
+def _available_compressors(wanted: str):
+    # snappy and zstd need optional packages; zlib is always there
+    modules = {"snappy": "snappy", "zstd": "zstandard"}
+    found = []
+    for name in (c.strip() for c in wanted.split(",")):
+        if not name:
+            continue
+        if name in modules:
+            try:
+                __import__(modules[name])
+            except ImportError:
+                continue
+        found.append(name)
+    return found
+
+
+def mongo_options() -> dict:
+    options = {
+        "maxPoolSize": MONGO_MAX_POOL_SIZE,
+        "minPoolSize": MONGO_MIN_POOL_SIZE,
+        "maxIdleTimeMS": MONGO_MAX_IDLE_MS,
+        "waitQueueTimeoutMS": MONGO_WAIT_QUEUE_TIMEOUT_MS,
+        "connectTimeoutMS": MONGO_CONNECT_TIMEOUT_MS,
+        "serverSelectionTimeoutMS": MONGO_SERVER_SELECTION_TIMEOUT_MS,
+        "socketTimeoutMS": MONGO_SOCKET_TIMEOUT_MS,
+        "readPreference": MONGO_READ_PREFERENCE,
+    }
+    compressors = _available_compressors(MONGO_COMPRESSORS)
+    if compressors:
+        options["compressors"] = ",".join(compressors)
+    return options
+
+
+mongo_client = AsyncIOMotorClient(
+    MONGO_URL,
+    event_listeners=[metrics.MongoCommandListener(), metrics.MongoPoolListener()],
+    **mongo_options(),
+)
+db = mongo_client[DB_NAME]
+metrics.MONGO_POOL_LIMIT.set(MONGO_MAX_POOL_SIZE)
+
+_bgg = None
+_http = None
+
+
+def _limits(size: int):
+    return httpx.Limits(max_connections=size, max_keepalive_connections=size, keepalive_expiry=30)
+
+
+def bgg_client() -> httpx.Client:
+    """Shared client for BGG (XML API and pages). Safe to use from worker threads."""
+    global _bgg
+    if _bgg is None or _bgg.is_closed:
+        _bgg = httpx.Client(headers=BGG_HEADERS, limits=_limits(BGG_POOL_SIZE), follow_redirects=True, timeout=10)
+        metrics.watch_http_pool("bgg", _bgg, BGG_POOL_SIZE)
+    return _bgg
+
+
+def http_client() -> httpx.AsyncClient:
+    """Shared async client for other outbound calls (auth provider, cover images)."""
+    global _http
+    if _http is None or _http.is_closed:
+        _http = httpx.AsyncClient(limits=_limits(HTTP_POOL_SIZE), follow_redirects=True, timeout=10)
+        metrics.watch_http_pool("http", _http, HTTP_POOL_SIZE)
+    return _http
+
+
+async def startup():
+    bgg_client()
+    http_client()
+    try:
+        await mongo_client.admin.command("ping")
+    except Exception as e:
+        # Don't refuse to boot; requests will surface the error, and Mongo may just be starting
+        logger.error(f"MongoDB not reachable at startup: {e}")
+
+
+async def shutdown():
+    global _bgg, _http
+    if _http is not None:
+        await _http.aclose()
+        _http = None
+    if _bgg is not None:
+        _bgg.close()
+        _bgg = None
+    mongo_client.close()
@@ -0,0 +1,259 @@
+"""
+Saved searches (wishlists) and the alerts they produce.
+
+A saved search names a game, by bggId and/or title, and can limit matches
+to a max price, a min condition and a listing type. New listings are
+matched against every saved search through an inverted index:
+
+- "bgg:<id>"  -> searches for that BGG id
+- "w:<word>"  -> title searches anchored on that word, their longest
+
+A title search matches when every word of its title key (see titles.py)
+appears in the listing's, so "catan" matches "Catan: Seafarers 5th ed".
+Each search is stored under one anchor word only, so matching a listing
+looks at the searches anchored on its own few words, however many searches
+exist. The "saved_search_alerts" job (see jobs.py) writes matches to the
+`inbox` collection, one per user and listing however often it runs, and
+they are read at GET /api/inbox.
+
+Every worker holds the index in memory, loaded at startup. Creating or
+deleting a search is broadcast on the "saved_searches" channel, and the
+other workers re-read those searches. A search's title key is recomputed
+from its title with the alias table as it is now, on load and whenever
+titles.py learns an alias the title uses.
+"""
+
+import logging
+import os
+import uuid
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Set
+
+from pymongo import DESCENDING, UpdateOne
+
+import data_access
+import jobs
+import titles
+from shared_state import state
+from titles import title_key
+
+logger = logging.getLogger(__name__)
+
+SAVED_SEARCH_LIMIT = int(os.environ.get("SAVED_SEARCH_LIMIT", 50))
+INBOX_PAGE_SIZE = int(os.environ.get("INBOX_PAGE_SIZE", 50))
+CHANNEL = "saved_searches"
+# Without an explicit type a wishlist is about buying or trading for the game
+DEFAULT_TYPES = ("WTS", "WTT", "WTL")
+
+_instance = uuid.uuid4().hex
+
+
+def _words(key: str) -> Set[str]:
+    return set(key.split())
+
+
+def _anchor(words: Set[str]) -> str:
+    # Longest word as a cheap stand-in for the rarest one
+    return max(words, key=lambda w: (len(w), w))
+
+
+class SearchIndex:
+    def __init__(self):
+        self.searches: Dict[str, dict] = {}
+        self.postings: Dict[str, Set[str]] = {}
+
+    def _keys(self, search: dict) -> List[str]:
+        keys = []
+        if search.get("bggId"):
+            keys.append(f"bgg:{search['bggId']}")
+        if search.get("normTitle"):
+            keys.append(f"w:{_anchor(_words(search['normTitle']))}")
+        return keys
+
+    def add(self, search: dict):
+        self.remove(search["id"])
+        self.searches[search["id"]] = search
+        for key in self._keys(search):
+            self.postings.setdefault(key, set()).add(search["id"])
+
+    def remove(self, search_id: str):
+        search = self.searches.pop(search_id, None)
+        if search is None:
+            return
+        for key in self._keys(search):
+            ids = self.postings.get(key)
+            if ids is not None:
+                ids.discard(search_id)
+                if not ids:
+                    del self.postings[key]
+
+    def match(self, listing: dict) -> List[dict]:
+        """Saved searches, of users other than the seller, that `listing` satisfies."""
+        words = _words(listing.get("normTitle") or title_key(listing.get("title")))
+        candidates = set()
+        for word in words:
+            for search_id in self.postings.get(f"w:{word}", ()):
+                if _words(self.searches[search_id]["normTitle"]) <= words:
+                    candidates.add(search_id)
+        if listing.get("bggId"):
+            candidates |= self.postings.get(f"bgg:{listing['bggId']}", set())
+
+        found = []
+        for search_id in candidates:
+            s = self.searches[search_id]
+            if s["userId"] == listing.get("sellerId"):
+                continue
+            # A search for one BGG id doesn't match other linked games that share its words
+            if s.get("bggId") and listing.get("bggId") and str(listing["bggId"]) != str(s["bggId"]):
+                continue
+            if listing.get("type") not in ((s["type"],) if s.get("type") else DEFAULT_TYPES):
+                continue
+            if s.get("maxPrice") is not None and (listing.get("price") is None or listing["price"] > s["maxPrice"]):
+                continue
+            if s.get("minCondition") is not None and (listing.get("condition") or 0) < s["minCondition"]:
+                continue
+            found.append(s)
+        return found
+
+
+index = SearchIndex()
+
+
+def _rekeyed(search: dict) -> dict:
+    # The stored normTitle is the key from when the search was saved
+    if search.get("title"):
+        search["normTitle"] = title_key(search["title"])
+    return search
+
+
+async def load():
+    async for doc in data_access.collection("saved_searches", "search").find({}, {"_id": 0}):
+        index.add(_rekeyed(doc))
+    logger.info(f"Saved searches loaded ({len(index.searches)})")
+
+
+async def _broadcast(ids: List[str]):
+    try:
+        await state.publish(CHANNEL, {"origin": _instance, "ids": ids})
+    except Exception as e:
+        logger.warning(f"Saved search broadcast failed: {e}")
+
+
+async def _on_change(message: dict):
+    if message.get("origin") == _instance:
+        return
+    ids = message.get("ids") or []
+    docs = await data_access.find("saved_searches", {"id": {"$in": ids}}, {"_id": 0})
+    found = {d["id"]: d for d in docs}
+    for search_id in ids:
+        if search_id in found:
+            index.add(_rekeyed(found[search_id]))
+        else:
+            index.remove(search_id)
+
+
+def _on_aliases(aliases: Set[str]):
+    for search in list(index.searches.values()):
+        if search.get("title") and titles.base_key(search["title"]) in aliases:
+            index.add(_rekeyed(dict(search)))
+
+
+state.subscribe(CHANNEL, _on_change)
+titles.subscribe(_on_aliases)
+
+
+def user_searches(user_id: str) -> List[dict]:
+    return sorted((s for s in index.searches.values() if s["userId"] == user_id), key=lambda s: s["createdAt"])
+
+
+async def create(user_id: str, title: Optional[str], bgg_id: Optional[str], max_price: Optional[float],
+                 min_condition: Optional[float], listing_type: Optional[str]) -> dict:
+    """Save a search; raises ValueError when it names no game or the user is at the limit."""
+    norm_title = title_key(title) if title else ""
+    if not norm_title and not bgg_id:
+        raise ValueError("A saved search needs a title or a BGG id")
+    if len(user_searches(user_id)) >= SAVED_SEARCH_LIMIT:
+        raise ValueError(f"At most {SAVED_SEARCH_LIMIT} saved searches per user")
+    doc = {
+        "id": str(uuid.uuid4()),
+        "userId": user_id,
+        "title": (title or "").strip(),
+        "normTitle": norm_title,
+        "bggId": bgg_id or None,
+        "maxPrice": max_price,
+        "minCondition": min_condition,
+        "type": listing_type or None,
+        "createdAt": datetime.now(timezone.utc).isoformat(),
+    }
+    await data_access.insert_one("saved_searches", doc)
+    doc.pop("_id", None)
+    index.add(doc)
+    await _broadcast([doc["id"]])
+    return doc
+
+
+async def delete(user_id: str, search_id: str) -> bool:
+    deleted = await data_access.find_one_and_delete("saved_searches", {"id": search_id, "userId": user_id}, {"_id": 0, "id": 1})
+    if deleted is None:
+        return False
+    index.remove(search_id)
+    await _broadcast([search_id])
+    return True
+
+
+async def notify(listings: List[dict]):
+    """Match new listings against every saved search and write the inbox entries (idempotent)."""
+    now = datetime.now(timezone.utc).isoformat()
+    entries = []
+    for listing in listings:
+        if listing.get("status", "active") != "active":
+            continue
+        notified = set()
+        for s in index.match(listing):
+            if s["userId"] in notified:
+                continue
+            notified.add(s["userId"])
+            entries.append({
+                "id": str(uuid.uuid4()),
+                "userId": s["userId"],
+                "searchId": s["id"],
+                "listingId": listing["id"],
+                "title": listing.get("title"),
+                "type": listing.get("type"),
+                "price": listing.get("price"),
+                "condition": listing.get("condition"),
+                "bggId": listing.get("bggId"),
+                "sellerId": listing.get("sellerId"),
+                "sellerName": listing.get("sellerName"),
+                "createdAt": now,
+                "read": False,
+            })
+    if entries:
+        await data_access.collection("inbox").bulk_write([
+            UpdateOne({"userId": e["userId"], "listingId": e["listingId"]}, {"$setOnInsert": e}, upsert=True)
+            for e in entries
+        ], ordered=False)
+
+
+@jobs.job("saved_search_alerts")
+async def alerts_job(payload: dict):
+    """Payload {ids}: newly created listings."""
+    listings = await data_access.find("listings", {"id": {"$in": payload["ids"]}}, {"_id": 0, "images": 0, "comments": 0})
+    await notify(listings)
+
+
+async def inbox(user_id: str, unread_only: bool = False, limit: int = INBOX_PAGE_SIZE) -> dict:
+    query = {"userId": user_id}
+    if unread_only:
+        query["read"] = False
+    items = await data_access.find("inbox", query, {"_id": 0}, sort=("createdAt", DESCENDING), limit=limit)
+    unread = await data_access.collection("inbox").count_documents({"userId": user_id, "read": False})
+    return {"items": items, "unread": unread}
+
+
+async def mark_read(user_id: str, ids: Optional[List[str]] = None) -> int:
+    query = {"userId": user_id, "read": False}
+    if ids:
+        query["id"] = {"$in": ids}
+    result = await data_access.collection("inbox").update_many(query, {"$set": {"read": True}})
+    return result.modified_count
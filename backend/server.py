@@ -1,7 +1,8 @@
 from fastapi import FastAPI, APIRouter, HTTPException, Request, Body
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
+from starlette.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, FileResponse
 import os
 import logging
 from pathlib import Path
@@ -9,12 +10,12 @@ from pydantic import BaseModel, Field, ConfigDict
 from typing import List, Optional, Any
 import uuid
 from datetime import datetime, timezone
-import requests
-import xmltodict
 import json
 import asyncio
-import html
-from bs4 import BeautifulSoup
+import math
+import time
+import base64
+import httpx
 
 # Emergent Integration
 from emergentintegrations.llm.chat import LlmChat, UserMessage, ImageContent
@@ -22,14 +23,32 @@ from emergentintegrations.llm.chat import LlmChat, UserMessage, ImageContent
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# MongoDB connection
-mongo_url = os.environ.get('MONGO_URL')
-if not mongo_url:
-    mongo_url = "mongodb://localhost:27017" 
-
-client = AsyncIOMotorClient(mongo_url)
-db_name = os.environ.get('DB_NAME', 'app_db')
-db = client[db_name]
+import metrics
+import diagnostics
+import http_cache
+import rate_limit
+import bgg_scrape
+import bgg_xml
+import cover_index
+import uploads
+import resources
+import data_access
+import feed_views
+import market
+import trade_match
+import titles
+import duplicates
+import saved_searches
+import jobs
+import deadlines
+import migrations
+from titles import normalize_title, title_key
+from circuit_breaker import breakers, get_breaker
+from shared_state import state as shared_state, check_multi_process
+
+# MongoDB connection (pool settings live in resources.py, read tiers in data_access.py)
+client = resources.mongo_client
+db = resources.db
 
 # Create the main app without a prefix
 app = FastAPI()
@@ -103,55 +122,65 @@ class BidRequest(BaseModel):
 
 # --- Helpers ---
 
+# Strong references to fire-and-forget tasks so they aren't garbage collected mid-run
+background_tasks = set()
+
+def run_in_background(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
 def get_bgg_session():
-    s = requests.Session()
-    s.headers.update({
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
-        "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,image/apng,*/*;q=0.8",
-        "Accept-Language": "en-US,en;q=0.9",
-        "Referer": "https://boardgamegeek.com/",
-        "Connection": "keep-alive"
-    })
-    return s
+    # Shared keep-alive pool; BGG lookups run in threads, so this one is synchronous
+    return resources.bgg_client()
+
+# One breaker per upstream path, so a blocked XML API doesn't stop the scrape fallback
+xml_search_breaker = get_breaker("bgg_xml_search")
+xml_thing_breaker = get_breaker("bgg_xml_thing")
+scrape_breaker = get_breaker("bgg_html_scrape", slow_call_seconds=8)
+
+# Below this much of the request budget, a BGG call isn't worth starting
+BGG_MIN_CALL_SECONDS = float(os.environ.get("BGG_MIN_CALL_SECONDS", 0.5))
+
+def bgg_get(breaker, url: str, timeout: float):
+    """GET through a circuit breaker, within the request deadline.
+
+    Returns None if the breaker is open, the call failed or the request is out of time.
+    """
+    left = deadlines.remaining()
+    if left is not None and left < BGG_MIN_CALL_SECONDS:
+        return None
+    budget = timeout if left is None else min(timeout, left)
+    if not breaker.allow():
+        return None
+    start = time.monotonic()
+    try:
+        res = get_bgg_session().get(url, timeout=budget)
+    except Exception as e:
+        elapsed = time.monotonic() - start
+        if budget < timeout and isinstance(e, httpx.TimeoutException):
+            # Cut short by our deadline, which says nothing about BGG's health
+            breaker.release()
+            metrics.DEADLINES_EXCEEDED.labels(breaker.name).inc()
+            metrics.observe_upstream(breaker.name, "deadline", elapsed)
+            return None
+        breaker.record(False, elapsed)
+        metrics.observe_upstream(breaker.name, "error", elapsed)
+        logging.warning(f"BGG request failed ({breaker.name}): {e}")
+        return None
+    elapsed = time.monotonic() - start
+    breaker.record(res.status_code == 200, elapsed)
+    metrics.observe_upstream(breaker.name, res.status_code, elapsed)
+    return res if res.status_code == 200 else None
 
 def scrape_bgg_search(q: str):
     try:
         url = f"https://boardgamegeek.com/geeksearch.php?action=search&objecttype=boardgame&q={q}"
-        s = get_bgg_session()
-        res = s.get(url, timeout=10)
-        if res.status_code != 200:
+        res = bgg_get(scrape_breaker, url, timeout=10)
+        if res is None:
             return []
-        
-        soup = BeautifulSoup(res.text, 'html.parser')
-        rows = soup.select('#collectionitems tr')
-        results = []
-        for row in rows[1:6]: # Skip header, limit 5
-            try:
-                # Title & ID
-                title_link = row.select_one('.collection_objectname a.primary')
-                if not title_link: continue
-                
-                title = title_link.text.strip()
-                href = title_link['href'] # /boardgame/13/catan
-                bgg_id = href.split('/')[2]
-                
-                # Year
-                year_span = row.select_one('.collection_objectname .smallerfont')
-                year = year_span.text.strip('()') if year_span else ""
-                
-                # Thumbnail
-                img_tag = row.select_one('.collection_thumbnail img')
-                thumbnail = img_tag['src'] if img_tag else ""
-                
-                results.append({
-                    "id": bgg_id,
-                    "title": title,
-                    "year": year,
-                    "thumbnail": thumbnail,
-                    "image": thumbnail # Fallback
-                })
-            except: continue
-        return results
+        return bgg_scrape.parse_search_page(res.text, limit=5)
     except Exception as e:
         logging.error(f"Scrape Search Error: {e}")
         return []
@@ -159,27 +188,11 @@ def scrape_bgg_search(q: str):
 def scrape_bgg_details(bgg_id: str):
     try:
         url = f"https://boardgamegeek.com/boardgame/{bgg_id}"
-        s = get_bgg_session()
-        res = s.get(url, timeout=10)
-        if res.status_code != 200:
+        res = bgg_get(scrape_breaker, url, timeout=10)
+        if res is None:
             return {}
-            
-        soup = BeautifulSoup(res.text, 'html.parser')
-        
-        # Image - Try meta tags first
-        image = ""
-        og_image = soup.select_one('meta[property="og:image"]')
-        if og_image:
-            image = og_image['content']
-            
-        # Description
-        desc = ""
-        desc_meta = soup.select_one('meta[name="description"]') # Often short
-        # Or find the angular description block if possible, but meta is safer for now
-        if desc_meta:
-            desc = desc_meta['content']
-            
-        return {"image": image, "description": desc}
+        # Meta tags only: og:image, and the (often short) meta description
+        return bgg_scrape.parse_details_page(res.text)
     except Exception as e:
         logging.error(f"Scrape Details Error: {e}")
         return {}
@@ -195,7 +208,6 @@ import uuid
 from datetime import datetime, timezone, timedelta
 from passlib.context import CryptContext
 from fastapi import Response, Cookie
-import httpx
 
 # Auth Security
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
@@ -234,9 +246,10 @@ async def create_session(user_id: str, response: Response):
         "session_token": session_token,
         "user_id": user_id,
         "expires_at": expires_at,
-        "created_at": datetime.now(timezone.utc)
+        "created_at": datetime.now(timezone.utc),
+        "schemaVersion": migrations.version("user_sessions")
     }
-    await db.user_sessions.insert_one(session_doc)
+    await data_access.insert_one("user_sessions", session_doc)
     
     response.set_cookie(
         key="session_token",
@@ -253,7 +266,7 @@ async def create_session(user_id: str, response: Response):
 @api_router.post("/auth/register-email")
 async def register_email(req: EmailRegisterRequest, response: Response):
     # Check existing
-    existing = await db.users.find_one({"email": req.email})
+    existing = await data_access.find_one("users", {"email": req.email})
     if existing:
         raise HTTPException(status_code=400, detail="Email already registered")
     
@@ -266,7 +279,8 @@ async def register_email(req: EmailRegisterRequest, response: Response):
         "email": req.email,
         "password_hash": hashed_pw,
         "auth_provider": "email",
-        "createdAt": datetime.now(timezone.utc).isoformat()
+        "createdAt": datetime.now(timezone.utc).isoformat(),
+        "schemaVersion": migrations.version("users")
     }
     await db.users.insert_one(user_doc)
     
@@ -279,7 +293,7 @@ async def register_email(req: EmailRegisterRequest, response: Response):
 
 @api_router.post("/auth/login-email")
 async def login_email(req: EmailLoginRequest, response: Response):
-    user = await db.users.find_one({"email": req.email})
+    user = await data_access.find_one("users", {"email": req.email})
     if not user or not user.get('password_hash'):
         raise HTTPException(status_code=401, detail="Invalid credentials")
         
@@ -291,22 +305,25 @@ async def login_email(req: EmailLoginRequest, response: Response):
     user_data = {k:v for k,v in user.items() if k not in ['_id', 'password_hash']}
     return {"user": user_data, "status": "success"}
 
+EMERGENT_AUTH_TIMEOUT = float(os.environ.get("EMERGENT_AUTH_TIMEOUT", 6.0))
+
 @api_router.post("/auth/exchange-session")
 async def exchange_emergent_session(req: EmergentSessionRequest, response: Response):
     # Call Emergent API
     emergent_url = "https://demobackend.emergentagent.com/auth/v1/env/oauth/session-data"
     headers = {"X-Session-ID": req.session_id}
     
-    async with httpx.AsyncClient() as client:
-        resp = await client.get(emergent_url, headers=headers)
-        if resp.status_code != 200:
-            raise HTTPException(status_code=401, detail="Invalid Google Session")
-        data = resp.json()
+    with metrics.time_upstream("emergent_auth"):
+        resp = await deadlines.run(resources.http_client().get(emergent_url, headers=headers),
+                                   EMERGENT_AUTH_TIMEOUT, "emergent_auth")
+    if resp.status_code != 200:
+        raise HTTPException(status_code=401, detail="Invalid Google Session")
+    data = resp.json()
             
     # Data has {id, email, name, picture, session_token}
     email = data.get('email')
     
-    user = await db.users.find_one({"email": email})
+    user = await data_access.find_one("users", {"email": email})
     if not user:
         # Create user
         user_id = str(uuid.uuid4())
@@ -316,7 +333,8 @@ async def exchange_emergent_session(req: EmergentSessionRequest, response: Respo
             "email": email,
             "picture": data.get('picture'),
             "auth_provider": "google",
-            "createdAt": datetime.now(timezone.utc).isoformat()
+            "createdAt": datetime.now(timezone.utc).isoformat(),
+            "schemaVersion": migrations.version("users")
         }
         await db.users.insert_one(user_doc)
         user = user_doc
@@ -333,35 +351,28 @@ async def get_current_user(request: Request):
     if not token:
         raise HTTPException(status_code=401, detail="Not authenticated")
         
-    session = await db.user_sessions.find_one({"session_token": token})
+    # Expired sessions are cleared by a TTL index once expires_at is a date (see migrations.py)
+    session = await data_access.load_session(token)
     if not session:
-        raise HTTPException(status_code=401, detail="Invalid session")
-        
-    # Check expiry
-    expires = session['expires_at']
-    if isinstance(expires, str):
-         try:
-            expires = datetime.fromisoformat(expires)
-         except: pass
-         
-    if expires.tzinfo is None:
-        expires = expires.replace(tzinfo=timezone.utc)
-        
-    if expires < datetime.now(timezone.utc):
-        await db.user_sessions.delete_one({"session_token": token})
-        raise HTTPException(status_code=401, detail="Session expired")
+        raise HTTPException(status_code=401, detail="Invalid or expired session")
         
-    user = await db.users.find_one({"id": session['user_id']}, {"_id": 0, "password_hash": 0})
+    user = await data_access.load_user(session['user_id'])
     if not user:
         raise HTTPException(status_code=401, detail="User not found")
         
     return user
 
+def user_avatar(user: dict) -> Optional[str]:
+    # Users the users 1 migration hasn't reached yet may still have it in `image` (see migrations.py)
+    if "users" in data_access.migrated:
+        return user.get('picture')
+    return user.get('picture') or user.get('image')
+
 @api_router.post("/auth/logout")
 async def logout(response: Response, request: Request):
     token = request.cookies.get("session_token")
     if token:
-        await db.user_sessions.delete_one({"session_token": token})
+        await data_access.delete_one("user_sessions", {"session_token": token})
     
     response.delete_cookie("session_token")
     return {"status": "success"}
@@ -380,7 +391,7 @@ async def update_profile(update: UserUpdate, request: Request):
     if not token:
         raise HTTPException(status_code=401, detail="Not authenticated")
         
-    session = await db.user_sessions.find_one({"session_token": token})
+    session = await data_access.find_one("user_sessions", {"session_token": token})
     if not session:
         raise HTTPException(status_code=401, detail="Invalid session")
         
@@ -407,12 +418,61 @@ async def update_profile(update: UserUpdate, request: Request):
     if not update_data:
         return {"status": "no changes"}
         
-    await db.users.update_one({"id": user_id}, {"$set": update_data})
-    
-    # Return updated user
-    updated_user = await db.users.find_one({"id": user_id}, {"_id": 0, "password_hash": 0})
+    # One round trip: update and read back the new document
+    updated_user = await data_access.find_one_and_update(
+        "users", {"id": user_id}, {"$set": update_data}, {"_id": 0, "password_hash": 0}
+    )
+    await http_cache.bump("users")
+    if 'displayName' in update_data or 'picture' in update_data:
+        await jobs.enqueue("seller_names", {"userId": user_id}, key=f"seller_names:{user_id}")
+    return updated_user
+
+@api_router.put("/auth/profile/avatar")
+async def update_avatar(request: Request):
+    token = request.cookies.get("session_token")
+    if not token:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+        
+    session = await data_access.find_one("user_sessions", {"session_token": token})
+    if not session:
+        raise HTTPException(status_code=401, detail="Invalid session")
+
+    user_id = session['user_id']
+    quota = await uploads.check_quota(user_id, request)
+    files = await uploads.receive_images(request, max_files=1, quota=quota)
+    if not files:
+        raise HTTPException(status_code=400, detail="No image uploaded")
+
+    await uploads.record(files, user_id, claimed=True)
+    updated_user = await data_access.find_one_and_update(
+        "users", {"id": user_id}, {"$set": {"picture": files[0]['url']}}, {"_id": 0, "password_hash": 0}
+    )
+    await http_cache.bump("users")
+    await jobs.enqueue("seller_names", {"userId": user_id}, key=f"seller_names:{user_id}")
     return updated_user
 
+@jobs.job("seller_names", concurrency=1, timeout=300)
+async def fan_out_seller_names(payload: dict):
+    """Payload {userId}: copy the user's current name and avatar onto their listings and comments."""
+    user_id = payload["userId"]
+    user = await data_access.load_user(user_id)
+    if not user:
+        return
+    name = user.get('displayName')
+    avatar = user_avatar(user)
+    listings = data_access.collection("listings")
+    await listings.update_many({"sellerId": user_id, "sellerName": {"$ne": name}}, {"$set": {"sellerName": name}})
+    await listings.update_many(
+        {"comments": {"$elemMatch": {"userId": user_id, "$or": [{"userName": {"$ne": name}}, {"userAvatar": {"$ne": avatar}}]}}},
+        {"$set": {"comments.$[c].userName": name, "comments.$[c].userAvatar": avatar}},
+        array_filters=[{"c.userId": user_id}],
+    )
+    touched = await data_access.find("listings", {"$or": [{"sellerId": user_id}, {"comments.userId": user_id}]}, {"_id": 0, "id": 1})
+    ids = [l['id'] for l in touched]
+    for start in range(0, len(ids), 500):
+        await feed_views.refreshed(await data_access.find("listings", {"id": {"$in": ids[start:start + 500]}}, {"_id": 0}))
+    await http_cache.bump("listings")
+
 # Auth
 @api_router.post("/auth/login-legacy", response_model=AuthResponse)
 async def login(req: AuthRequest):
@@ -421,6 +481,7 @@ async def login(req: AuthRequest):
         user_obj = User(displayName=req.displayName)
         doc = user_obj.model_dump()
         doc['createdAt'] = doc['createdAt'].isoformat()
+        doc['schemaVersion'] = migrations.version("users")
         await db.users.insert_one(doc)
         user_data = user_obj
 from fastapi_sso.sso.facebook import FacebookSSO
@@ -449,7 +510,7 @@ async def facebook_login():
 async def facebook_callback(request: Request):
     """Handle Facebook Callback"""
     try:
-        user_sso = await facebook_sso.verify_and_process(request)
+        user_sso = await deadlines.run(facebook_sso.verify_and_process(request), upstream="facebook_auth")
         
         # Check if user exists
         user = await db.users.find_one({"email": user_sso.email})
@@ -463,7 +524,8 @@ async def facebook_callback(request: Request):
                 "picture": user_sso.picture,
                 "auth_provider": "facebook",
                 "provider_id": user_sso.id,
-                "createdAt": datetime.now(timezone.utc).isoformat()
+                "createdAt": datetime.now(timezone.utc).isoformat(),
+                "schemaVersion": migrations.version("users")
             }
             await db.users.insert_one(user_doc)
             user = user_doc
@@ -480,9 +542,10 @@ async def facebook_callback(request: Request):
             "session_token": session_token,
             "user_id": user['id'],
             "expires_at": expires_at,
-            "created_at": datetime.now(timezone.utc)
+            "created_at": datetime.now(timezone.utc),
+            "schemaVersion": migrations.version("user_sessions")
         }
-        await db.user_sessions.insert_one(session_doc)
+        await data_access.insert_one("user_sessions", session_doc)
         
         redirect.set_cookie(
             key="session_token",
@@ -507,7 +570,7 @@ async def facebook_callback(request: Request):
     return {"user": user_data, "token": user_data.id}
 
 # Listings
-@api_router.get("/listings", response_model=List[dict])
+@api_router.get("/listings", response_class=ORJSONResponse)
 async def get_listings(type: Optional[str] = None, sellerId: Optional[str] = None):
     query = {}
     if type and type != 'ALL':
@@ -515,14 +578,25 @@ async def get_listings(type: Optional[str] = None, sellerId: Optional[str] = Non
     if sellerId:
         query['sellerId'] = sellerId
     
-    cursor = db.listings.find(query, {"_id": 0}).sort("createdAt", -1).limit(100)
-    listings = await cursor.to_list(length=100)
+    # The unfiltered and per-type feeds are served from memory (feed_views.py)
+    listings = None if sellerId else feed_views.feed(query.get('type'))
+    # A seller's own listings are read back right after they edit them, and the response is
+    # cached and ETagged under the version the write bumped: a lagging secondary would pin
+    # the old body there. The polled feeds can be a little behind (see data_access.TIERS).
+    tier = "primary" if sellerId else "feed"
+    if listings is None:
+        listings = await data_access.find("listings", query, {"_id": 0}, tier=tier, sort=("createdAt", -1), limit=feed_views.FEED_SIZE)
     
-    # Enrich listings with seller contact info
+    await enrich_sellers(listings, tier)
+
+    # createdAt is passed through as stored; orjson handles both ISO strings and datetimes
+    return ORJSONResponse(listings)
+
+async def enrich_sellers(listings: List[dict], tier: str = "feed"):
+    """Add seller contact info to each listing, with one users query."""
     seller_ids = list(set(l['sellerId'] for l in listings if l.get('sellerId')))
     if seller_ids:
-        users_cursor = db.users.find({"id": {"$in": seller_ids}}, {"_id": 0, "password_hash": 0})
-        users_list = await users_cursor.to_list(length=None)
+        users_list = await data_access.find("users", {"id": {"$in": seller_ids}}, {"_id": 0, "password_hash": 0}, tier=tier)
         users_map = {u['id']: u for u in users_list}
         
         for l in listings:
@@ -531,15 +605,30 @@ async def get_listings(type: Optional[str] = None, sellerId: Optional[str] = Non
                 l['sellerName'] = seller.get('displayName')
                 l['sellerPhone'] = seller.get('phone')
                 l['sellerFb'] = seller.get('facebookLink')
-                l['sellerAvatar'] = seller.get('picture') or seller.get('image')
+                l['sellerAvatar'] = user_avatar(seller)
+
+@api_router.get("/listings/hot", response_class=ORJSONResponse)
+async def get_hot_listings():
+    """Most-bid active listings."""
+    listings = feed_views.hottest()
+    if listings is None:
+        listings = await data_access.find(
+            "listings", {"status": "active", "bidCount": {"$gt": 0}}, {"_id": 0},
+            tier="feed", sort=("bidCount", -1), limit=feed_views.HOT_SIZE
+        )
+    await enrich_sellers(listings)
+    return ORJSONResponse(listings)
 
-    for l in listings:
-        if isinstance(l.get('createdAt'), str):
-            try:
-                l['createdAt'] = datetime.fromisoformat(l['createdAt'])
-            except: pass
-            
-    return listings
+@api_router.get("/sellers/{id}/summary")
+async def get_seller_summary(id: str):
+    return await feed_views.seller_summary(id)
+
+@api_router.get("/trades/{userId}")
+async def get_trades(userId: str):
+    """Trade partners for a user: direct matches, who wants their games, and multi-party swaps."""
+    if not trade_match.ready():
+        raise HTTPException(status_code=503, detail="Trade matching is still loading")
+    return trade_match.matches(userId)
 
 @api_router.post("/listings", response_model=List[dict])
 async def create_listings(items: List[Listing]):
@@ -551,9 +640,8 @@ async def create_listings(items: List[Listing]):
     
     # Optimization: Batch fetch users
     seller_ids = list(set(item.sellerId for item in items if item.sellerId))
-    users_cursor = db.users.find({"id": {"$in": seller_ids}})
-    users_list = await users_cursor.to_list(length=None)
-    users_map = {u['id']: u['displayName'] for u in users_list}
+    users_list = await data_access.user_loader.load_many(seller_ids)
+    users_map = {u['id']: u['displayName'] for u in users_list if u}
 
     for item in items:
         if item.sellerId in users_map:
@@ -563,42 +651,88 @@ async def create_listings(items: List[Listing]):
         doc['createdAt'] = doc['createdAt'].isoformat()
         if doc['updatedAt']:
             doc['updatedAt'] = doc['updatedAt'].isoformat()
+        doc['schemaVersion'] = migrations.version("listings")
+        # normTitle, a bggId guessed from the title, and repost flags
+        duplicates.annotate(doc)
         
         docs.append(doc)
         created_items.append(doc)
 
     if docs:
         await db.listings.insert_many(docs)
+        await http_cache.bump("listings")
+        await uploads.claim(v for d in docs for v in [d.get('image')] + list(d.get('images') or []))
         
     for d in created_items:
         if '_id' in d:
             del d['_id']
+    if docs:
+        await feed_views.added(docs)
+        await enqueue_listing_jobs(docs)
             
     return created_items
 
+async def enqueue_listing_jobs(docs: List[dict]):
+    """Follow-up work for new listings, run by the job runner (jobs.py)."""
+    await jobs.enqueue("saved_search_alerts", {"ids": [d['id'] for d in docs]})
+    # Covers of BGG-linked listings are hashed for scan_image; title guesses don't count as confirmed
+    linked = [d for d in docs if d.get('bggId') and d.get('bggIdSource') != 'title']
+    with_cover = [d['id'] for d in linked if d.get('image')]
+    if with_cover:
+        await jobs.enqueue("cover_index", {"ids": with_cover})
+    # The rest get BGG's cover first; that job queues their hashing. A guessed game's cover
+    # (or its BGG names) would be evidence for the guess, so those are left alone
+    without_cover = [d['id'] for d in linked if not d.get('image')]
+    if without_cover:
+        await jobs.enqueue("bgg_enrich", {"ids": without_cover})
+
+# What a sold listing contributes to its game's market stats (see market.py)
+MARKET_SALE_FIELDS = {'bggId', 'price', 'condition'}
+
 @api_router.put("/listings/{id}")
 async def update_listing(id: str, update_data: dict = Body(...)):
     update_data.pop('id', None)
     update_data.pop('createdAt', None)
     update_data['updatedAt'] = datetime.now(timezone.utc).isoformat()
+    if 'title' in update_data:
+        update_data['normTitle'] = title_key(update_data['title'])
+    previous = None
+    if 'bggId' in update_data:
+        # Set by hand, so no longer a guess from the title
+        update_data['bggIdSource'] = None
+        # A sale recorded under the old bggId has to leave that game's market window
+        previous = await data_access.find_one("listings", {"id": id}, {"_id": 0, "bggId": 1})
     
-    result = await db.listings.update_one({"id": id}, {"$set": update_data})
-    if result.modified_count == 0:
+    # updatedAt always changes, so a match is always a modification
+    updated = await data_access.find_one_and_update("listings", {"id": id}, {"$set": update_data}, {"_id": 0})
+    if updated is None:
         raise HTTPException(status_code=404, detail="Listing not found")
-    
-    updated = await db.listings.find_one({"id": id}, {"_id": 0})
+    await http_cache.bump("listings")
+    await feed_views.updated(updated, status_changed='status' in update_data)
+    if 'image' in update_data or 'images' in update_data:
+        await uploads.claim([update_data.get('image')] + list(update_data.get('images') or []))
+    # Sold prices feed the per-game market stats
+    if 'status' in update_data or (updated.get('status') == 'sold' and MARKET_SALE_FIELDS & update_data.keys()):
+        payload = {"id": id}
+        if previous and previous.get('bggId') and previous['bggId'] != updated.get('bggId'):
+            payload["previousBggId"] = previous['bggId']
+        await jobs.enqueue("market_sale", payload)
     return updated
 
 @api_router.delete("/listings/{id}")
 async def delete_listing(id: str):
-    result = await db.listings.delete_one({"id": id})
-    if result.deleted_count == 0:
+    deleted = await data_access.find_one_and_delete("listings", {"id": id}, {"_id": 0, "id": 1, "sellerId": 1, "status": 1, "bggId": 1})
+    if deleted is None:
         raise HTTPException(status_code=404, detail="Listing not found")
+    await http_cache.bump("listings")
+    await feed_views.removed(deleted)
+    if deleted.get('status') == 'sold':
+        await market.remove_sale(deleted)
     return {"status": "success"}
 
 @api_router.post("/listings/{id}/bid")
 async def place_bid(id: str, bid: BidRequest):
-    listing = await db.listings.find_one({"id": id})
+    listing = await data_access.find_one("listings", {"id": id})
     if not listing:
         raise HTTPException(status_code=404, detail="Listing not found")
     
@@ -612,37 +746,44 @@ async def place_bid(id: str, bid: BidRequest):
         "updatedAt": datetime.now(timezone.utc).isoformat()
     }
     
-    await db.listings.update_one({"id": id}, {"$set": update_data})
+    await data_access.update_one("listings", {"id": id}, {"$set": update_data})
+    await http_cache.bump("listings")
+    listing.pop('_id', None)
+    await feed_views.updated({**listing, **update_data})
 @api_router.post("/listings/{id}/comments")
 async def add_comment(id: str, comment: CommentRequest, request: Request):
     token = request.cookies.get("session_token")
     if not token:
         raise HTTPException(status_code=401, detail="Not authenticated")
-    session = await db.user_sessions.find_one({"session_token": token})
+    session = await data_access.find_one("user_sessions", {"session_token": token})
     if not session:
         raise HTTPException(status_code=401, detail="Invalid session")
         
-    user = await db.users.find_one({"id": session['user_id']})
+    user = await data_access.load_user(session['user_id'])
     if not user:
         raise HTTPException(status_code=401, detail="User not found")
 
     new_comment = Comment(
         userId=user['id'],
         userName=user['displayName'],
-        userAvatar=user.get('picture') or user.get('image'),
+        userAvatar=user_avatar(user),
         text=comment.text
     )
     
     comment_doc = new_comment.model_dump()
     comment_doc['createdAt'] = comment_doc['createdAt'].isoformat()
     
-    result = await db.listings.update_one(
+    updated = await data_access.find_one_and_update(
+        "listings",
         {"id": id},
-        {"$push": {"comments": comment_doc}}
+        {"$push": {"comments": comment_doc}},
+        {"_id": 0}
     )
     
-    if result.modified_count == 0:
+    if updated is None:
         raise HTTPException(status_code=404, detail="Listing not found")
+    await http_cache.bump("listings")
+    await feed_views.updated(updated)
         
     return comment_doc
 
@@ -651,18 +792,23 @@ async def delete_comment(id: str, commentId: str, request: Request):
     token = request.cookies.get("session_token")
     if not token:
         raise HTTPException(status_code=401, detail="Not authenticated")
-    session = await db.user_sessions.find_one({"session_token": token})
+    session = await data_access.find_one("user_sessions", {"session_token": token})
     if not session:
         raise HTTPException(status_code=401, detail="Invalid session")
         
-    # Remove comment only if user matches
-    result = await db.listings.update_one(
-        {"id": id},
-        {"$pull": {"comments": {"id": commentId, "userId": session['user_id']}}}
+    # Remove comment only if user matches; the filter makes a miss return None
+    owned = {"id": commentId, "userId": session['user_id']}
+    updated = await data_access.find_one_and_update(
+        "listings",
+        {"id": id, "comments": {"$elemMatch": owned}},
+        {"$pull": {"comments": owned}},
+        {"_id": 0}
     )
     
-    if result.modified_count == 0:
+    if updated is None:
         raise HTTPException(status_code=404, detail="Comment not found or unauthorized")
+    await http_cache.bump("listings")
+    await feed_views.updated(updated)
         
     return {"status": "success"}
 
@@ -670,44 +816,162 @@ async def delete_comment(id: str, commentId: str, request: Request):
 
 # Seed endpoint removed
 
-# Integrations
+# Uploads (multipart; the base64-in-JSON fields are kept for compatibility)
 
-@api_router.post("/ai/scan-image")
-async def scan_image(req: ScanImageRequest):
+# Saved searches and their inbox
+class SavedSearchRequest(BaseModel):
+    title: Optional[str] = None
+    bggId: Optional[str] = None
+    maxPrice: Optional[float] = None
+    minCondition: Optional[float] = None
+    type: Optional[str] = None  # WTS, WTB, WTT, WTL; default any but WTB
+
+class InboxReadRequest(BaseModel):
+    ids: Optional[List[str]] = None  # None marks everything read
+
+async def session_user_id(request: Request) -> str:
+    token = request.cookies.get("session_token")
+    if not token:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    session = await data_access.find_one("user_sessions", {"session_token": token})
+    if not session:
+        raise HTTPException(status_code=401, detail="Invalid session")
+    return session['user_id']
+
+@api_router.get("/saved-searches")
+async def list_saved_searches(request: Request):
+    return saved_searches.user_searches(await session_user_id(request))
+
+@api_router.post("/saved-searches")
+async def create_saved_search(req: SavedSearchRequest, request: Request):
+    user_id = await session_user_id(request)
     try:
-        chat = LlmChat(
-            api_key=os.environ.get("EMERGENT_LLM_KEY"),
-            session_id=f"scan-{uuid.uuid4()}",
-            system_message="You are a board game expert."
-        ).with_model("gemini", "gemini-2.5-flash")
+        return await saved_searches.create(user_id, req.title, req.bggId, req.maxPrice, req.minCondition, req.type)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@api_router.delete("/saved-searches/{id}")
+async def delete_saved_search(id: str, request: Request):
+    if not await saved_searches.delete(await session_user_id(request), id):
+        raise HTTPException(status_code=404, detail="Saved search not found")
+    return {"status": "success"}
+
+@api_router.get("/inbox")
+async def get_inbox(request: Request, unread: bool = False):
+    """Listings that matched the user's saved searches, newest first."""
+    return await saved_searches.inbox(await session_user_id(request), unread_only=unread)
+
+@api_router.post("/inbox/read")
+async def mark_inbox_read(req: InboxReadRequest, request: Request):
+    count = await saved_searches.mark_read(await session_user_id(request), req.ids)
+    return {"status": "success", "marked": count}
+
+@api_router.post("/uploads/images")
+async def upload_images(request: Request):
+    user_id = await session_user_id(request)
+    quota = await uploads.check_quota(user_id, request)
+    files = await uploads.receive_images(request, quota=quota)
+    # Kept only once a listing refers to them (see uploads.claim)
+    await uploads.record(files, user_id)
+    return [{"url": f['url'], "contentType": f['contentType'], "size": f['size']} for f in files]
+
+@api_router.get("/uploads/{name}")
+async def get_upload(name: str):
+    path = uploads.stored_path(name)
+    if not path:
+        raise HTTPException(status_code=404, detail="Not found")
+    # Names are random and never reused, so the file can be cached forever
+    return FileResponse(path, headers={"Cache-Control": "public, max-age=31536000, immutable"})
+
+# Integrations
 
-        prompt = """Look at this image of boardgames. Identify ALL boardgames visible. 
+LLM_TIMEOUT = float(os.environ.get("LLM_TIMEOUT", 25.0))
+
+async def scan_photo(b64_data: str):
+    """Identify the games in a base64 photo: local cover index first, LLM for the rest."""
+    # Covers we've seen on earlier listings are recognized locally; only the rest goes to the LLM
+    try:
+        known, b64_data = await asyncio.to_thread(cover_index.index.match_photo, b64_data)
+    except Exception as e:
+        logging.warning(f"Cover index lookup failed: {e}")
+        known = []
+    metrics.cache_result("cover_index", bool(known))
+    recognized = [
+        {"title": k['title'], "price": 0, "condition": 8.0, "description": "", "bggId": k['bggId']}
+        for k in known
+    ]
+    if b64_data is None:
+        return recognized
+
+    chat = LlmChat(
+        api_key=os.environ.get("EMERGENT_LLM_KEY"),
+        session_id=f"scan-{uuid.uuid4()}",
+        system_message="You are a board game expert."
+    ).with_model("gemini", "gemini-2.5-flash")
+
+    prompt = """Look at this image of boardgames. Identify ALL boardgames visible. 
         Return a JSON ARRAY of objects. Each object must have: 
         - 'title' (string)
         - 'price' (number, guess 0 if not visible)
         - 'condition' (number 1.0 to 10.0, estimate based on wear, default 8.0)
         - 'description' (short text)
         Strictly JSON array only. Do not wrap in markdown."""
-        
+
+    image_content = ImageContent(image_base64=b64_data)
+    
+    user_msg = UserMessage(text=prompt, file_contents=[image_content])
+    try:
+        with metrics.time_upstream("llm_scan_image"):
+            response = await deadlines.run(chat.send_message(user_msg), LLM_TIMEOUT, "llm_scan_image")
+    except deadlines.DeadlineExceeded:
+        # What the cover index recognized is still an answer
+        if recognized:
+            return recognized
+        raise
+
+    text = response.replace("```json", "").replace("```", "").strip()
+    try:
+        data = json.loads(text)
+    except:
+        return recognized
+    if isinstance(data, dict):
+        data = [data]
+    known_titles = {title_key(r['title']) for r in recognized}
+    return recognized + [d for d in data if not isinstance(d, dict) or title_key(d.get('title')) not in known_titles]
+
+@api_router.post("/ai/scan-image")
+async def scan_image(req: ScanImageRequest):
+    # Compatibility path: base64 inside JSON. Prefer /ai/scan-image/upload.
+    try:
         b64_data = req.image
-        if "base64," in b64_data:
-            b64_data = b64_data.split("base64,")[1]
+        marker = b64_data.find("base64,")
+        if marker != -1:
+            b64_data = b64_data[marker + 7:]
+        return await scan_photo(b64_data)
+    except deadlines.DeadlineExceeded:
+        raise
+    except Exception as e:
+        logging.error(f"AI Scan Error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
 
-        image_content = ImageContent(image_base64=b64_data)
-        
-        user_msg = UserMessage(text=prompt, file_contents=[image_content])
-        response = await chat.send_message(user_msg)
-        
-        text = response.replace("```json", "").replace("```", "").strip()
-        try:
-            data = json.loads(text)
-            return data
-        except:
-            return []
-            
+@api_router.post("/ai/scan-image/upload")
+async def scan_image_upload(request: Request):
+    # Phone photos are often HEIC; the file is only read here and removed afterwards
+    files = await uploads.receive_images(request, max_files=1, allow_heic=True)
+    if not files:
+        raise HTTPException(status_code=400, detail="No image uploaded")
+    path = files[0]['path']
+    try:
+        # The LLM client only takes base64, so encode once from disk
+        b64_data = await asyncio.to_thread(lambda: base64.b64encode(Path(path).read_bytes()).decode())
+        return await scan_photo(b64_data)
+    except deadlines.DeadlineExceeded:
+        raise
     except Exception as e:
         logging.error(f"AI Scan Error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        os.remove(path)
 
 @api_router.post("/ai/parse-text")
 async def parse_text(req: ParseTextRequest):
@@ -724,7 +988,8 @@ async def parse_text(req: ParseTextRequest):
         Strictly JSON array only. Do not wrap in markdown."""
         
         user_msg = UserMessage(text=prompt)
-        response = await chat.send_message(user_msg)
+        with metrics.time_upstream("llm_parse_text"):
+            response = await deadlines.run(chat.send_message(user_msg), LLM_TIMEOUT, "llm_parse_text")
         
         text = response.replace("```json", "").replace("```", "").strip()
         try:
@@ -733,38 +998,30 @@ async def parse_text(req: ParseTextRequest):
         except:
             return []
             
+    except deadlines.DeadlineExceeded:
+        raise
     except Exception as e:
         logging.error(f"AI Parse Error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
-@api_router.get("/bgg/search")
-async def bgg_search(q: str):
-    if not q or len(q) < 3:
-        return []
-    
+# Below this much of the request budget, search results go out without images/descriptions
+BGG_DETAILS_MIN_SECONDS = float(os.environ.get("BGG_DETAILS_MIN_SECONDS", 1.5))
+
+def fetch_bgg_results(q: str):
+    """Blocking BGG lookup (XML API with scrape fallback). Run off the event loop.
+
+    Returns (results, complete); complete is False when the request deadline
+    cut the details lookups short.
+    """
     results = []
     
     # 1. Try XML API
     try:
         url = f"https://boardgamegeek.com/xmlapi2/search?query={q}&type=boardgame"
-        s = get_bgg_session()
-        res = s.get(url, timeout=5)
+        res = bgg_get(xml_search_breaker, url, timeout=5)
         
-        if res.status_code == 200 and res.content:
-            data = xmltodict.parse(res.content)
-            items = data.get('items', {}).get('item', [])
-            if isinstance(items, dict): items = [items]
-            
-            for item in items[:5]:
-                name_val = item.get('name', {}).get('@value')
-                if not name_val and isinstance(item.get('name'), list):
-                     name_val = item.get('name')[0].get('@value')
-                     
-                results.append({
-                    "id": item.get('@id'),
-                    "title": name_val,
-                    "year": item.get('yearpublished', {}).get('@value')
-                })
+        if res is not None and res.content:
+            results = bgg_xml.parse_search(res.content, limit=5)
     except Exception as e:
         logging.warning(f"BGG XML Search failed, trying scrape: {e}")
 
@@ -776,34 +1033,210 @@ async def bgg_search(q: str):
     # For XML API results, we still need details. 
     # For Scrape results, we have thumbnails but no description/full-image.
     
-    # We will try to fetch details for the top results.
-    for r in results[:5]:
-        # Try XML details first
+    # We will try to fetch details for the top results, in one batched thing request.
+    # An open breaker makes bgg_get return None at once, so we go straight to the scrape.
+    left = deadlines.remaining()
+    if left is not None and left < BGG_DETAILS_MIN_SECONDS:
+        for r in results:
+            r.setdefault('description', '')
+        return results, False
+
+    things = {}
+    ids = [r['id'] for r in results[:5] if r.get('id')]
+    if ids:
         try:
-             url = f"https://boardgamegeek.com/xmlapi2/thing?id={r['id']}"
-             s = get_bgg_session()
-             res = s.get(url, timeout=5)
-             if res.status_code == 200:
-                d_data = xmltodict.parse(res.content)
-                item = d_data.get('items', {}).get('item', {})
-                if item:
-                    r['image'] = item.get('image', r.get('image', ''))
-                    r['thumbnail'] = item.get('thumbnail', r.get('thumbnail', ''))
-                    raw_desc = item.get('description', '')
-                    r['description'] = html.unescape(raw_desc) if raw_desc else ""
-             else:
-                 raise Exception("XML Details blocked")
-        except:
+            url = f"https://boardgamegeek.com/xmlapi2/thing?id={','.join(ids)}"
+            res = bgg_get(xml_thing_breaker, url, timeout=5)
+            if res is not None:
+                things = bgg_xml.parse_things(res.content)
+        except Exception as e:
+            logging.warning(f"BGG XML Details failed, trying scrape: {e}")
+
+    for r in results[:5]:
+        item = things.get(r['id'])
+        if item:
+            r['image'] = item.get('image', r.get('image', ''))
+            r['thumbnail'] = item.get('thumbnail', r.get('thumbnail', ''))
+            r['description'] = item.get('description', '')
+            r['alternateNames'] = item.get('alternateNames', [])
+        else:
             # Fallback Scrape Details
             details = scrape_bgg_details(r['id'])
             if details.get('image'): r['image'] = details['image']
             if details.get('description'): r['description'] = details['description']
-            
+
+    # bgg_get only skips calls for lack of time once less than BGG_MIN_CALL_SECONDS is left
+    left = deadlines.remaining()
+    return results, left is None or left >= BGG_MIN_CALL_SECONDS
+
+def fetch_bgg_things(bgg_ids: List[str]) -> dict:
+    """Blocking batched /thing lookup. Raises when BGG can't be reached, so a job retries later."""
+    res = bgg_get(xml_thing_breaker, f"https://boardgamegeek.com/xmlapi2/thing?id={','.join(bgg_ids)}", timeout=10)
+    if res is None:
+        raise RuntimeError("BGG thing lookup unavailable")
+    return bgg_xml.parse_things(res.content)
+
+@jobs.job("bgg_enrich", concurrency=2, max_attempts=8, timeout=120)
+async def enrich_listings_from_bgg(payload: dict):
+    """Payload {ids}: give BGG-linked listings without a cover BGG's cover, then queue hashing it."""
+    # Links guessed from the title since the job was queued don't count either
+    listings = await data_access.find(
+        "listings", {"id": {"$in": payload["ids"]}, "bggId": {"$nin": [None, ""]}, "bggIdSource": {"$ne": "title"},
+                     "image": {"$in": [None, ""]}},
+        {"_id": 0, "id": 1, "bggId": 1}
+    )
+    bgg_ids = sorted({str(l['bggId']) for l in listings})
+    things = {}
+    for start in range(0, len(bgg_ids), 20):
+        things.update(await asyncio.to_thread(fetch_bgg_things, bgg_ids[start:start + 20]))
+    games = [{"bggId": i, "title": t.get('title'), "alternateNames": t.get('alternateNames')}
+             for i, t in things.items() if t.get('alternateNames')]
+    if games:
+        await titles.learn_aliases(games)
+
+    covered = []
+    for l in listings:
+        thing = things.get(str(l['bggId'])) or {}
+        cover = thing.get('image') or thing.get('thumbnail')
+        # Only if the seller hasn't added one meanwhile
+        if cover and (await data_access.update_one(
+                "listings", {"id": l['id'], "image": {"$in": [None, ""]}}, {"$set": {"image": cover}})).modified_count:
+            covered.append(l)
+    if not covered:
+        return
+    await feed_views.refreshed(await data_access.find("listings", {"id": {"$in": [l['id'] for l in covered]}}, {"_id": 0}))
+    await http_cache.bump("listings")
+    await jobs.enqueue("cover_index", {"ids": [l['id'] for l in covered]})
+
+# BGG results cache (shared across workers), keyed by normalized title
+BGG_CACHE_TTL = int(os.environ.get("BGG_CACHE_TTL", 6 * 60 * 60))
+BGG_MATCH_CONCURRENCY = int(os.environ.get("BGG_MATCH_CONCURRENCY", 4))
+
+async def cached_bgg_search(q: str):
+    key = f"bgg:search:{normalize_title(q)}"
+    try:
+        hit = await shared_state.get(key)
+    except Exception as e:
+        logging.warning(f"BGG cache read failed: {e}")
+        hit = None
+    metrics.cache_result("bgg_search", hit is not None)
+    if hit is not None:
+        return hit
+
+    results, complete = await asyncio.to_thread(fetch_bgg_results, q)
+    # Alternate names feed the title alias table; they aren't part of the response
+    games = [{"bggId": r['id'], "title": r.get('title'), "alternateNames": r.pop('alternateNames')}
+             for r in results if r.get('id') and r.get('alternateNames')]
+    if games:
+        run_in_background(titles.learn_aliases(games))
+    # Results missing details for lack of time aren't cached, so the next search fills them in
+    if results and complete:
+        try:
+            await shared_state.set(key, results, ttl=BGG_CACHE_TTL)
+        except Exception as e:
+            logging.warning(f"BGG cache write failed: {e}")
     return results
 
+@api_router.get("/bgg/{id}/market")
+async def bgg_market(id: str):
+    """What a game has been selling for: price percentiles, overall and by condition."""
+    return await market.market_value(id)
+
+@api_router.get("/status/upstreams")
+async def upstream_status():
+    return {name: b.snapshot() for name, b in breakers.items()}
+
+@api_router.get("/bgg/search", response_class=ORJSONResponse)
+async def bgg_search(q: str):
+    if not q or len(q) < 3:
+        return ORJSONResponse([])
+    return ORJSONResponse(await cached_bgg_search(q))
+
+# Each title can cost a BGG search, so one request can't ask for too many
+BGG_MATCH_MAX_TITLES = 50
+
+class BggMatchRequest(BaseModel):
+    titles: List[str] = Field(..., max_length=BGG_MATCH_MAX_TITLES)
+
+def pick_bgg_match(key: str, results: list):
+    if not results:
+        return None
+    for r in results:
+        if title_key(r.get('title')) == key:
+            return r
+    return results[0]
+
+@api_router.post("/bgg/match", response_class=ORJSONResponse)
+async def bgg_match(req: BggMatchRequest, request: Request):
+    # Dedupe by title key, keep the first spelling we saw for the lookup
+    wanted = {}
+    for t in req.titles:
+        key = title_key(t)
+        if len(key) >= 3 and key not in wanted:
+            wanted[key] = t.strip()
+
+    # The rate limiter took one token for the request; each further title can be a BGG search
+    allowed, retry_after = await rate_limit.take(request.scope, len(wanted) - 1)
+    if not allowed:
+        raise HTTPException(status_code=429, detail="Too many requests, please slow down",
+                            headers={"Retry-After": str(max(1, math.ceil(retry_after)))})
+
+    matches = {}
+
+    # 1. Local index: titles already linked to a BGG id on earlier listings
+    if wanted:
+        known = await data_access.find(
+            "listings",
+            {"normTitle": {"$in": list(wanted)}, "bggId": {"$nin": [None, ""]}, "bggIdSource": {"$ne": "title"},
+             "image": {"$nin": [None, ""]}},
+            {"_id": 0, "title": 1, "normTitle": 1, "bggId": 1, "image": 1, "description": 1},
+            tier="search"
+        )
+        for l in known:
+            key = l['normTitle']
+            if key in wanted and key not in matches:
+                matches[key] = {
+                    "bggId": l['bggId'],
+                    "title": l['title'],
+                    "image": l.get('image', ''),
+                    "description": l.get('description', '')
+                }
+
+    # 2. Cache / BGG for the rest, with bounded parallelism
+    sem = asyncio.Semaphore(BGG_MATCH_CONCURRENCY)
+
+    async def resolve(key: str, title: str):
+        async with sem:
+            try:
+                results = await cached_bgg_search(title)
+            except Exception as e:
+                logging.warning(f"BGG match failed for {title}: {e}")
+                return
+        best = pick_bgg_match(key, results)
+        if best:
+            matches[key] = {
+                "bggId": best.get('id'),
+                "title": best.get('title'),
+                "image": best.get('image') or best.get('thumbnail', ''),
+                "description": best.get('description', '')
+            }
+
+    await asyncio.gather(*(resolve(k, t) for k, t in wanted.items() if k not in matches))
+
+    return ORJSONResponse([
+        {"query": t, **(matches.get(title_key(t)) or {"bggId": None, "image": ""})}
+        for t in req.titles
+    ])
+
 # Include the router in the main app
 app.include_router(api_router)
 
+# Limits sit inside the response cache so cache hits don't use up a client's quota
+app.add_middleware(rate_limit.RateLimitMiddleware)
+
+# Cached bodies are stored uncompressed and still get CORS headers
+app.add_middleware(http_cache.ResponseCacheMiddleware)
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
@@ -812,12 +1245,64 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.get("/metrics", include_in_schema=False)
+async def prometheus_metrics():
+    body, content_type = metrics.render()
+    return Response(content=body, media_type=content_type)
+
+# Compress anything over the threshold; prefer brotli when the client accepts it
+COMPRESSION_MIN_SIZE = int(os.environ.get("COMPRESSION_MIN_SIZE", 1024))
+try:
+    from brotli_asgi import BrotliMiddleware
+    app.add_middleware(BrotliMiddleware, minimum_size=COMPRESSION_MIN_SIZE, gzip_fallback=True)
+except ImportError:
+    app.add_middleware(GZipMiddleware, minimum_size=COMPRESSION_MIN_SIZE)
+
+# Opt-in (DIAGNOSTICS=1): per-request profiling via the X-Profile header
+if diagnostics.ENABLED:
+    app.add_middleware(diagnostics.ProfilerMiddleware)
+
+# Starts each request's time budget (see deadlines.py); 504 when an upstream uses it all
+app.add_middleware(deadlines.DeadlineMiddleware)
+
+# Outermost, so latency includes every other middleware
+app.add_middleware(metrics.MetricsMiddleware)
+
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def startup_shared_state():
+    if int(os.environ.get("WEB_CONCURRENCY", 1)) > 1:
+        check_multi_process(f"WEB_CONCURRENCY={os.environ['WEB_CONCURRENCY']} runs several API workers")
+    if not jobs.JOBS_IN_APP:
+        check_multi_process("JOBS_IN_APP=false leaves jobs to a separate worker.py")
+    await resources.startup()
+    await shared_state.start()
+    await http_cache.start()
+    await cover_index.load(db)
+    await titles.load()
+    await saved_searches.load()
+    await feed_views.load()
+    await trade_match.load()
+    await migrations.start()
+    await uploads.start()
+    run_in_background(duplicates.start())
+    run_in_background(market.ensure_built())
+    if jobs.JOBS_IN_APP:
+        await jobs.start()
+    task = asyncio.create_task(metrics.sample_loop_lag())
+    background_tasks.add(task)
+    if diagnostics.ENABLED:
+        diagnostics.detector.start()
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
-    client.close()
+    await jobs.stop()
+    await resources.shutdown()
+    await shared_state.close()
+    diagnostics.detector.stop()
+    metrics.shutdown()
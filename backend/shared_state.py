@@ -0,0 +1,231 @@
+"""
+Shared state backend for caches and cross-worker messaging.
+
+Everything that would otherwise live in a per-process dict (BGG results,
+response cache versions, ...) goes through `state`. With SHARED_STATE_URL unset
+it is an in-process MemoryState, which is right for a single uvicorn worker.
+With SHARED_STATE_URL=redis://host:6379/0 every worker talks to the same Redis
+(or anything speaking the Redis protocol, e.g. fakeredis / a local
+redis-server in tests), so caches stay coherent across workers and nodes.
+
+Invalidation is plain pub/sub: a worker that writes publishes a message on a
+channel, and every worker (including itself) runs the handlers registered for
+that channel with subscribe().
+
+A MemoryState's messages never leave its process. With several uvicorn
+workers (WEB_CONCURRENCY) or a separate worker.py (JOBS_IN_APP=false), each
+process would keep its own feed views, response cache versions and indexes,
+and never hear of the others' writes. check_multi_process() refuses to start
+that setup unless ALLOW_MEMORY_STATE=true says the staleness is accepted.
+"""
+
+import asyncio
+import inspect
+import logging
+import os
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import orjson
+
+logger = logging.getLogger(__name__)
+
+Handler = Callable[[dict], Any]
+
+
+class MemoryState:
+    """Single-process backend: TTL dict plus synchronous in-process pub/sub."""
+
+    def __init__(self, max_entries: int = 10000):
+        self.max_entries = max_entries
+        self._data: Dict[str, tuple] = {}
+        self._buckets: Dict[str, list] = {}
+        self._handlers: Dict[str, List[Handler]] = {}
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def get(self, key: str):
+        hit = self._data.get(key)
+        if hit is None:
+            return None
+        expires, value = hit
+        if expires is not None and expires < time.monotonic():
+            self._data.pop(key, None)
+            return None
+        return value
+
+    async def set(self, key: str, value, ttl: Optional[float] = None):
+        if key not in self._data and len(self._data) >= self.max_entries:
+            self._data.pop(next(iter(self._data)))
+        expires = time.monotonic() + ttl if ttl else None
+        self._data[key] = (expires, value)
+
+    async def delete(self, key: str):
+        self._data.pop(key, None)
+
+    async def incr(self, key: str, amount: int = 1) -> int:
+        value = int(await self.get(key) or 0) + amount
+        self._data[key] = (None, value)
+        return value
+
+    async def take_token(self, key: str, capacity: float, rate: float, cost: float = 1) -> Tuple[bool, float]:
+        """Token bucket: returns (allowed, seconds until enough tokens are available)."""
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= self.max_entries:
+                self._buckets.pop(next(iter(self._buckets)))
+            bucket = self._buckets[key] = [capacity, now]
+        tokens = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        if tokens >= cost:
+            bucket[0] = tokens - cost
+            return True, 0.0
+        bucket[0] = tokens
+        return False, (cost - tokens) / rate
+
+    def subscribe(self, channel: str, handler: Handler):
+        self._handlers.setdefault(channel, []).append(handler)
+
+    async def publish(self, channel: str, message: dict):
+        await _dispatch(self._handlers.get(channel, ()), message)
+
+
+# Same algorithm as MemoryState.take_token, atomic on the server and using its clock
+TOKEN_BUCKET_LUA = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local b = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(b[1]) or capacity
+local ts = tonumber(b[2]) or now
+tokens = math.min(capacity, tokens + (now - ts) * rate)
+local allowed = 0
+local retry = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+else
+    retry = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity / rate * 1000) + 1000)
+return {allowed, tostring(retry)}
+"""
+
+
+class RedisState:
+    """Redis-protocol backend. Values are stored as orjson, pub/sub runs in a listener task."""
+
+    def __init__(self, url: str, prefix: str = "pmbg:"):
+        import redis.asyncio as aioredis  # optional dependency, only needed for this backend
+
+        self.url = url
+        self.prefix = prefix
+        self._redis = aioredis.from_url(url)
+        self._token_bucket = self._redis.register_script(TOKEN_BUCKET_LUA)
+        self._handlers: Dict[str, List[Handler]] = {}
+        self._pubsub = None
+        self._listener: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self._pubsub = self._redis.pubsub()
+        if self._handlers:
+            await self._pubsub.subscribe(*(self.prefix + c for c in self._handlers))
+        self._listener = asyncio.create_task(self._listen())
+
+    async def close(self):
+        if self._listener:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+        if self._pubsub:
+            await self._pubsub.aclose()
+        await self._redis.aclose()
+
+    async def get(self, key: str):
+        raw = await self._redis.get(self.prefix + key)
+        return orjson.loads(raw) if raw is not None else None
+
+    async def set(self, key: str, value, ttl: Optional[float] = None):
+        px = int(ttl * 1000) if ttl else None
+        await self._redis.set(self.prefix + key, orjson.dumps(value), px=px)
+
+    async def delete(self, key: str):
+        await self._redis.delete(self.prefix + key)
+
+    async def incr(self, key: str, amount: int = 1) -> int:
+        return await self._redis.incrby(self.prefix + key, amount)
+
+    async def take_token(self, key: str, capacity: float, rate: float, cost: float = 1) -> Tuple[bool, float]:
+        allowed, retry = await self._token_bucket(keys=[self.prefix + key], args=[capacity, rate, cost])
+        return bool(allowed), float(retry)
+
+    def subscribe(self, channel: str, handler: Handler):
+        new_channel = channel not in self._handlers
+        self._handlers.setdefault(channel, []).append(handler)
+        if new_channel and self._pubsub is not None:
+            asyncio.get_running_loop().create_task(self._pubsub.subscribe(self.prefix + channel))
+
+    async def publish(self, channel: str, message: dict):
+        await self._redis.publish(self.prefix + channel, orjson.dumps(message))
+
+    async def _listen(self):
+        while True:
+            try:
+                # listen() returns straight away while nothing is subscribed
+                if not self._pubsub.subscribed:
+                    await asyncio.sleep(0.5)
+                    continue
+                async for msg in self._pubsub.listen():
+                    if msg.get("type") != "message":
+                        continue
+                    channel = msg["channel"]
+                    if isinstance(channel, bytes):
+                        channel = channel.decode()
+                    handlers = self._handlers.get(channel[len(self.prefix):], ())
+                    await _dispatch(handlers, orjson.loads(msg["data"]))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Shared state listener error, reconnecting: {e}")
+                await asyncio.sleep(1)
+
+
+async def _dispatch(handlers, message: dict):
+    for handler in list(handlers):
+        try:
+            result = handler(message)
+            if inspect.isawaitable(result):
+                await result
+        except Exception as e:
+            logger.error(f"Shared state handler error: {e}")
+
+
+def create_state(url: Optional[str] = None):
+    if url and url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisState(url)
+    return MemoryState()
+
+
+state = create_state(os.environ.get("SHARED_STATE_URL"))
+
+
+def check_multi_process(reason: str):
+    """Fail startup when `reason` (another process) would run beside an in-process MemoryState."""
+    if not isinstance(state, MemoryState):
+        return
+    message = (f"{reason}, but SHARED_STATE_URL is not set: each process would serve its own stale "
+               "feed views and response caches. Set SHARED_STATE_URL to a Redis URL.")
+    if os.environ.get("ALLOW_MEMORY_STATE", "false").lower() == "true":
+        logger.error(f"{message} Starting anyway (ALLOW_MEMORY_STATE=true).")
+        return
+    raise RuntimeError(message)
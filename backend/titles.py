@@ -0,0 +1,218 @@
+"""
+Title keys shared by the BGG cache, bulk matching, trade matching and the
+duplicate index.
+
+normalize_title() is the plain text step: lowercase, punctuation to spaces,
+whitespace collapsed. title_key() is the grouping key stored on listings as
+`normTitle`; on top of that it folds accents, spells "&" as "and", drops
+edition/printing tokens, a leading article and a trailing year, and maps alternate names to the
+game's primary name:
+
+    "CATAN 5th ed."      -> "catan"
+    "Settlers of Catan"  -> "catan"   (once BGG has told us it's an alias)
+
+The alias table is learned from the alternate names in BGG thing responses.
+It is stored in `title_aliases`, loaded at startup, and learned aliases are
+broadcast on the "title_aliases" channel so every worker applies them. An
+alternate name claimed by two different games is marked ambiguous and never
+used.
+
+The worker that learns an alias moves the listings stored under it to the
+primary name's key. When an alias turns ambiguous, it moves the listings it
+had rewritten back to their own key. The listings it touches go through
+feed_views.refreshed(), so the in-memory indexes over listings re-key them
+in every worker. Indexes keyed on titles of their own register with
+subscribe() and are told which aliases changed, here or in another worker.
+"""
+
+import logging
+import re
+import unicodedata
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from pymongo import UpdateOne
+
+import data_access
+import feed_views
+import http_cache
+from shared_state import state
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = "title_aliases"
+
+_QUALIFIER = (r"(?:\d+(?:st|nd|rd|th)|first|second|third|fourth|fifth|sixth|seventh|eighth|ninth|tenth"
+              r"|revised|new|english|anniversary|collectors?|retail)")
+# "ed" only counts after a qualifier ("5th ed"), so "Ed" in a name survives
+_EDITION = re.compile(rf"\b(?:{_QUALIFIER}\s+)+(?:edition|ed|printing|version)\b|\b(?:edition|printing)\b")
+_TRAILING = re.compile(r"\s+(?:(?:19|20)\d\d|board\s+game)$")
+_LEADING = re.compile(r"^(?:the|a)\s+(?=\S)")
+
+# alias key -> (primary key, bggId); None when two games claim the alias
+_aliases: Dict[str, Optional[Tuple[str, str]]] = {}
+# primary key -> bggId; None when two games share the primary name
+_primaries: Dict[str, Optional[str]] = {}
+_listeners: List[Callable[[Set[str]], None]] = []
+
+
+def normalize_title(title: str) -> str:
+    """Lowercase, punctuation to spaces, whitespace collapsed: "CATAN: 5th ed." -> "catan 5th ed"."""
+    title = re.sub(r"[^\w\s]", " ", (title or "").lower())
+    return " ".join(title.split())
+
+
+def base_key(title: str) -> str:
+    """title_key() without the alias table."""
+    folded = unicodedata.normalize("NFKD", title or "")
+    folded = "".join(c for c in folded if not unicodedata.combining(c)).replace("&", " and ")
+    key = normalize_title(folded)
+    stripped = " ".join(_EDITION.sub(" ", key).split())
+    while True:
+        shorter = _TRAILING.sub("", stripped)
+        if shorter == stripped:
+            break
+        stripped = shorter
+    stripped = _LEADING.sub("", stripped)
+    # "The 2nd Edition" is still a title
+    return stripped or key
+
+
+def title_key(title: str) -> str:
+    key = base_key(title)
+    alias = _aliases.get(key)
+    return alias[0] if alias else key
+
+
+def bgg_id_for_key(key: str) -> Optional[str]:
+    """The BGG game whose primary or alternate name has this key, if exactly one does."""
+    if key in _primaries:
+        return _primaries[key]
+    alias = _aliases.get(key)
+    return alias[1] if alias else None
+
+
+def _apply(alias: str, canonical: str, bgg_id: str) -> bool:
+    """Record one claim on an alias locally; True if that changed what the alias means."""
+    entry = (canonical, bgg_id)
+    if alias in _aliases and _aliases[alias] != entry:
+        entry = None
+    changed = _aliases.get(alias, False) != entry
+    _aliases[alias] = entry
+    return changed
+
+
+def _apply_primary(key: str, bgg_id: str):
+    if key in _primaries and _primaries[key] != bgg_id:
+        _primaries[key] = None
+    else:
+        _primaries[key] = bgg_id
+
+
+async def load():
+    async for doc in data_access.collection("title_aliases", "search").find({}, {"_id": 0}):
+        for claim in doc.get("claims", []):
+            _apply_primary(claim["canonical"], claim["bggId"])
+            _apply(doc["alias"], claim["canonical"], claim["bggId"])
+    logger.info(f"Title aliases loaded ({len(_aliases)} aliases, {len(_primaries)} primary names)")
+
+
+def subscribe(callback: Callable[[Set[str]], None]):
+    """Call `callback(alias keys)` whenever what those aliases map to changes, here or in another worker."""
+    _listeners.append(callback)
+
+
+def _notify(aliases: Set[str]):
+    for callback in _listeners:
+        try:
+            callback(aliases)
+        except Exception as e:
+            logger.error(f"Title alias listener failed: {e}")
+
+
+def _learn_local(games: Iterable[dict]) -> List[Tuple[str, str, str, Optional[Tuple[str, str]]]]:
+    """Apply games' alternate names.
+
+    Returns the (alias, canonical, bggId, what the alias meant before) claims that changed anything.
+    """
+    changed = []
+    for game in games:
+        bgg_id = str(game["bggId"])
+        canonical = base_key(game.get("title"))
+        if not canonical:
+            continue
+        _apply_primary(canonical, bgg_id)
+        for name in game.get("alternateNames") or []:
+            alias = base_key(name)
+            # Another game's primary name is never an alias of this one
+            if not alias or alias == canonical or _primaries.get(alias, bgg_id) != bgg_id:
+                continue
+            before = _aliases.get(alias)
+            if _apply(alias, canonical, bgg_id):
+                changed.append((alias, canonical, bgg_id, before))
+    return changed
+
+
+async def _rekey_listings(resolved: Set[str], reverted: Dict[str, str]):
+    """Move listings' normTitle to what the changed aliases mean now.
+
+    `resolved` aliases now map to a primary name; `reverted` maps aliases that
+    turned ambiguous to the primary key their listings were moved to.
+    """
+    ops, ids = [], []
+    if resolved:
+        for doc in await data_access.find("listings", {"normTitle": {"$in": list(resolved)}},
+                                          {"_id": 0, "id": 1, "normTitle": 1}):
+            ops.append(UpdateOne({"id": doc["id"], "normTitle": doc["normTitle"]},
+                                 {"$set": {"normTitle": _aliases[doc["normTitle"]][0]}}))
+            ids.append(doc["id"])
+    if reverted:
+        # Only the listings whose own title is the alias; the rest were always under the primary name
+        for doc in await data_access.find("listings", {"normTitle": {"$in": list(set(reverted.values()))}},
+                                          {"_id": 0, "id": 1, "title": 1, "normTitle": 1}):
+            alias = base_key(doc.get("title"))
+            if reverted.get(alias) == doc["normTitle"]:
+                ops.append(UpdateOne({"id": doc["id"], "normTitle": doc["normTitle"]}, {"$set": {"normTitle": alias}}))
+                ids.append(doc["id"])
+    if not ops:
+        return
+    listings = data_access.collection("listings")
+    for start in range(0, len(ops), 1000):
+        await listings.bulk_write(ops[start:start + 1000], ordered=False)
+    for start in range(0, len(ids), 1000):
+        await feed_views.refreshed(await data_access.find("listings", {"id": {"$in": ids[start:start + 1000]}}, {"_id": 0}))
+    await http_cache.bump("listings")
+
+
+async def learn_aliases(games: List[dict]):
+    """Add BGG alternate names ({bggId, title, alternateNames}) to the alias table."""
+    changed = _learn_local(games)
+    if not changed:
+        return
+    # Claims accumulate, so workers learning different games for one alias still end up ambiguous
+    alias_ops = [
+        UpdateOne({"alias": alias}, {"$addToSet": {"claims": {"canonical": canonical, "bggId": bgg_id}}}, upsert=True)
+        for alias, canonical, bgg_id, _ in changed
+    ]
+    # An alias can change twice in one batch; what it meant before the batch is what listings are under
+    before = {}
+    for alias, _, _, meant in changed:
+        before.setdefault(alias, meant)
+    resolved = {alias for alias in before if _aliases[alias]}
+    reverted = {alias: meant[0] for alias, meant in before.items() if meant and not _aliases[alias]}
+    try:
+        await data_access.collection("title_aliases").bulk_write(alias_ops, ordered=False)
+        # Published first, so other workers re-key the refreshed listings with the new table
+        await state.publish(CHANNEL, {"games": games})
+        await _rekey_listings(resolved, reverted)
+    except Exception as e:
+        logger.warning(f"Saving title aliases failed: {e}")
+    _notify(set(before))
+
+
+def _on_learned(message: dict):
+    changed = _learn_local(message.get("games") or [])
+    if changed:
+        _notify({alias for alias, _, _, _ in changed})
+
+
+state.subscribe(CHANNEL, _on_learned)
@@ -0,0 +1,266 @@
+"""
+Trade matching over active listings.
+
+Wants are WTB listings. Haves are listings someone is giving up: WTS, WTT,
+or anything marked openForTrade. Both are indexed by key, "bgg:<bggId>" when
+the listing is linked to BGG and "t:<title_key>" always (see titles.py), so
+a linked want still finds an unlinked listing of the same game. Links guessed
+from the title (bggIdSource "title", see duplicates.py) only get the title
+key, so a wrong guess can't match two different games.
+
+- direct: other users' haves matching a user's wants, cheapest first.
+- wantedBy: other users' wants matching a user's haves.
+- cycles: multi-party swaps. The trade graph has an edge A -> B when A wants
+  something B offers for trade (WTT or openForTrade); a cycle A -> B -> C -> A
+  lets everyone give one game and get one. Found with a bounded DFS from the
+  requesting user, shortest cycles first, up to TRADE_MAX_CYCLE_LEN parties.
+
+The index and the graph's edge counts are updated per listing change through
+feed_views.subscribe (local writes and other workers' alike), so a change
+costs one pass over the listings sharing its keys, not a rebuild. Only a
+compact entry per active listing is held; load() builds it at startup with a
+narrow projection. Served at GET /api/trades/{userId}.
+"""
+
+import logging
+import os
+from typing import Dict, NamedTuple, Optional, Set
+
+import data_access
+import feed_views
+from titles import title_key
+
+logger = logging.getLogger(__name__)
+
+TRADE_MAX_CYCLE_LEN = int(os.environ.get("TRADE_MAX_CYCLE_LEN", 3))
+TRADE_RESULT_LIMIT = int(os.environ.get("TRADE_RESULT_LIMIT", 50))
+TRADE_CYCLE_LIMIT = int(os.environ.get("TRADE_CYCLE_LIMIT", 20))
+# Edges followed per cycle search, so one well-connected user can't stall the loop
+TRADE_SEARCH_BUDGET = int(os.environ.get("TRADE_SEARCH_BUDGET", 50_000))
+
+PROJECTION = {"_id": 0, "id": 1, "sellerId": 1, "type": 1, "title": 1, "bggId": 1,
+              "price": 1, "status": 1, "openForTrade": 1, "bggIdSource": 1}
+
+
+class _Entry(NamedTuple):
+    id: str
+    user: str
+    type: str
+    title: str
+    bggId: Optional[str]
+    price: Optional[float]
+    want: bool
+    tradeable: bool
+    keys: tuple
+
+
+def _entry(doc: dict) -> Optional[_Entry]:
+    if doc.get("status", "active") != "active" or not doc.get("sellerId"):
+        return None
+    listing_type = doc.get("type")
+    want = listing_type == "WTB"
+    tradeable = not want and (listing_type == "WTT" or bool(doc.get("openForTrade")))
+    if not want and not tradeable and listing_type != "WTS":
+        return None
+    keys = []
+    if doc.get("bggId") and doc.get("bggIdSource") != "title":
+        keys.append(f"bgg:{doc['bggId']}")
+    title = title_key(doc.get("title"))
+    if title:
+        keys.append(f"t:{title}")
+    if not keys:
+        return None
+    return _Entry(doc["id"], doc["sellerId"], listing_type, doc.get("title") or "",
+                  str(doc["bggId"]) if doc.get("bggId") else None, doc.get("price"),
+                  want, tradeable, tuple(keys))
+
+
+def _add(index: Dict[str, Set[str]], key: str, value: str):
+    index.setdefault(key, set()).add(value)
+
+
+def _discard(index: Dict[str, Set[str]], key: str, value: str):
+    values = index.get(key)
+    if values is not None:
+        values.discard(value)
+        if not values:
+            del index[key]
+
+
+class TradeIndex:
+    def __init__(self):
+        self.entries: Dict[str, _Entry] = {}
+        self.wants: Dict[str, Set[str]] = {}
+        self.haves: Dict[str, Set[str]] = {}
+        self.by_user: Dict[str, Set[str]] = {}
+        # edges[a][b]: how many (want of a, tradeable have of b) pairs match
+        self.edges: Dict[str, Dict[str, int]] = {}
+
+    def _matching(self, index: Dict[str, Set[str]], keys: tuple) -> Set[str]:
+        found = set()
+        for key in keys:
+            found |= index.get(key, set())
+        return found
+
+    def _edge(self, a: str, b: str, delta: int):
+        out = self.edges.setdefault(a, {})
+        n = out.get(b, 0) + delta
+        if n > 0:
+            out[b] = n
+        else:
+            out.pop(b, None)
+            if not out:
+                del self.edges[a]
+
+    def _link(self, e: _Entry, delta: int):
+        # Each (want, have) pair is counted once, by whichever side arrives later
+        if e.want:
+            for hid in self._matching(self.haves, e.keys):
+                h = self.entries[hid]
+                if h.tradeable and h.user != e.user:
+                    self._edge(e.user, h.user, delta)
+        elif e.tradeable:
+            for wid in self._matching(self.wants, e.keys):
+                w = self.entries[wid]
+                if w.user != e.user:
+                    self._edge(w.user, e.user, delta)
+
+    def upsert(self, doc: dict):
+        self.remove(doc["id"])
+        e = _entry(doc)
+        if e is None:
+            return
+        self._link(e, 1)
+        self.entries[e.id] = e
+        for key in e.keys:
+            _add(self.wants if e.want else self.haves, key, e.id)
+        _add(self.by_user, e.user, e.id)
+
+    def remove(self, listing_id: str):
+        e = self.entries.pop(listing_id, None)
+        if e is None:
+            return
+        for key in e.keys:
+            _discard(self.wants if e.want else self.haves, key, e.id)
+        _discard(self.by_user, e.user, e.id)
+        self._link(e, -1)
+
+    def _own(self, user: str, want: bool):
+        for lid in self.by_user.get(user, ()):
+            e = self.entries[lid]
+            if e.want == want:
+                yield e
+
+    def direct(self, user: str, limit: int = TRADE_RESULT_LIMIT) -> list:
+        found = {}
+        for w in self._own(user, want=True):
+            for hid in self._matching(self.haves, w.keys):
+                h = self.entries[hid]
+                if h.user != user and hid not in found:
+                    found[hid] = {"wantListingId": w.id, "listingId": h.id, "userId": h.user, "type": h.type,
+                                  "title": h.title, "bggId": h.bggId, "price": h.price, "forTrade": h.tradeable}
+        return sorted(found.values(), key=lambda m: (m["price"] is None, m["price"] or 0))[:limit]
+
+    def wanted_by(self, user: str, limit: int = TRADE_RESULT_LIMIT) -> list:
+        found = {}
+        for h in self._own(user, want=False):
+            for wid in self._matching(self.wants, h.keys):
+                w = self.entries[wid]
+                if w.user != user and wid not in found:
+                    found[wid] = {"listingId": h.id, "wantListingId": w.id, "userId": w.user,
+                                  "title": w.title, "bggId": w.bggId, "price": w.price}
+        # Best offers first
+        return sorted(found.values(), key=lambda m: (m["price"] is None, -(m["price"] or 0)))[:limit]
+
+    def _leg(self, receiver: str, giver: str) -> Optional[dict]:
+        for w in self._own(receiver, want=True):
+            for hid in self._matching(self.haves, w.keys):
+                h = self.entries[hid]
+                if h.tradeable and h.user == giver:
+                    return {"from": giver, "to": receiver, "listingId": h.id, "wantListingId": w.id, "title": h.title}
+        return None
+
+    def cycles(self, user: str, max_len: int = TRADE_MAX_CYCLE_LEN, limit: int = TRADE_CYCLE_LIMIT) -> list:
+        """Swaps through `user`, each as the list of legs (who gives what to whom)."""
+        found = []
+        budget = TRADE_SEARCH_BUDGET
+        path = [user]
+
+        def search(node: str, length: int):
+            nonlocal budget
+            for nxt in self.edges.get(node, ()):
+                budget -= 1
+                if budget < 0 or len(found) >= limit:
+                    return
+                if len(path) == length:
+                    if nxt == user:
+                        found.append(list(path))
+                elif nxt not in path:
+                    path.append(nxt)
+                    search(nxt, length)
+                    path.pop()
+
+        for length in range(2, max_len + 1):
+            search(user, length)
+
+        results = []
+        for cycle in found:
+            # cycle[i] wants from cycle[i + 1], wrapping back to the user
+            legs = [self._leg(cycle[i], cycle[(i + 1) % len(cycle)]) for i in range(len(cycle))]
+            if all(legs):
+                results.append({"users": cycle, "legs": legs})
+        return results
+
+
+index = TradeIndex()
+_loaded = False
+# Changes seen while load() is reading; replayed on top of what it read
+_replay: Optional[list] = None
+
+
+def _on_change(listing_id: str, doc: Optional[dict]):
+    if _replay is not None:
+        _replay.append((listing_id, doc))
+    if doc is None:
+        index.remove(listing_id)
+    else:
+        index.upsert(doc)
+
+
+feed_views.subscribe(_on_change)
+
+
+async def load():
+    """Build the index from every active listing."""
+    global index, _loaded, _replay
+    _replay = []
+    fresh = TradeIndex()
+    try:
+        cursor = data_access.collection("listings", "search").find(
+            {"status": {"$in": ["active", None]}}, PROJECTION
+        ).batch_size(2000)
+        async for doc in cursor:
+            fresh.upsert(doc)
+    finally:
+        replay, _replay = _replay, None
+    for listing_id, doc in replay:
+        if doc is None:
+            fresh.remove(listing_id)
+        else:
+            fresh.upsert(doc)
+    index = fresh
+    _loaded = True
+    logger.info(f"Trade index loaded ({len(index.entries)} listings, {len(index.edges)} users with trade edges)")
+
+
+def ready() -> bool:
+    return _loaded
+
+
+def matches(user_id: str) -> dict:
+    return {
+        "userId": user_id,
+        "direct": index.direct(user_id),
+        "wantedBy": index.wanted_by(user_id),
+        "cycles": index.cycles(user_id),
+    }
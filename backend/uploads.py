@@ -0,0 +1,370 @@
+"""
+Streaming multipart image uploads.
+
+The JSON endpoints carry images as base64 strings, which costs a third more
+bytes and means holding the whole body plus a decoded copy in memory. Here
+the request body is read chunk by chunk, fed to python-multipart's streaming
+parser and written to disk in a worker thread every UPLOAD_FLUSH_BYTES, so
+the event loop never waits on the disk. The size limits (and the user's
+remaining daily quota) are checked against Content-Length before anything
+is read and again on every chunk, so an oversized or chunked upload is
+rejected without being buffered.
+
+Stored files are served back from GET /api/uploads/{name}.
+
+Uploading needs a session. Every stored file is recorded in the `uploads`
+collection with its uploader, which also caps what one user can store per
+day (UPLOAD_DAILY_BYTES). A file is claimed once a listing or avatar
+refers to it (claim()); the "uploads_reap" job deletes files nobody
+claimed within UPLOAD_GRACE_SECONDS, along with parts left behind by
+interrupted uploads. Files from before uploads were recorded are left
+alone.
+"""
+
+import asyncio
+import logging
+import os
+import re
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Iterable, List, Optional
+
+from fastapi import HTTPException, Request
+
+import data_access
+import jobs
+
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ImportError:  # python-multipart < 0.0.13
+    from multipart.multipart import MultipartParser, parse_options_header
+
+UPLOAD_DIR = Path(os.environ.get("UPLOAD_DIR", Path(__file__).parent / "uploads"))
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", 10 * 1024 * 1024))
+MAX_UPLOAD_FILES = int(os.environ.get("MAX_UPLOAD_FILES", 10))
+UPLOAD_URL_PREFIX = "/api/uploads/"
+UPLOAD_DAILY_BYTES = int(os.environ.get("UPLOAD_DAILY_BYTES", 200 * 1024 * 1024))
+UPLOAD_GRACE_SECONDS = int(os.environ.get("UPLOAD_GRACE_SECONDS", 24 * 60 * 60))
+UPLOAD_REAP_INTERVAL = int(os.environ.get("UPLOAD_REAP_INTERVAL", 60 * 60))
+# Received data is held up to this much before a thread writes it out
+UPLOAD_FLUSH_BYTES = int(os.environ.get("UPLOAD_FLUSH_BYTES", 256 * 1024))
+
+logger = logging.getLogger(__name__)
+
+# Magic bytes -> (content type, extension); anything else is rejected
+IMAGE_SIGNATURES = [
+    (b"\xff\xd8\xff", "image/jpeg", ".jpg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png", ".png"),
+    (b"GIF87a", "image/gif", ".gif"),
+    (b"GIF89a", "image/gif", ".gif"),
+]
+# ISO BMFF brands of HEIC/HEIF stills, what iPhones save photos as
+HEIF_BRANDS = {b"heic", b"heix", b"heim", b"heis", b"hevc", b"hevx", b"hevm", b"hevs", b"mif1", b"msf1"}
+_SAFE_NAME = re.compile(r"^[0-9a-f]{32}\.(jpg|png|gif|webp)$")
+# Upload names inside image URLs, relative or absolute
+_URL_NAME = re.compile(re.escape(UPLOAD_URL_PREFIX) + r"([0-9a-f]{32}\.(?:jpg|png|gif|webp))")
+
+
+def _sniff(head: bytes, allow_heic: bool = False):
+    for magic, content_type, ext in IMAGE_SIGNATURES:
+        if head.startswith(magic):
+            return content_type, ext
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp", ".webp"
+    if allow_heic and head[4:8] == b"ftyp" and head[8:12] in HEIF_BRANDS:
+        return "image/heic", ".heic"
+    return None
+
+
+class _Part:
+    def __init__(self):
+        self.headers = {}
+        self.field = ""
+        self.path = None
+        self.file = None
+        self.head = b""
+        self.size = 0
+        self.content_type = None
+        # Received but not yet written, and whether the part is complete
+        self.pending: List[bytes] = []
+        self.ended = False
+
+
+def _flush(parts: List["_Part"]):
+    """Write out what the parser buffered; runs in a worker thread."""
+    for part in parts:
+        if part.path is None:
+            continue
+        if part.pending:
+            if part.file is None:
+                part.file = open(part.path, "ab")
+            part.file.write(b"".join(part.pending))
+            part.pending.clear()
+        if part.ended and part.file is not None:
+            part.file.close()
+            part.file = None
+
+
+def _close(parts: List["_Part"]):
+    for part in parts:
+        if part.file is not None:
+            part.file.close()
+            part.file = None
+        if part.path is not None:
+            try:
+                os.remove(part.path)
+            except FileNotFoundError:
+                pass
+
+
+async def receive_images(request: Request, max_files: int = MAX_UPLOAD_FILES, allow_heic: bool = False,
+                         quota: Optional[int] = None) -> List[dict]:
+    """Stream every file part of a multipart request to UPLOAD_DIR.
+
+    Returns [{"name", "path", "url", "contentType", "size", "field"}]. Raises 413 on
+    oversized bodies, 429 once the body passes `quota` bytes (what the user may
+    still upload, see check_quota) and 415 on non-multipart requests or
+    non-image files; any partially written files are removed. HEIC/HEIF is only
+    accepted with `allow_heic`, for files that are processed and not served
+    back (most browsers can't display it).
+    """
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or b"boundary" not in params:
+        raise HTTPException(status_code=415, detail="Expected multipart/form-data")
+
+    limit = MAX_UPLOAD_BYTES * max_files
+    declared = request.headers.get("content-length")
+    if declared and declared.isdigit() and int(declared) > limit:
+        raise HTTPException(status_code=413, detail="Upload too large")
+
+    UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
+    parts: List[_Part] = []
+    errors = []
+    state = {"part": None, "header_field": b"", "header_value": b""}
+
+    def on_part_begin():
+        state["part"] = _Part()
+
+    def on_header_field(data, start, end):
+        state["header_field"] += data[start:end]
+
+    def on_header_value(data, start, end):
+        state["header_value"] += data[start:end]
+
+    def on_header_end():
+        state["part"].headers[state["header_field"].lower()] = state["header_value"]
+        state["header_field"] = b""
+        state["header_value"] = b""
+
+    def on_headers_finished():
+        part = state["part"]
+        _, disp = parse_options_header(part.headers.get(b"content-disposition", b""))
+        part.field = disp.get(b"name", b"").decode("latin-1")
+        if b"filename" in disp:
+            if len([p for p in parts if p.path]) >= max_files:
+                errors.append((413, "Too many files"))
+                return
+            part.path = UPLOAD_DIR / f".partial-{uuid.uuid4().hex}"
+        parts.append(part)
+
+    def on_part_data(data, start, end):
+        part = state["part"]
+        if part is None or part.path is None or errors:
+            return
+        chunk = data[start:end]
+        if len(part.head) < 16:
+            part.head += chunk[:16 - len(part.head)]
+        part.size += len(chunk)
+        if part.size > MAX_UPLOAD_BYTES:
+            errors.append((413, "File too large"))
+            return
+        part.pending.append(chunk)
+
+    def on_part_end():
+        part = state["part"]
+        if part is not None:
+            part.ended = True
+        state["part"] = None
+
+    parser = MultipartParser(params[b"boundary"], {
+        "on_part_begin": on_part_begin,
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data,
+        "on_part_end": on_part_end,
+    })
+
+    received = 0
+    buffered = 0
+    try:
+        async for chunk in request.stream():
+            received += len(chunk)
+            if received > limit:
+                raise HTTPException(status_code=413, detail="Upload too large")
+            # Also catches chunked bodies, which declare no length up front
+            if quota is not None and received > quota:
+                raise HTTPException(status_code=429, detail="Daily upload limit reached")
+            parser.write(chunk)
+            if errors:
+                raise HTTPException(status_code=errors[0][0], detail=errors[0][1])
+            buffered += len(chunk)
+            if buffered >= UPLOAD_FLUSH_BYTES:
+                await asyncio.to_thread(_flush, parts)
+                buffered = 0
+        parser.finalize()
+        await asyncio.to_thread(_flush, parts)
+
+        stored = []
+        for part in parts:
+            if part.path is None:
+                continue
+            sniffed = _sniff(part.head, allow_heic)
+            if sniffed is None:
+                accepted = "JPEG, PNG, GIF, WebP and HEIC" if allow_heic else "JPEG, PNG, GIF and WebP"
+                raise HTTPException(status_code=415, detail=f"Only {accepted} images are accepted")
+            content_type, ext = sniffed
+            name = f"{uuid.uuid4().hex}{ext}"
+            final = UPLOAD_DIR / name
+            await asyncio.to_thread(os.replace, part.path, final)
+            part.path = final
+            stored.append({
+                "name": name,
+                "path": str(final),
+                "url": UPLOAD_URL_PREFIX + name,
+                "contentType": content_type,
+                "size": part.size,
+                "field": part.field,
+            })
+        return stored
+    except BaseException:
+        # Not awaited in a thread: this also runs when the request is cancelled
+        _close(parts)
+        raise
+
+
+def stored_path(name: str):
+    """Path of a stored upload, or None for unknown / unsafe names."""
+    if not _SAFE_NAME.match(name):
+        return None
+    path = UPLOAD_DIR / name
+    return path if path.is_file() else None
+
+
+async def check_quota(user_id: str, request: Request) -> int:
+    """Bytes the user may still upload (UPLOAD_DAILY_BYTES over the last day).
+
+    429 up front when the declared Content-Length is already past it; pass the
+    result to receive_images(quota=...) to hold bodies of unknown length to it.
+    """
+    since = datetime.now(timezone.utc) - timedelta(days=1)
+    used = await data_access.collection("uploads").aggregate([
+        {"$match": {"userId": user_id, "createdAt": {"$gte": since}}},
+        {"$group": {"_id": None, "bytes": {"$sum": "$size"}}},
+    ]).to_list(1)
+    used = used[0]["bytes"] if used else 0
+    declared = request.headers.get("content-length")
+    incoming = int(declared) if declared and declared.isdigit() else 0
+    if used + incoming > UPLOAD_DAILY_BYTES:
+        raise HTTPException(status_code=429, detail="Daily upload limit reached")
+    return UPLOAD_DAILY_BYTES - used
+
+
+async def record(files: List[dict], user_id: str, claimed: bool = False):
+    """Remember who stored `files`; unclaimed ones are reaped after the grace period."""
+    if not files:
+        return
+    now = datetime.now(timezone.utc)
+    await data_access.collection("uploads").insert_many([
+        {"name": f["name"], "userId": user_id, "size": f["size"], "contentType": f["contentType"],
+         "createdAt": now, "claimed": claimed}
+        for f in files
+    ])
+
+
+def referenced_names(values: Iterable) -> List[str]:
+    """Upload names in image URLs (skipping base64 data, which can't be one)."""
+    names = []
+    for value in values:
+        if isinstance(value, str) and not value.startswith("data:"):
+            names.extend(_URL_NAME.findall(value))
+    return names
+
+
+async def claim(values: Iterable):
+    """Mark the uploads referred to by these image URLs as in use."""
+    names = referenced_names(values)
+    if names:
+        await data_access.collection("uploads").update_many(
+            {"name": {"$in": names}, "claimed": False}, {"$set": {"claimed": True}}
+        )
+
+
+def _remove_stale_partials(cutoff: float) -> int:
+    removed = 0
+    if not UPLOAD_DIR.is_dir():
+        return 0
+    with os.scandir(UPLOAD_DIR) as entries:
+        for entry in entries:
+            if entry.name.startswith(".partial-") and entry.stat().st_mtime < cutoff:
+                try:
+                    os.remove(entry.path)
+                    removed += 1
+                except FileNotFoundError:
+                    pass
+    return removed
+
+
+async def reap() -> int:
+    """Delete unclaimed uploads past the grace period. Returns how many files went."""
+    uploads = data_access.collection("uploads")
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=UPLOAD_GRACE_SECONDS)
+    removed = 0
+    while True:
+        stale = await uploads.find(
+            {"claimed": False, "createdAt": {"$lt": cutoff}}, {"_id": 0, "name": 1}
+        ).limit(500).to_list(None)
+        if not stale:
+            break
+        names = [u["name"] for u in stale]
+        # A listing written some way that didn't claim its images still keeps them
+        urls = [UPLOAD_URL_PREFIX + n for n in names]
+        used = set()
+        for doc in await data_access.find(
+                "listings", {"$or": [{"image": {"$in": urls}}, {"images": {"$in": urls}}]},
+                {"_id": 0, "image": 1, "images": 1}):
+            used.update(referenced_names([doc.get("image")] + list(doc.get("images") or [])))
+        for doc in await data_access.find("users", {"picture": {"$in": urls}}, {"_id": 0, "picture": 1}):
+            used.update(referenced_names([doc.get("picture")]))
+        if used:
+            await uploads.update_many({"name": {"$in": list(used)}}, {"$set": {"claimed": True}})
+        gone = [n for n in names if n not in used]
+        for name in gone:
+            try:
+                await asyncio.to_thread(os.remove, UPLOAD_DIR / name)
+            except FileNotFoundError:
+                pass
+        await uploads.delete_many({"name": {"$in": gone}})
+        removed += len(gone)
+    removed += await asyncio.to_thread(_remove_stale_partials, time.time() - UPLOAD_GRACE_SECONDS)
+    if removed:
+        logger.info(f"Removed {removed} unclaimed uploads")
+    return removed
+
+
+@jobs.job("uploads_reap", concurrency=1, timeout=600)
+async def reap_job(payload: dict):
+    await reap()
+    # Next round; if this one failed, its retries come first and start() restarts the chain on boot
+    await jobs.enqueue("uploads_reap", {}, key="uploads_reap", delay=UPLOAD_REAP_INTERVAL)
+
+
+async def start():
+    uploads = data_access.collection("uploads")
+    await uploads.create_index("name", unique=True)
+    await uploads.create_index([("userId", 1), ("createdAt", 1)])
+    await uploads.create_index([("claimed", 1), ("createdAt", 1)])
+    await jobs.enqueue("uploads_reap", {}, key="uploads_reap", delay=UPLOAD_REAP_INTERVAL)
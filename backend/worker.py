@@ -0,0 +1,51 @@
+"""
+Standalone job worker:
+
+    python backend/worker.py
+
+Runs the same job handlers as the API process (see jobs.py) without
+serving HTTP. Set JOBS_IN_APP=false on the API processes to leave all
+background work to workers like this one. Every process needs the same
+SHARED_STATE_URL: it carries the workers' writes to the API processes'
+in-memory views and wakes the worker as soon as something is enqueued, so
+without it the worker refuses to start (see shared_state.py).
+"""
+
+import asyncio
+import logging
+import signal
+
+# Importing the app registers every job handler and loads the shared config
+import server
+from server import cover_index, duplicates, jobs, resources, saved_searches, shared_state, titles
+from shared_state import check_multi_process
+
+logger = logging.getLogger("worker")
+
+
+async def main():
+    check_multi_process("worker.py runs beside the API processes")
+    await resources.startup()
+    await shared_state.start()
+    # In-memory state some handlers match against
+    await titles.load()
+    await saved_searches.load()
+    await cover_index.load(server.db)
+    await duplicates.load()
+    await jobs.start()
+
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopping.set)
+    await stopping.wait()
+
+    logger.info("Stopping job worker")
+    await jobs.stop()
+    await shared_state.close()
+    await resources.shutdown()
+    server.metrics.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -52,6 +52,18 @@ const api = axios.create({
     withCredentials: true // Important for cookies
 });
 
+// --- BGG Matching Helper ---
+// The backend takes at most 50 titles per /bgg/match request; results come back in order
+const BGG_MATCH_BATCH = 50;
+const matchBggTitles = async (titles) => {
+  const matches = [];
+  for (let start = 0; start < titles.length; start += BGG_MATCH_BATCH) {
+    const res = await api.post('/bgg/match', { titles: titles.slice(start, start + BGG_MATCH_BATCH) });
+    matches.push(...(res.data || []));
+  }
+  return matches;
+};
+
 // --- Image Resizing Helper ---
 const resizeImage = (file, maxWidth = 500, maxHeight = 500) => {
   return new Promise((resolve) => {
@@ -59,6 +71,8 @@ const resizeImage = (file, maxWidth = 500, maxHeight = 500) => {
     reader.readAsDataURL(file);
     reader.onload = (event) => {
       const img = new Image();
+      // Formats the browser can't decode (HEIC outside Safari) give no preview instead of hanging
+      img.onerror = () => resolve('');
       img.src = event.target.result;
       img.onload = () => {
         let width = img.width;
@@ -1309,71 +1323,62 @@ function AddGameModal({ onClose, onAdd, initialData }) {
 
   const enrichWithBGG = async (items) => {
     const updatedItems = [...items];
-    for (let i = 0; i < updatedItems.length; i++) {
-        const item = updatedItems[i];
-        if (!item.title) continue;
+    const titles = updatedItems.map(item => item.title || '');
+    if (!titles.some(t => t)) return updatedItems;
 
-        try {
-            if (i > 0) await new Promise(r => setTimeout(r, 500));
-            const res = await api.get(`/bgg/search?q=${encodeURIComponent(item.title)}`);
-            const results = res.data;
-            if (!results || results.length === 0) continue;
-
-            const exactMatch = results.find(r => r.title.toLowerCase() === item.title.toLowerCase());
-            const match = exactMatch || results[0];
-
-            if (match) {
-                 updatedItems[i] = { ...item };
-                 // Overwrite or fill image
-                 if (match.image) {
-                     const existing = updatedItems[i].images || [];
-                     updatedItems[i].image = match.image;
-                     updatedItems[i].images = [match.image, ...existing];
-                     updatedItems[i].bggId = match.id;
-                 }
-                 // Fill description if missing or short? BGG desc is usually good
-                 if (match.description) {
-                     updatedItems[i].description = match.description.replace(/<[^>]*>/g, ' ').slice(0, 1000) + "...";
-                 }
+    try {
+        // Batched requests; the backend dedupes and resolves titles in parallel
+        const matches = await matchBggTitles(titles);
+        matches.forEach((match, i) => {
+            if (!match || !match.bggId || !updatedItems[i].title) return;
+            updatedItems[i] = { ...updatedItems[i] };
+            // Overwrite or fill image
+            if (match.image) {
+                const existing = updatedItems[i].images || [];
+                updatedItems[i].image = match.image;
+                updatedItems[i].images = [match.image, ...existing];
+                updatedItems[i].bggId = match.bggId;
             }
-        } catch (e) { console.error(e); }
-    }
+            // Fill description if missing or short? BGG desc is usually good
+            if (match.description) {
+                updatedItems[i].description = match.description.replace(/<[^>]*>/g, ' ').slice(0, 1000) + "...";
+            }
+        });
+    } catch (e) { console.error(e); }
     return updatedItems;
   };
 
-  const processScanFile = (file) => {
+  const processScanFile = async (file) => {
     if (!file) return;
-    const reader = new FileReader();
-    reader.onloadend = async () => {
-      const base64 = reader.result;
-      setIsAnalyzing(true);
-      setErrorMsg('');
-      try {
-        const res = await api.post('/ai/scan-image', { image: base64 });
-        const items = Array.isArray(res.data) ? res.data : [res.data];
-        
-        const compressed = await resizeImage(file); 
-        const itemsWithImg = items.map(i => ({ 
-          ...i, 
-          images: [compressed], 
-          image: compressed, 
-          type: formData.type || 'WTS',
-          openForTrade: false 
-        }));
-        
-        // Auto-search BGG covers immediately
-        const enrichedItems = await enrichWithBGG(itemsWithImg);
-        
-        setDetectedItems(enrichedItems);
-        setStep('review');
-      } catch (err) {
-        console.error(err);
-        setErrorMsg("Failed to identify boardgames. Try again.");
-      } finally {
-        setIsAnalyzing(false);
-      }
-    };
-    reader.readAsDataURL(file);
+    setIsAnalyzing(true);
+    setErrorMsg('');
+    try {
+      // Send the raw file as multipart instead of a base64 data URL inside JSON
+      const body = new FormData();
+      body.append('file', file);
+      const res = await api.post('/ai/scan-image/upload', body);
+      const items = Array.isArray(res.data) ? res.data : [res.data];
+      
+      const compressed = await resizeImage(file); 
+      const itemsWithImg = items.map(i => ({ 
+        ...i, 
+        images: compressed ? [compressed] : [], 
+        image: compressed, 
+        type: formData.type || 'WTS',
+        openForTrade: false 
+      }));
+      
+      // Auto-search BGG covers immediately
+      const enrichedItems = await enrichWithBGG(itemsWithImg);
+      
+      setDetectedItems(enrichedItems);
+      setStep('review');
+    } catch (err) {
+      console.error(err);
+      setErrorMsg("Failed to identify boardgames. Try again.");
+    } finally {
+      setIsAnalyzing(false);
+    }
   };
 
   const handleScanInput = (e) => {
@@ -1519,31 +1524,27 @@ function AddGameModal({ onClose, onAdd, initialData }) {
     setIsSubmitting(true);
     try {
         const updatedItems = [...detectedItems];
-        for (let i = 0; i < updatedItems.length; i++) {
-            const item = updatedItems[i];
-            if ((item.image && item.description) || !item.title) continue;
+        const pending = updatedItems
+            .map((item, i) => ({ item, i }))
+            .filter(({ item }) => item.title && !(item.image && item.description));
 
+        if (pending.length > 0) {
             try {
-                if (i > 0) await new Promise(r => setTimeout(r, 500));
-                const res = await api.get(`/bgg/search?q=${encodeURIComponent(item.title)}`);
-                const results = res.data;
-                if (!results || results.length === 0) continue;
-
-                const exactMatch = results.find(r => r.title.toLowerCase() === item.title.toLowerCase());
-                const match = exactMatch || results[0];
-
-                if (match) {
-                     updatedItems[i] = { ...item };
-                     if (!updatedItems[i].image && match.image) {
-                         const existing = updatedItems[i].images || [];
-                         updatedItems[i].image = match.image;
-                         updatedItems[i].images = [match.image, ...existing];
-                         updatedItems[i].bggId = match.id;
-                     }
-                     if (!updatedItems[i].description && match.description) {
-                         updatedItems[i].description = match.description.replace(/<[^>]*>/g, ' ').slice(0, 1000) + "...";
-                     }
-                }
+                const matches = await matchBggTitles(pending.map(({ item }) => item.title));
+                pending.forEach(({ item, i }, j) => {
+                    const match = matches[j];
+                    if (!match || !match.bggId) return;
+                    updatedItems[i] = { ...item };
+                    if (!updatedItems[i].image && match.image) {
+                        const existing = updatedItems[i].images || [];
+                        updatedItems[i].image = match.image;
+                        updatedItems[i].images = [match.image, ...existing];
+                        updatedItems[i].bggId = match.bggId;
+                    }
+                    if (!updatedItems[i].description && match.description) {
+                        updatedItems[i].description = match.description.replace(/<[^>]*>/g, ' ').slice(0, 1000) + "...";
+                    }
+                });
             } catch (e) { console.error(e); }
         }
         setDetectedItems(updatedItems);
@@ -0,0 +1,26 @@
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import data_access  # noqa: E402
+import jobs  # noqa: E402
+import resources  # noqa: E402
+
+
+@pytest.fixture
+def db(monkeypatch):
+    """A fresh mongomock database behind data_access.collection()."""
+    database = AsyncMongoMockClient()["test"]
+    monkeypatch.setattr(resources, "db", database)
+    monkeypatch.setattr(jobs, "_indexes_created", False)
+    monkeypatch.setattr(data_access, "migrated", set())
+    return database
+
+
+def run(coro):
+    return asyncio.run(coro)
@@ -0,0 +1,62 @@
+from datetime import datetime, timezone
+
+import data_access
+import feed_views
+from tests.conftest import run
+
+MIXED = [
+    {"id": "a", "createdAt": "2024-03-01T00:00:00+00:00"},
+    {"id": "b", "createdAt": datetime(2023, 1, 1, tzinfo=timezone.utc)},
+    {"id": "c", "createdAt": "2024-01-01T00:00:00+00:00"},
+    {"id": "d"},
+    {"id": "e", "createdAt": datetime(2022, 6, 1)},
+    {"id": "f", "createdAt": "2025-01-01T00:00:00+00:00"},
+]
+
+
+def _mongo_order(db, docs):
+    run(db.listings.insert_many([dict(d) for d in docs]))
+    return [d["id"] for d in run(db.listings.find({}, {"_id": 0, "id": 1}).sort("createdAt", -1).to_list(None))]
+
+
+def test_created_key_matches_mongo_sort_on_mixed_types(db):
+    expected = _mongo_order(db, MIXED)
+    # Dates (any age) before strings before missing, as in BSON comparison order
+    assert expected == ["b", "e", "f", "a", "c", "d"]
+    stored = run(db.listings.find({}, {"_id": 0}).to_list(None))
+    assert [d["id"] for d in sorted(stored, key=feed_views._created_key, reverse=True)] == expected
+
+
+def test_created_key_once_listings_are_migrated(db):
+    migrated = [d for d in MIXED if not isinstance(d.get("createdAt"), datetime)]
+    expected = _mongo_order(db, migrated)
+    data_access.migrated.add("listings")
+    assert [d["id"] for d in sorted(migrated, key=feed_views._created_key, reverse=True)] == expected
+
+
+def _view(size=2):
+    return feed_views.RankedView(size, lambda d: d.get("type") == "WTS", feed_views._created_key)
+
+
+def test_ranked_view_keeps_the_newest():
+    view = _view()
+    view.reset([])
+    for i in range(6):
+        view.upsert({"id": str(i), "type": "WTS", "createdAt": f"2024-01-0{i + 1}"})
+    view.upsert({"id": "x", "type": "WTB", "createdAt": "2025-01-01"})
+    assert view.top() == ["5", "4"]
+    assert len(view.entries) == view.capacity and not view.complete
+    view.discard("5")
+    assert view.top() == ["4", "3"]
+
+
+def test_incomplete_view_ignores_what_ranks_below_it():
+    view = _view()
+    view.reset([{"id": str(i), "type": "WTS", "createdAt": f"2024-01-0{i + 5}"} for i in range(4)])
+    assert not view.complete
+    view.upsert({"id": "old", "type": "WTS", "createdAt": "2024-01-01"})
+    assert "old" not in view.keys
+    for i in range(3):
+        view.discard(str(i))
+    # One entry left of the two it serves: it can't vouch for the rest
+    assert not view.ready
@@ -0,0 +1,117 @@
+import asyncio
+from datetime import timedelta
+
+import jobs
+from tests.conftest import run
+
+
+async def _noop(payload):
+    pass
+
+
+async def _fail(payload):
+    raise ValueError("boom")
+
+
+def test_keyed_enqueue_keeps_one_queued_job(db):
+    async def main():
+        await asyncio.gather(*(jobs.enqueue("t_noop", {"n": i}, key="k") for i in range(5)))
+        return await db.jobs.count_documents({"key": "k", "status": "queued"})
+
+    assert run(main()) == 1
+
+
+def test_keyed_enqueue_skipped_while_running_elsewhere(db):
+    async def main():
+        await jobs.enqueue("t_noop", {}, key="k")
+        await db.jobs.update_one({"key": "k"}, {"$set": {"status": "running", "lockedUntil": jobs._now() + timedelta(minutes=1)}})
+        await jobs.enqueue("t_noop", {}, key="k")
+        return await db.jobs.count_documents({"key": "k"})
+
+    assert run(main()) == 1
+
+
+def test_keyed_enqueue_from_the_running_job_queues_its_successor(db):
+    async def main():
+        await jobs.enqueue("t_noop", {}, key="k")
+        doc = await db.jobs.find_one_and_update(
+            {"key": "k"}, {"$set": {"status": "running", "lockedUntil": jobs._now() + timedelta(minutes=1)}})
+        jobs._current_job.set(doc["id"])
+        await jobs.enqueue("t_noop", {}, key="k")
+        return await db.jobs.count_documents({"key": "k", "status": "queued"})
+
+    assert run(main()) == 1
+
+
+def test_unkeyed_enqueue_always_inserts(db):
+    async def main():
+        await jobs.enqueue("t_noop", {})
+        await jobs.enqueue("t_noop", {})
+        return await db.jobs.count_documents({})
+
+    assert run(main()) == 2
+
+
+def test_backoff_doubles_and_caps(monkeypatch):
+    monkeypatch.setattr(jobs.random, "uniform", lambda a, b: b)
+    assert jobs._backoff(1) == jobs.JOB_BACKOFF_BASE
+    assert jobs._backoff(3) == jobs.JOB_BACKOFF_BASE * 4
+    assert jobs._backoff(100) == jobs.JOB_BACKOFF_MAX
+    monkeypatch.setattr(jobs.random, "uniform", lambda a, b: a)
+    assert jobs._backoff(2) == jobs.JOB_BACKOFF_BASE
+
+
+def test_claim_takes_a_due_job_once(db):
+    spec = jobs.JobType(_noop, 1, 3, 60)
+
+    async def main():
+        await jobs.enqueue("t_noop", {"a": 1})
+        await jobs.enqueue("t_noop", {}, delay=60)
+        runner = jobs.Runner()
+        first = await runner._claim("t_noop", spec)
+        second = await runner._claim("t_noop", spec)
+        stored = await db.jobs.find_one({"id": first["id"]})
+        return first, second, stored, runner.id
+
+    first, second, stored, runner_id = run(main())
+    assert first["payload"] == {"a": 1} and first["attempts"] == 1
+    assert second is None
+    assert stored["status"] == "running" and stored["lockedBy"] == runner_id and stored["attempts"] == 1
+
+
+def test_claim_takes_over_an_expired_lock(db):
+    spec = jobs.JobType(_noop, 1, 3, 60)
+
+    async def main():
+        await jobs.enqueue("t_noop", {})
+        await db.jobs.update_one({}, {"$set": {"status": "running", "lockedBy": "gone", "attempts": 1,
+                                               "lockedUntil": jobs._now() - timedelta(seconds=1)}})
+        return await jobs.Runner()._claim("t_noop", spec)
+
+    assert run(main())["attempts"] == 2
+
+
+def test_failed_job_is_retried_with_backoff_then_fails_for_good(db, monkeypatch):
+    monkeypatch.setattr(jobs.random, "uniform", lambda a, b: b)
+    spec = jobs.JobType(_fail, 1, 2, 60)
+
+    async def attempt(runner):
+        doc = await runner._claim("t_fail", spec)
+        runner.running["t_fail"] = 1
+        await runner._execute(doc, spec)
+        return await db.jobs.find_one({"id": doc["id"]})
+
+    async def main():
+        await jobs.enqueue("t_fail", {})
+        runner = jobs.Runner()
+        retried = await attempt(runner)
+        assert await runner._claim("t_fail", spec) is None
+        await db.jobs.update_one({"id": retried["id"]}, {"$set": {"runAt": jobs._now()}})
+        return retried, await attempt(runner)
+
+    retried, failed = run(main())
+    assert retried["status"] == "queued" and retried["lastError"] == "ValueError: boom"
+    assert "lockedBy" not in retried
+    delay = (retried["runAt"] - retried["createdAt"]).total_seconds()
+    assert jobs.JOB_BACKOFF_BASE - 1 < delay < jobs.JOB_BACKOFF_BASE + 5
+    assert failed["status"] == "failed" and failed["attempts"] == 2
@@ -0,0 +1,83 @@
+import asyncio
+from datetime import datetime, timezone
+
+import pytest
+
+import data_access
+import migrations
+from tests.conftest import run
+
+
+@pytest.fixture
+def listings(db, monkeypatch):
+    monkeypatch.setattr(migrations, "MIGRATION_BATCH_SIZE", 2)
+    monkeypatch.setattr(migrations, "MIGRATION_PAUSE_SECONDS", 0)
+    monkeypatch.setattr(migrations, "_migrations", [m for m in migrations._migrations if m.collection == "listings"])
+    docs = [{"id": str(i), "createdAt": datetime(2024, 1, 1 + i, tzinfo=timezone.utc)} for i in range(5)]
+    # Already in the new shape: only gets its schemaVersion
+    docs.append({"id": "5", "createdAt": "2024-02-01T00:00:00+00:00"})
+    run(db.listings.insert_many(docs))
+    return db
+
+
+def test_run_converts_every_document(listings):
+    assert run(migrations.run()) is True
+    docs = run(listings.listings.find({}, {"_id": 0}).to_list(None))
+    assert all(isinstance(d["createdAt"], str) and d["schemaVersion"] == 1 for d in docs)
+    assert docs[0]["createdAt"] == "2024-01-01T00:00:00+00:00"
+    status = run(listings.migrations.find_one({"id": "listings:1"}))
+    assert status["status"] == "done" and status["changed"] == 5
+    assert "listings" in data_access.migrated
+
+
+def test_run_again_changes_nothing(listings):
+    run(migrations.run())
+    before = run(listings.listings.find({}, {"_id": 0}).to_list(None))
+    assert run(migrations.run()) is True
+    assert run(listings.listings.find({}, {"_id": 0}).to_list(None)) == before
+
+
+def test_repeated_batch_is_a_no_op(listings):
+    m = migrations._migrations[0]
+
+    async def main():
+        await migrations._run_batch(m, None)
+        return await migrations._run_batch(m, None)
+
+    last_id, changed = run(main())
+    assert last_id is not None and changed == 0
+
+
+def test_resumes_after_the_last_saved_batch(listings, monkeypatch):
+    real = migrations._run_batch
+    starts = []
+
+    async def crash_after_first_batch(m, last_id):
+        starts.append(last_id)
+        if len(starts) > 1:
+            raise RuntimeError("worker died")
+        return await real(m, last_id)
+
+    monkeypatch.setattr(migrations, "_run_batch", crash_after_first_batch)
+    with pytest.raises(RuntimeError):
+        run(migrations.run())
+    saved = run(listings.migrations.find_one({"id": "listings:1"}))
+    assert saved["lastId"] == starts[1]
+
+    # Held by the dead runner until its lease runs out
+    assert run(migrations.run()) is False
+    run(listings.migrations.update_one({"id": "listings:1"}, {"$set": {"leaseUntil": None}}))
+
+    starts.clear()
+    monkeypatch.setattr(migrations, "_run_batch", lambda m, last_id: starts.append(last_id) or real(m, last_id))
+    assert run(migrations.run()) is True
+    assert starts[0] == saved["lastId"]
+    assert run(listings.migrations.find_one({"id": "listings:1"}))["changed"] == 5
+
+
+def test_second_runner_backs_off_while_leased(listings):
+    async def main():
+        return await asyncio.gather(migrations.run(), migrations.run())
+
+    assert sorted(run(main())) == [False, True]
+    assert run(listings.listings.count_documents({"schemaVersion": 1})) == 6
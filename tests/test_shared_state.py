@@ -0,0 +1,43 @@
+import pytest
+
+import shared_state
+from tests.conftest import run
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(shared_state.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_take_token_spends_then_refills(clock):
+    state = shared_state.MemoryState()
+
+    async def take(cost=1):
+        return await state.take_token("k", capacity=3, rate=2, cost=cost)
+
+    assert [run(take()) for _ in range(3)] == [(True, 0.0)] * 3
+    allowed, wait = run(take())
+    assert not allowed and wait == pytest.approx(0.5)
+
+    clock[0] += 0.5
+    assert run(take()) == (True, 0.0)
+    # Refills only up to capacity, however long it sat idle
+    clock[0] += 60
+    assert [run(take())[0] for _ in range(4)] == [True, True, True, False]
+
+
+def test_take_token_costs_and_keys_are_separate(clock):
+    state = shared_state.MemoryState()
+    assert run(state.take_token("a", capacity=5, rate=1, cost=5)) == (True, 0.0)
+    allowed, wait = run(state.take_token("a", capacity=5, rate=1, cost=2))
+    assert not allowed and wait == pytest.approx(2)
+    assert run(state.take_token("b", capacity=5, rate=1, cost=2)) == (True, 0.0)
+
+
+def test_take_token_evicts_the_oldest_bucket(clock):
+    state = shared_state.MemoryState(max_entries=2)
+    for key in ("a", "b", "c"):
+        run(state.take_token(key, capacity=1, rate=1))
+    assert list(state._buckets) == ["b", "c"]
@@ -0,0 +1,81 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from fastapi import HTTPException
+
+import uploads
+from tests.conftest import run
+
+PNG = b"\x89PNG\r\n\x1a\n" + b"\0" * 1000
+BOUNDARY = "xyz"
+
+
+class FakeRequest:
+    """Just what uploads reads from a Starlette request: headers and the body stream."""
+
+    def __init__(self, body: bytes, chunk: int = 256, declare_length: bool = True):
+        self.headers = {"content-type": f"multipart/form-data; boundary={BOUNDARY}"}
+        if declare_length:
+            self.headers["content-length"] = str(len(body))
+        self._chunks = [body[i:i + chunk] for i in range(0, len(body), chunk)]
+
+    async def stream(self):
+        for chunk in self._chunks:
+            yield chunk
+
+
+def _multipart(*files: bytes) -> bytes:
+    body = b""
+    for i, data in enumerate(files):
+        body += (f"--{BOUNDARY}\r\nContent-Disposition: form-data; name=\"images\"; filename=\"{i}.png\"\r\n"
+                 f"Content-Type: image/png\r\n\r\n").encode() + data + b"\r\n"
+    return body + f"--{BOUNDARY}--\r\n".encode()
+
+
+@pytest.fixture
+def upload_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(uploads, "UPLOAD_DIR", tmp_path)
+    monkeypatch.setattr(uploads, "UPLOAD_FLUSH_BYTES", 512)
+    return tmp_path
+
+
+def test_check_quota_returns_what_is_left(db, monkeypatch):
+    monkeypatch.setattr(uploads, "UPLOAD_DAILY_BYTES", 5000)
+    now = datetime.now(timezone.utc)
+    run(db.uploads.insert_many([
+        {"userId": "u", "size": 1500, "createdAt": now},
+        {"userId": "u", "size": 9000, "createdAt": now - timedelta(days=2)},
+        {"userId": "v", "size": 9000, "createdAt": now},
+    ]))
+    assert run(uploads.check_quota("u", FakeRequest(b"", declare_length=False))) == 3500
+
+
+def test_check_quota_rejects_a_declared_length_past_it(db, monkeypatch):
+    monkeypatch.setattr(uploads, "UPLOAD_DAILY_BYTES", 5000)
+    run(db.uploads.insert_one({"userId": "u", "size": 4500, "createdAt": datetime.now(timezone.utc)}))
+    with pytest.raises(HTTPException) as e:
+        run(uploads.check_quota("u", FakeRequest(_multipart(PNG))))
+    assert e.value.status_code == 429
+
+
+def test_receive_images_within_quota(upload_dir):
+    body = _multipart(PNG, PNG)
+    stored = run(uploads.receive_images(FakeRequest(body, declare_length=False), quota=len(body)))
+    assert [f["contentType"] for f in stored] == ["image/png", "image/png"]
+    assert all((upload_dir / f["name"]).read_bytes() == PNG for f in stored)
+    assert not list(upload_dir.glob(".partial-*"))
+
+
+def test_chunked_body_past_quota_is_rejected_and_cleaned_up(upload_dir):
+    body = _multipart(PNG, PNG)
+    with pytest.raises(HTTPException) as e:
+        run(uploads.receive_images(FakeRequest(body, declare_length=False), quota=len(body) - 100))
+    assert e.value.status_code == 429
+    assert not list(upload_dir.iterdir())
+
+
+def test_non_image_is_rejected_and_cleaned_up(upload_dir):
+    with pytest.raises(HTTPException) as e:
+        run(uploads.receive_images(FakeRequest(_multipart(PNG, b"not an image" * 100))))
+    assert e.value.status_code == 415
+    assert not list(upload_dir.iterdir())